@@ -0,0 +1,187 @@
+"""
+Token-budgeted prompt context.
+Fits the system prompt, the rolling conversation summary and as many recent
+turns as the budget allows into the messages sent to the LLM. Turns that do
+not fit (and are not yet summarised) are handed back so the summariser can
+fold them into the summary off the hot path.
+"""
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence
+from config import settings
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken is optional; fall back to a character estimate
+    _encoding = None
+
+# Chat-format overhead per message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+CHARS_PER_TOKEN = 4
+
+prompt_tokens = metrics.histogram(
+    "whatsapp_llm_prompt_tokens",
+    "Prompt tokens per LLM call, as counted by the context builder",
+    buckets=(100, 250, 500, 750, 1000, 1500, 2000, 3000, 4000, 8000)
+)
+context_budget = metrics.counter(
+    "whatsapp_context_budget_total",
+    "Prompt context builds by result (within budget, turns trimmed, message truncated)",
+    ["result"]
+)
+
+
+def count_tokens(text: str) -> int:
+    """Token count of text (tiktoken when installed, else ~4 chars per token)."""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text down to at most max_tokens tokens."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens]).rstrip() + "…"
+    return text[:max_tokens * CHARS_PER_TOKEN].rstrip() + "…"
+
+
+@dataclass
+class ConversationContext:
+    """Prompt messages plus what was left out of them."""
+    messages: List[Dict[str, str]]
+    prompt_tokens: int
+    # History messages that were dropped and are not covered by the summary
+    unsummarized: List[Dict[str, Any]] = field(default_factory=list)
+    trimmed: bool = False
+    truncated: bool = False
+
+
+class ContextBuilder:
+    """Builds LLM messages within a token budget."""
+
+    def __init__(self, budget: int = 1500, max_recent_turns: int = 4, max_message_tokens: int = 400):
+        """
+        Args:
+            budget: Maximum prompt tokens (system prompt included)
+            max_recent_turns: Most history messages sent verbatim
+            max_message_tokens: Longer single messages are truncated
+        """
+        self.budget = budget
+        self.max_recent_turns = max_recent_turns
+        self.max_message_tokens = max_message_tokens
+
+    def build(
+        self,
+        system_prompt: str,
+        message_text: str,
+        message_history: Optional[List[Dict]] = None,
+        summary: Optional[Dict] = None,
+        batch_sids: Optional[Sequence[str]] = None
+    ) -> ConversationContext:
+        """
+        Assemble the prompt for one agent call.
+
+        Args:
+            system_prompt: Agent instructions
+            message_text: Current customer message
+            message_history: Recent messages, oldest first (may already
+                include the current message)
+            summary: Rolling summary ({"text", "through"}) from conversations.metadata
+            batch_sids: Twilio SIDs of the messages answered together (a
+                coalesced burst, current message last); their history
+                entries are always kept, on top of max_recent_turns older
+                ones. Without them the current message is matched on its text
+
+        Returns:
+            ConversationContext with the messages and token accounting
+        """
+        history = list(message_history or [])
+        # Messages up to summary["through"] are already in the summary
+        if summary and summary.get("through"):
+            history = [m for m in history if (m.get("created_at") or "") > summary["through"]]
+
+        # The current message is stored before the agent runs, so it is
+        # usually already in the history, preceded by the rest of its burst
+        pending: List[Dict[str, Any]] = []
+        current: Optional[Dict[str, Any]] = None
+        if batch_sids:
+            sids = set(batch_sids)
+            pending = [m for m in history if m.get("whatsapp_message_id") in sids]
+            history = [m for m in history if m.get("whatsapp_message_id") not in sids]
+            if pending and pending[-1].get("whatsapp_message_id") == batch_sids[-1]:
+                # Media-only messages are stored without text; use message_text
+                current = {**pending.pop(), "message_text": message_text}
+        elif history and history[-1].get("message_text") == message_text:
+            current = history.pop()
+        if current is None:
+            current = {"sender_type": "customer", "message_text": message_text}
+
+        truncated = False
+        system_messages = [{"role": "system", "content": system_prompt}]
+        if summary and summary.get("text"):
+            system_messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{summary['text']}"
+            })
+
+        # The whole batch is being answered, so none of it is trimmed
+        batch = [self._to_message(m) for m in pending + [current]]
+        if any(m["content"] != raw.get("message_text", "") for m, raw in zip(batch, pending + [current])):
+            truncated = True
+
+        used = sum(self._cost(m) for m in system_messages) + sum(self._cost(m) for m in batch)
+
+        # Newest turns first, until the budget or the turn limit is reached
+        kept: List[Dict[str, str]] = []
+        index = len(history)
+        while index > 0 and len(kept) < self.max_recent_turns:
+            message = self._to_message(history[index - 1])
+            cost = self._cost(message)
+            if used + cost > self.budget:
+                break
+            if message["content"] != history[index - 1].get("message_text", ""):
+                truncated = True
+            kept.append(message)
+            used += cost
+            index -= 1
+
+        trimmed = index > 0
+        context = ConversationContext(
+            messages=system_messages + kept[::-1] + batch,
+            prompt_tokens=used,
+            unsummarized=history[:index],
+            trimmed=trimmed,
+            truncated=truncated
+        )
+
+        if trimmed:
+            context_budget.inc(result="trimmed")
+        if truncated:
+            context_budget.inc(result="truncated")
+        if not trimmed and not truncated:
+            context_budget.inc(result="within")
+        return context
+
+    def _to_message(self, msg: Dict) -> Dict[str, str]:
+        role = "assistant" if msg.get("sender_type") == "agent" else "user"
+        return {"role": role, "content": truncate_to_tokens(msg.get("message_text") or "", self.max_message_tokens)}
+
+    @staticmethod
+    def _cost(message: Dict[str, str]) -> int:
+        return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+# Global context builder
+context_builder = ContextBuilder(
+    budget=settings.context_token_budget,
+    max_recent_turns=settings.context_max_recent_turns,
+    max_message_tokens=settings.context_max_message_tokens
+)
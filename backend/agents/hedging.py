@@ -0,0 +1,270 @@
+"""
+Hedged LLM completions over a chain of models.
+Each request goes to the model with the best recent record. If it has not
+answered within that model's recent p95 latency, a second model is asked
+as well and the first good answer wins; the other request is cancelled.
+Errors fail over to the next model, and the whole call is bounded by a
+deadline. Hedges are capped to a fraction of requests so the extra calls
+stay a small share of LLM spend.
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from services.metrics import dependencies, metrics
+
+logger = logging.getLogger(__name__)
+
+# Samples needed before a model's own p95 drives its hedge delay
+MIN_SAMPLES = 20
+
+llm_request_seconds = metrics.histogram(
+    "whatsapp_llm_request_seconds",
+    "Latency of individual LLM requests by model and outcome",
+    ["model", "outcome"]
+)
+llm_attempts = metrics.counter(
+    "whatsapp_llm_attempts_total",
+    "LLM requests started, by model and reason (primary, hedge, failover)",
+    ["model", "reason"]
+)
+llm_wins = metrics.counter(
+    "whatsapp_llm_wins_total",
+    "Completions returned to the caller, by model and whether it was a hedge",
+    ["model", "hedged"]
+)
+
+
+class LLMDeadlineExceeded(Exception):
+    """No model produced an answer before the deadline."""
+
+
+class ModelStats:
+    """Rolling latency and error window for one model."""
+
+    def __init__(self, window: int = 200):
+        # (seconds, ok) of finished requests, newest last
+        self._events: Deque[Tuple[float, bool]] = deque(maxlen=window)
+
+    def record(self, seconds: float, ok: bool):
+        self._events.append((seconds, ok))
+
+    @property
+    def samples(self) -> int:
+        return len(self._events)
+
+    @property
+    def error_rate(self) -> float:
+        if not self._events:
+            return 0.0
+        return sum(1 for _, ok in self._events if not ok) / len(self._events)
+
+    def latency(self, q: float) -> Optional[float]:
+        """Latency quantile of successful requests, or None without data."""
+        latencies = sorted(seconds for seconds, ok in self._events if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50, p95 = self.latency(0.50), self.latency(0.95)
+        return {
+            "requests": self.samples,
+            "error_rate": round(self.error_rate, 4),
+            "latency_ms_p50": round(p50 * 1000, 1) if p50 is not None else None,
+            "latency_ms_p95": round(p95 * 1000, 1) if p95 is not None else None,
+        }
+
+
+class HedgedModelChain:
+    """Runs chat completions against an ordered, self-ranking list of models."""
+
+    def __init__(
+        self,
+        client,
+        models: List[str],
+        deadline: float = 20.0,
+        hedge_quantile: float = 0.95,
+        hedge_delay: float = 3.0,
+        hedge_min_delay: float = 0.5,
+        hedge_budget: float = 0.1
+    ):
+        """
+        Args:
+            client: AsyncOpenAI-compatible client
+            models: Models in preference order
+            deadline: Seconds before the whole call gives up
+            hedge_quantile: Latency quantile of the leading model after which to hedge
+            hedge_delay: Hedge delay used until a model has enough samples
+            hedge_min_delay: Lower bound on the hedge delay
+            hedge_budget: Maximum fraction of recent requests that may be hedged
+        """
+        if not models:
+            raise ValueError("At least one LLM model is required")
+        self.client = client
+        self.models = list(models)
+        self.deadline = deadline
+        self.hedge_quantile = hedge_quantile
+        self.hedge_delay = hedge_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_budget = hedge_budget
+        self.stats: Dict[str, ModelStats] = {model: ModelStats() for model in self.models}
+        # Whether each recent request was hedged, for the hedge budget
+        self._hedged: Deque[bool] = deque(maxlen=200)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_misses = 0
+
+    def ranked(self) -> List[str]:
+        """
+        Models in the order they should be tried: mostly-failing models
+        last, then by expected latency (p50 inflated by the error rate).
+        Models without enough samples rank after measured ones, in their
+        configured order.
+        """
+        def key(item: Tuple[int, str]):
+            position, model = item
+            stats = self.stats[model]
+            p50 = stats.latency(0.50)
+            unhealthy = stats.samples >= MIN_SAMPLES and (stats.error_rate > 0.5 or p50 is None)
+            if stats.samples < MIN_SAMPLES or p50 is None:
+                expected = float("inf")
+            else:
+                expected = p50 / max(1e-3, 1.0 - stats.error_rate)
+            return (unhealthy, expected, position)
+
+        return [model for _, model in sorted(enumerate(self.models), key=key)]
+
+    def delay_for(self, model: str) -> float:
+        """How long to wait on a model before hedging."""
+        stats = self.stats[model]
+        latency = stats.latency(self.hedge_quantile) if stats.samples >= MIN_SAMPLES else None
+        delay = latency if latency is not None else self.hedge_delay
+        return max(self.hedge_min_delay, delay)
+
+    def _hedge_allowed(self) -> bool:
+        if not self._hedged:
+            return True
+        return sum(self._hedged) / len(self._hedged) < self.hedge_budget
+
+    async def complete(self, messages: List[Dict[str, str]], deadline: Optional[float] = None, **params) -> Tuple[Any, str]:
+        """
+        Get one chat completion, hedging and failing over across models.
+
+        Args:
+            messages: Chat messages
+            deadline: Override of the default deadline in seconds
+            **params: Extra create() arguments (max_tokens, temperature, ...)
+
+        Returns:
+            Tuple of (completion response, model that produced it)
+
+        Raises:
+            LLMDeadlineExceeded: If no model answered in time
+            Exception: The last model error, if every model failed
+        """
+        order = self.ranked()
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + (deadline or self.deadline)
+        hedge_at = deadline_at
+        self.requests += 1
+
+        # task -> (model, is_hedge, started_at)
+        attempts: Dict[asyncio.Task, Tuple[str, bool, float]] = {}
+        next_index = 0
+        hedged = False
+        timed_out = False
+        last_error: Optional[BaseException] = None
+
+        def launch(reason: str):
+            nonlocal next_index, hedge_at
+            model = order[next_index]
+            next_index += 1
+            llm_attempts.inc(model=model, reason=reason)
+            task = asyncio.create_task(self._attempt(model, messages, params))
+            attempts[task] = (model, reason == "hedge", time.perf_counter())
+            # Hedge on the newest attempt's own latency profile
+            hedge_at = loop.time() + self.delay_for(model)
+
+        launch("primary")
+        try:
+            while attempts:
+                now = loop.time()
+                if now >= deadline_at:
+                    self.deadline_misses += 1
+                    timed_out = True
+                    raise LLMDeadlineExceeded(f"No LLM answer within {deadline or self.deadline:.1f}s")
+
+                can_hedge = not hedged and next_index < len(order)
+                wake_at = min(deadline_at, hedge_at) if can_hedge else deadline_at
+                done, _ = await asyncio.wait(
+                    attempts, timeout=max(0.0, wake_at - now), return_when=asyncio.FIRST_COMPLETED
+                )
+
+                for task in done:
+                    model, is_hedge, _ = attempts.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        llm_wins.inc(model=model, hedged=str(is_hedge).lower())
+                        if is_hedge:
+                            self.hedge_wins += 1
+                        return task.result(), model
+                    last_error = error
+                    logger.warning("LLM model %s failed: %s: %s", model, type(error).__name__, error)
+
+                # Fail over as soon as nothing is left in flight
+                if not attempts and next_index < len(order):
+                    launch("failover")
+                elif can_hedge and loop.time() >= hedge_at and self._hedge_allowed():
+                    hedged = True
+                    self.hedges += 1
+                    launch("hedge")
+                elif can_hedge and loop.time() >= hedge_at:
+                    # Over the hedge budget: keep waiting on what is in flight
+                    hedged = True
+
+            raise last_error
+        finally:
+            self._hedged.append(hedged)
+            for task, (model, _, started_at) in attempts.items():
+                if not task.done():
+                    task.cancel()
+                    if timed_out:
+                        # Still running at the deadline: a failure of that model
+                        self._finish(model, started_at, ok=False, outcome="timeout")
+                    else:
+                        # Lost the race; not the model's fault
+                        llm_request_seconds.observe(time.perf_counter() - started_at, model=model, outcome="cancelled")
+                elif not task.cancelled():
+                    task.exception()  # mark as retrieved
+
+    async def _attempt(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]):
+        # Cancellation is accounted for by complete(), which knows why
+        started_at = time.perf_counter()
+        try:
+            response = await self.client.chat.completions.create(model=model, messages=messages, **params)
+            if not response.choices or not response.choices[0].message.content:
+                raise ValueError("Empty completion")
+        except Exception:
+            self._finish(model, started_at, ok=False)
+            raise
+        self._finish(model, started_at, ok=True)
+        return response
+
+    def _finish(self, model: str, started_at: float, ok: bool, outcome: Optional[str] = None):
+        seconds = time.perf_counter() - started_at
+        self.stats[model].record(seconds, ok)
+        dependencies.record('openrouter', seconds, ok)
+        llm_request_seconds.observe(seconds, model=model, outcome=outcome or ("ok" if ok else "error"))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "order": self.ranked(),
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "deadline_misses": self.deadline_misses,
+            "models": {model: stats.snapshot() for model, stats in self.stats.items()},
+        }
@@ -0,0 +1,48 @@
+"""
+Order extraction from agent replies.
+The agent appends a confirmed order as JSON inside an <ORDER_DETAILS> tag
+(see SYSTEM_PROMPT). A single regex pass finds the tag; the reply sent to
+the customer is the text around it.
+"""
+import re
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ORDER_DETAILS = re.compile(r'<ORDER_DETAILS>(.*?)</ORDER_DETAILS>', re.DOTALL)
+
+
+def extract_order(response_text: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Split an agent reply into customer-facing text and order details.
+
+    Args:
+        response_text: Raw agent reply
+
+    Returns:
+        Tuple of (reply without the tag, order dict with items and total,
+        or None if there is no valid order)
+    """
+    match = ORDER_DETAILS.search(response_text)
+    if match is None:
+        return response_text, None
+
+    # The tag is never shown to the customer, even if its JSON is broken
+    text = (response_text[:match.start()] + response_text[match.end():]).strip()
+    order_json_str = match.group(1).strip()
+    logger.info("Found order details (%d chars)", len(order_json_str))
+    try:
+        details = json.loads(order_json_str)
+    except json.JSONDecodeError as e:
+        logger.error("Error parsing order details: %s", e)
+        return text, None
+    if not isinstance(details, dict):
+        logger.error("Order details are not an object: %s", type(details).__name__)
+        return text, None
+
+    return text, {
+        'items': details.get('items') or [],
+        'total': details.get('total') or 0,
+    }
@@ -0,0 +1,132 @@
+"""
+Answer cache for repeated customer questions.
+Short, common messages ("hi", "what do you sell?") get the same reply for
+the same prompt context, so we reuse the LLM answer instead of calling
+OpenRouter again. The key covers everything the model would see (system
+prompt, conversation summary, earlier turns), so a reply that draws on one
+customer's history or summary is never served to anyone else.
+"""
+import re
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional
+from config import settings
+from services.cache import cache
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ORDER_TAG = "<ORDER_DETAILS>"
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """Lowercase, drop punctuation/emoji and collapse whitespace."""
+    return _SPACES.sub(" ", _NON_WORD.sub(" ", (text or "").lower())).strip()
+
+
+def context_fingerprint(prompt_messages: List[Dict[str, str]]) -> str:
+    """
+    Short hash of the prompt messages that precede the current one
+    (system prompt, summary, earlier turns). The same question in a
+    different context gets a different key.
+    """
+    digest = hashlib.sha1()
+    for msg in prompt_messages:
+        digest.update(f"{msg['role']}:{normalize(msg['content'])}\n".encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+class ResponseCache:
+    """Caches agent replies keyed on normalised text plus a context fingerprint."""
+
+    def __init__(self, ttl: int = 3600, max_message_chars: int = 80, enabled: bool = True):
+        """
+        Args:
+            ttl: Seconds a cached answer stays valid
+            max_message_chars: Longer (normalised) messages are never cached
+            enabled: Master switch
+        """
+        self.ttl = ttl
+        self.max_message_chars = max_message_chars
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.llm_seconds_saved = 0.0
+
+    def key_for(self, message_text: str, prompt_messages: List[Dict[str, str]]) -> Optional[str]:
+        """
+        Cache key for a message, or None if it should not be cached.
+
+        Args:
+            message_text: Current customer message
+            prompt_messages: LLM messages sent before it (ConversationContext.messages
+                without the last one)
+        """
+        text = normalize(message_text)
+        if not self.enabled or not text or len(text) > self.max_message_chars:
+            return None
+        digest = hashlib.sha1(
+            f"{text}|{context_fingerprint(prompt_messages)}".encode("utf-8")
+        ).hexdigest()[:24]
+        return f"response:{digest}"
+
+    async def get(self, key: Optional[str]) -> Optional[str]:
+        """Cached reply for key, counting hits and the LLM time they save."""
+        if key is None:
+            self.bypassed += 1
+            return None
+
+        entry = await cache.get(key)
+        if not entry or ORDER_TAG in entry["text"]:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.llm_seconds_saved += entry.get("llm_seconds", 0.0)
+        return entry["text"]
+
+    async def set(self, key: Optional[str], text: str, llm_seconds: float):
+        """Store a reply unless it carries order details."""
+        if key is None or not text or ORDER_TAG in text:
+            return
+        await cache.set(key, {"text": text, "llm_seconds": llm_seconds}, ttl=self.ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "llm_seconds_saved": round(self.llm_seconds_saved, 3),
+        }
+
+
+# Global response cache instance
+response_cache = ResponseCache(
+    ttl=settings.response_cache_ttl,
+    max_message_chars=settings.response_cache_max_chars,
+    enabled=settings.response_cache_enabled
+)
+
+metrics.gauge(
+    "whatsapp_response_cache_total",
+    "Agent response cache lookups by result",
+    lambda: {
+        ("hit",): response_cache.hits,
+        ("miss",): response_cache.misses,
+        ("bypass",): response_cache.bypassed
+    },
+    ["result"],
+    kind="counter"
+)
+metrics.gauge(
+    "whatsapp_llm_seconds_saved_total",
+    "LLM time avoided by serving cached responses",
+    lambda: {(): response_cache.llm_seconds_saved},
+    kind="counter"
+)
@@ -3,16 +3,33 @@ AI Router Agent using OpenRouter API.
 """
 from openai import AsyncOpenAI
 from config import settings
+from services.metrics import llm_tokens
+from agents.response_cache import response_cache
+from agents.context import ConversationContext, context_builder, prompt_tokens
+from agents.hedging import HedgedModelChain
+from typing import Optional
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 # Initialize OpenRouter client (OpenAI-compatible)
 client = AsyncOpenAI(
-    base_url="https://openrouter.ai/api/v1",
+    base_url=settings.openrouter_base_url,
     api_key=settings.openrouter_api_key,
 )
 
+# Model chain with deadline, p95-based hedging and failover
+model_chain = HedgedModelChain(
+    client,
+    models=settings.llm_model_list,
+    deadline=settings.llm_deadline,
+    hedge_quantile=settings.llm_hedge_quantile,
+    hedge_delay=settings.llm_hedge_delay,
+    hedge_min_delay=settings.llm_hedge_min_delay,
+    hedge_budget=settings.llm_hedge_budget
+)
+
 SYSTEM_PROMPT = """You are a friendly and helpful AI sales assistant for a boutique e-commerce store.
 Your name is "SalesBot".
 
@@ -53,48 +70,62 @@ If a user asks for products, ask them what specifically they are looking for (e.
 If you don't understand, ask for clarification politely.
 """
 
-async def process_message(message_text: str, message_history: list = None) -> str:
+async def process_message(
+    message_text: str,
+    message_history: list = None,
+    use_cache: bool = True,
+    context: Optional[ConversationContext] = None
+) -> str:
     """
     Process a user message using OpenRouter AI.
     
     Args:
         message_text: The user's input message.
         message_history: List of previous messages for context.
+        use_cache: Allow answering from the response cache (disable when
+            the conversation has order state).
+        context: Prompt already fitted to the token budget (with the
+            conversation summary); built from message_history if omitted.
         
     Returns:
         The agent's text response.
     """
     try:
-        logger.info(f"Router Agent processing: {message_text}")
-        
-        # Build messages list with system prompt
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        logger.info("Router Agent processing a %d-char message", len(message_text))
         
-        # Add history if available
-        if message_history:
-            for msg in message_history:
-                role = "assistant" if msg.get("sender_type") == "agent" else "user"
-                messages.append({"role": role, "content": msg.get("message_text", "")})
+        # System prompt, summary and the recent turns that fit the budget
+        if context is None:
+            context = context_builder.build(SYSTEM_PROMPT, message_text, message_history)
+        messages = context.messages
         
-        # Add current user message only if it's not already the last message in history
-        # (Since we store the message before calling the agent, it might be in history)
-        last_msg_text = message_history[-1].get("message_text") if message_history else ""
-        if last_msg_text != message_text:
-            messages.append({"role": "user", "content": message_text})
+        # Keyed on the whole prompt, so only identical contexts share a reply
+        cache_key = response_cache.key_for(message_text, messages[:-1]) if use_cache else None
+        cached_response = await response_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info("Response cache hit")
+            return cached_response
+        prompt_tokens.observe(context.prompt_tokens)
         
-        # Call OpenRouter API (OpenAI-compatible)
-        response = await client.chat.completions.create(
-            model="openai/gpt-3.5-turbo",  # Reliable low-cost model
-            messages=messages,
+        # Call OpenRouter API (OpenAI-compatible), hedged across the model chain
+        started_at = time.perf_counter()
+        response, model = await model_chain.complete(
+            messages,
             max_tokens=300,
             temperature=0.7,
         )
+        llm_seconds = time.perf_counter() - started_at
+        
+        if response.usage:
+            llm_tokens.inc(response.usage.prompt_tokens, type="prompt")
+            llm_tokens.inc(response.usage.completion_tokens, type="completion")
         
         ai_response = response.choices[0].message.content
-        logger.info(f"Generated response: {ai_response[:100]}...")
+        logger.info("Generated response with %s (%d chars)", model, len(ai_response))
+        
+        await response_cache.set(cache_key, ai_response, llm_seconds=llm_seconds)
         
         return ai_response
         
     except Exception as e:
-        logger.error(f"Error in Router Agent: {str(e)}", exc_info=True)
+        logger.error("Error in Router Agent: %s", e, exc_info=True)
         return "I'm having a little trouble right now. Could you try again? 😊"
@@ -0,0 +1,143 @@
+"""
+Rolling conversation summaries.
+Older turns that no longer fit the prompt budget are folded into a short
+summary by a background task, so the hot path only ever reads it. The
+summary lives in conversations.metadata["summary"] and in the cache.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+from config import settings
+from services.cache import cache
+from services.metrics import dependencies, llm_tokens, metrics
+from services.supabase import supabase_client
+from agents.router import client
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """You maintain a running summary of a WhatsApp conversation between a customer and a store's sales assistant.
+Update the summary with the new messages. Keep the customer's name and preferences, products and quantities discussed, prices quoted, order status and any open questions.
+Write plain sentences, at most 120 words. Output only the summary."""
+
+
+class ConversationSummarizer:
+    """Folds overflowing turns into conversations.metadata["summary"] off the hot path."""
+
+    def __init__(self, model: str, min_messages: int = 4, max_tokens: int = 200, enabled: bool = True):
+        """
+        Args:
+            model: OpenRouter model used for summaries
+            min_messages: Unsummarised messages needed before a run is scheduled
+            max_tokens: Completion limit for the summary
+            enabled: Master switch
+        """
+        self.model = model
+        self.min_messages = min_messages
+        self.max_tokens = max_tokens
+        self.enabled = enabled
+        self._in_flight: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.completed = 0
+        self.failed = 0
+
+    async def get(self, conversation: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Current summary for a conversation (cache first, then the row's metadata)."""
+        summary = await cache.get_cached_conversation_summary(conversation['id'])
+        if summary is None:
+            summary = (conversation.get('metadata') or {}).get('summary')
+        return summary
+
+    def schedule(self, conversation_id: str, summary: Optional[Dict], messages: List[Dict]) -> bool:
+        """
+        Start a background summary run if enough turns have overflowed.
+
+        Args:
+            conversation_id: Conversation UUID
+            summary: Summary the messages should be folded into
+            messages: Unsummarised messages, oldest first
+
+        Returns:
+            True if a run was started
+        """
+        # The summary's cursor is created_at, so only stored rows can be folded in
+        messages = [m for m in messages if m.get('created_at')]
+        if not self.enabled or len(messages) < self.min_messages or conversation_id in self._in_flight:
+            return False
+        self._in_flight.add(conversation_id)
+        task = asyncio.create_task(self._summarize(conversation_id, summary, messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _summarize(self, conversation_id: str, summary: Optional[Dict], messages: List[Dict]):
+        try:
+            transcript = "\n".join(
+                f"{'Assistant' if m.get('sender_type') == 'agent' else 'Customer'}: {m.get('message_text', '')}"
+                for m in messages
+            )
+            previous = summary.get('text') if summary else None
+            with dependencies.track('openrouter'):
+                response = await client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": SUMMARY_PROMPT},
+                        {"role": "user", "content": f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}"},
+                    ],
+                    max_tokens=self.max_tokens,
+                    temperature=0.2,
+                )
+            if response.usage:
+                llm_tokens.inc(response.usage.prompt_tokens, type="summary_prompt")
+                llm_tokens.inc(response.usage.completion_tokens, type="summary_completion")
+
+            new_summary = {
+                "text": (response.choices[0].message.content or "").strip(),
+                "through": messages[-1].get('created_at'),
+                "messages": (summary or {}).get('messages', 0) + len(messages),
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }
+            await supabase_client.update_conversation_summary(conversation_id, new_summary)
+            await cache.set_cached_conversation_summary(conversation_id, new_summary)
+            self.completed += 1
+            logger.info("Summarised %d messages for conversation %s", len(messages), conversation_id)
+
+        except Exception as e:
+            self.failed += 1
+            logger.error("Conversation summary failed for %s: %s", conversation_id, e)
+        finally:
+            self._in_flight.discard(conversation_id)
+
+    async def stop(self, timeout: float = 10.0):
+        """Let in-flight summary runs finish, cancelling them after timeout."""
+        if not self._tasks:
+            return
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._in_flight),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+# Global summarizer instance
+conversation_summarizer = ConversationSummarizer(
+    model=settings.summary_model,
+    min_messages=settings.summary_min_messages,
+    max_tokens=settings.summary_max_tokens,
+    enabled=settings.summary_enabled
+)
+
+metrics.gauge(
+    "whatsapp_conversation_summaries_total",
+    "Background conversation summary runs by result",
+    lambda: {("ok",): conversation_summarizer.completed, ("error",): conversation_summarizer.failed},
+    ["result"],
+    kind="counter"
+)
@@ -0,0 +1,133 @@
+"""
+Benchmark: in-memory catalog index vs the PostgREST ilike search.
+
+Generates a synthetic catalog, loads it into the fake PostgREST from
+benchmarks/fakes.py, then runs the same queries through
+  - SupabaseClient.search_products via PostgREST (the ilike path), and
+  - ProductCatalog.search (the in-memory index, loaded via refresh()).
+
+The fake evaluates ilike with a Python scan rather than Postgres' trigram
+GIN index, so the "before" column shows the HTTP + JSON round-trip cost
+plus a full scan; against a real Supabase the network hop dominates.
+
+Usage (from backend/):
+    python benchmarks/bench_catalog.py --products 50000 --queries 200
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+sys.path.append('.')
+
+from benchmarks.fakes import FakeOpenAI, FakePostgrest, FakeServices, FakeTwilio, LatencyModel
+
+logging.basicConfig(level=logging.WARNING)
+
+COLORS = ["red", "blue", "black", "white", "green", "grey", "navy", "pink", "brown", "beige"]
+MATERIALS = ["leather", "cotton", "denim", "wool", "canvas", "steel", "silk", "linen", "suede", "nylon"]
+NOUNS = {
+    "Footwear": ["sneakers", "boots", "sandals", "loafers", "heels", "slippers"],
+    "Clothing": ["t-shirt", "jeans", "hoodie", "jacket", "dress", "skirt", "shorts", "sweater"],
+    "Electronics": ["headphones", "smartphone", "laptop", "smartwatch", "speaker", "charger", "tablet"],
+    "Accessories": ["backpack", "wallet", "sunglasses", "belt", "scarf", "handbag", "watch"],
+}
+ADJECTIVES = ["classic", "premium", "lightweight", "wireless", "waterproof", "slim", "vintage", "sport", "casual"]
+TAGS = ["sale", "new", "bestseller", "eco", "summer", "winter", "gift", "limited", "unisex", "kids"]
+
+QUERIES = [
+    "red sneakers", "wireless headphones", "leather backpack", "blue jeans", "laptop",
+    "waterproof boots", "sunglasses", "cotton t-shirt", "smart watch", "black hoodie",
+    "snekers", "headphnes", "bakpack", "lether wallet", "summer dress",
+]
+
+
+def synthetic_products(count: int):
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(count):
+        category = random.choice(list(NOUNS))
+        noun = random.choice(NOUNS[category])
+        color, material, adjective = random.choice(COLORS), random.choice(MATERIALS), random.choice(ADJECTIVES)
+        yield {
+            "id": str(uuid.uuid4()),
+            "sku": f"SKU-{i:06d}",
+            "name": f"{adjective.title()} {color.title()} {material.title()} {noun.title()}",
+            "description": f"A {adjective} {noun} made from {material}, perfect for everyday use.",
+            "category": category,
+            "subcategory": noun,
+            "price": round(random.uniform(5, 500), 2),
+            "currency": "USD",
+            "stock_quantity": random.randint(0, 200),
+            "tags": random.sample(TAGS, 2),
+            "is_active": random.random() > 0.05,
+            "updated_at": (base + timedelta(seconds=i)).isoformat(),
+        }
+
+
+def summarize(label: str, samples):
+    samples = sorted(samples)
+    mean = sum(samples) / len(samples)
+    p50 = samples[len(samples) // 2]
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"  {label:<26} mean {mean * 1e6:10.1f} us   p50 {p50 * 1e6:10.1f} us   p99 {p99 * 1e6:10.1f} us")
+    return mean
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--db-latency", default="const:0", help="Extra PostgREST latency spec")
+    args = parser.parse_args()
+    random.seed(1)
+
+    postgrest = FakePostgrest(LatencyModel(args.db_latency))
+    postgrest.tables["products"] = list(synthetic_products(args.products))
+    fakes = FakeServices(postgrest, FakeOpenAI(), FakeTwilio())
+    fakes.start()
+    os.environ.update(fakes.env())
+
+    from services.catalog import ProductCatalog
+    from services.supabase import supabase_client
+
+    queries = [random.choice(QUERIES) for _ in range(args.queries)]
+    print(f"{args.products} products, {args.queries} queries")
+
+    try:
+        catalog = ProductCatalog()
+        started = time.perf_counter()
+        await catalog.refresh(supabase_client, page_size=5000)
+        print(f"  index load (via PostgREST)  {time.perf_counter() - started:.2f}s, "
+              f"{catalog.size} active products, {catalog.stats()['tokens']} tokens")
+
+        before = []
+        for query in queries:
+            started = time.perf_counter()
+            await supabase_client.search_products(query, limit=10)
+            before.append(time.perf_counter() - started)
+
+        after = []
+        for query in queries:
+            started = time.perf_counter()
+            catalog.search(query, limit=10)
+            after.append(time.perf_counter() - started)
+    finally:
+        fakes.stop()
+
+    mean_before = summarize("PostgREST ilike", before)
+    mean_after = summarize("catalog index", after)
+    print(f"  speedup                    {mean_before / mean_after:.0f}x")
+
+    print("\nSample results (catalog index):")
+    for query in ["red sneakers", "snekers", "headphnes"]:
+        names = [p["name"] for p in catalog.search(query, limit=3)]
+        print(f"  {query!r:<18} -> {names}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
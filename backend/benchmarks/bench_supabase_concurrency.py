@@ -0,0 +1,144 @@
+"""
+Benchmark: Supabase data layer throughput at N concurrent conversations.
+
+Compares the old behaviour (synchronous execute() on the event loop) with
+the executor offload in SupabaseClient._execute. PostgREST is replaced by
+an in-process fake whose execute() blocks for a fixed round-trip time, so
+the numbers reflect event-loop blocking rather than network noise.
+
+Usage (from backend/):
+    python benchmarks/bench_supabase_concurrency.py --conversations 50 --latency-ms 20
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+import uuid
+sys.path.append('.')
+
+from services.cache import cache
+from services.supabase import SupabaseClient
+
+logging.basicConfig(level=logging.WARNING)
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """Chainable stand-in for a postgrest request builder."""
+
+    def __init__(self, table: str, latency: float):
+        self.table = table
+        self.latency = latency
+        self.payload = None
+
+    def insert(self, payload):
+        self.payload = payload
+        return self
+
+    def __getattr__(self, name):
+        # select/eq/order/limit/or_ ... all just return the builder
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        time.sleep(self.latency)
+        if self.payload is not None:
+            return FakeResponse([{**self.payload, 'id': str(uuid.uuid4())}])
+        return FakeResponse([])
+
+
+class FakeRpc:
+    """Stand-in for a postgrest RPC call (the two the message path uses)."""
+
+    def __init__(self, name: str, params: dict, latency: float):
+        self.name = name
+        self.params = params
+        self.latency = latency
+
+    def execute(self):
+        time.sleep(self.latency)
+        if self.name == 'store_messages_batch':
+            return FakeResponse({'inserted': len(self.params['p_messages'])})
+        if self.name == 'resolve_customer_conversation':
+            number = self.params['p_whatsapp_number']
+            customer = {'id': str(uuid.uuid4()), 'whatsapp_number': number}
+            conversation = {
+                'id': str(uuid.uuid4()), 'customer_id': customer['id'],
+                'whatsapp_number': number, 'status': 'active',
+            }
+            return FakeResponse({
+                'customer': customer, 'conversation': conversation,
+                'customer_created': True, 'conversation_created': True,
+            })
+        raise NotImplementedError(self.name)
+
+
+class FakeSupabase:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def table(self, name: str):
+        return FakeQuery(name, self.latency)
+
+    def rpc(self, name: str, params: dict):
+        return FakeRpc(name, params, self.latency)
+
+
+class BlockingSupabaseClient(SupabaseClient):
+    """The pre-offload behaviour: execute() runs on the event loop thread."""
+
+    async def _execute(self, query):
+        return query.execute()
+
+
+def build(cls, latency: float) -> SupabaseClient:
+    client = cls.__new__(cls)
+    SupabaseClient.__init__(client)
+    client.client = FakeSupabase(latency)
+    return client
+
+
+async def conversation_turn(db: SupabaseClient, number: str):
+    """The DB calls made by main.process_message for one inbound message."""
+    _, conversation = await db.resolve_customer_conversation(number)
+    await db.store_message(conversation['id'], 'inbound', 'hello', sender_type='customer')
+    await db.get_recent_messages(conversation['id'], limit=10)
+    await db.store_message(conversation['id'], 'outbound', 'hi!', sender_type='agent')
+
+
+async def run(db: SupabaseClient, conversations: int, turns: int) -> float:
+    cache.clear()
+    numbers = [f"+2547{i:08d}" for i in range(conversations)]
+
+    async def customer(number):
+        for _ in range(turns):
+            await conversation_turn(db, number)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(customer(n) for n in numbers))
+    return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--turns', type=int, default=3)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    total = args.conversations * args.turns
+
+    print(f"{args.conversations} concurrent conversations x {args.turns} turns, "
+          f"{args.latency_ms:.0f} ms per PostgREST round trip")
+    for label, cls in (("before (blocking)", BlockingSupabaseClient), ("after (offloaded)", SupabaseClient)):
+        elapsed = await run(build(cls, latency), args.conversations, args.turns)
+        print(f"  {label:<18} {elapsed:7.2f}s  {total / elapsed:8.1f} messages/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,611 @@
+"""
+Local stand-ins for the external services used by main:app.
+
+- FakePostgrest: in-memory, PostgREST-compatible enough for SupabaseClient
+  (customers, conversations, messages, orders, products, daily stats + RPCs)
+- FakeOpenAI: OpenAI-compatible /chat/completions with sampled latency
+- FakeTwilio: Twilio Messages API that records every outbound send and
+  serves registered inbound media
+
+All three are plain FastAPI apps; FakeServices runs them on free local
+ports in a background thread with its own event loop.
+"""
+import asyncio
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class LatencyModel:
+    """
+    Latency distribution parsed from a spec string:
+        const:0.5             always 0.5s
+        uniform:0.2:1.0       uniform between 0.2s and 1.0s
+        lognormal:0.8:0.4     lognormal with median 0.8s and sigma 0.4
+    """
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, *params = spec.split(":")
+        values = [float(p) for p in params]
+        if kind == "const":
+            self._sample = lambda: values[0]
+        elif kind == "uniform":
+            self._sample = lambda: random.uniform(values[0], values[1])
+        elif kind == "lognormal":
+            import math
+            mu = math.log(values[0])
+            self._sample = lambda: random.lognormvariate(mu, values[1])
+        else:
+            raise ValueError(f"Unknown latency spec: {spec}")
+
+    def sample(self) -> float:
+        return max(0.0, self._sample())
+
+    async def wait(self):
+        delay = self.sample()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+# =====================================================
+# PostgREST
+# =====================================================
+
+TABLE_DEFAULTS: Dict[str, Callable[[], Dict[str, Any]]] = {
+    "customers": lambda: {
+        "name": None, "email": None, "preferred_language": "en", "total_orders": 0,
+        "total_spent": 0, "metadata": None, "customer_since": now_iso(), "updated_at": now_iso(),
+    },
+    "conversations": lambda: {
+        "status": "active", "started_at": now_iso(), "ended_at": None, "last_message_at": now_iso(),
+        "message_count": 0, "agent_handled": True, "metadata": None, "updated_at": now_iso(),
+    },
+    "messages": lambda: {
+        "content_type": "text", "media_url": None, "media_mime_type": None, "intent": None,
+        "metadata": None, "delivery_status": None, "sent_at": now_iso(), "delivered_at": None,
+        "read_at": None,
+    },
+    "orders": lambda: {
+        "status": "pending", "subtotal": 0, "currency": "USD", "payment_status": "unpaid",
+        "metadata": None, "placed_at": now_iso(), "updated_at": now_iso(),
+    },
+    "order_items": lambda: {"product_id": None},
+    "products": lambda: {"is_active": True, "tags": [], "metadata": None, "updated_at": now_iso()},
+}
+
+DAILY_COUNTERS = (
+    "messages_inbound", "messages_outbound", "orders", "order_value",
+    "new_customers", "conversations_started", "conversations_closed", "revenue",
+)
+
+# Columns with a UNIQUE constraint in database/schema.sql
+UNIQUE_COLUMNS: Dict[str, List[str]] = {
+    "customers": ["whatsapp_number"],
+    "messages": ["whatsapp_message_id"],
+    "orders": ["order_number", "idempotency_key"],
+    "products": ["sku"],
+}
+
+
+def _coerce(value: str) -> Any:
+    if value == "null":
+        return None
+    if value == "true":
+        return True
+    if value == "false":
+        return False
+    return value
+
+
+def _compare(row_value: Any, op: str, arg: str) -> bool:
+    if op == "is":
+        return row_value is _coerce(arg) if arg in ("null", "true", "false") else False
+    if op == "in":
+        options = [o.strip().strip('"') for o in arg.strip("()").split(",")]
+        return str(row_value) in options
+    if op in ("like", "ilike"):
+        if row_value is None:
+            return False
+        pattern = arg.replace("*", "%")
+        text, needle = str(row_value), pattern.strip("%")
+        if op == "ilike":
+            text, needle = text.lower(), needle.lower()
+        return needle in text
+    if row_value is None:
+        return False
+    target = _coerce(arg)
+    if isinstance(row_value, bool) or isinstance(target, bool):
+        left, right = row_value, target
+    elif isinstance(row_value, (int, float)):
+        left, right = float(row_value), float(target)
+    else:
+        left, right = str(row_value), str(target)
+    return {
+        "eq": lambda: left == right,
+        "neq": lambda: left != right,
+        "gt": lambda: left > right,
+        "gte": lambda: left >= right,
+        "lt": lambda: left < right,
+        "lte": lambda: left <= right,
+    }[op]()
+
+
+def _split_top_level(expr: str) -> List[str]:
+    """Split 'a.eq.1,and(b.gt.2,c.lt.3)' on commas outside parentheses."""
+    parts, depth, current = [], 0, ""
+    for ch in expr:
+        if ch == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            continue
+        depth += ch == "("
+        depth -= ch == ")"
+        current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _match_expr(row: Dict[str, Any], expr: str) -> bool:
+    """Evaluate one PostgREST logical-tree term such as 'and(a.eq.1,b.gt.2)'."""
+    for logic in ("and", "or"):
+        if expr.startswith(f"{logic}(") and expr.endswith(")"):
+            terms = [_match_expr(row, t) for t in _split_top_level(expr[len(logic) + 1:-1])]
+            return all(terms) if logic == "and" else any(terms)
+    column, op, arg = expr.split(".", 2)
+    negate = op == "not"
+    if negate:
+        op, arg = arg.split(".", 1)
+    if len(arg) > 1 and arg.startswith('"') and arg.endswith('"'):
+        arg = arg[1:-1]
+    result = _compare(row.get(column), op, arg)
+    return not result if negate else result
+
+
+class FakePostgrest:
+    """In-memory tables served over a PostgREST-shaped HTTP API."""
+
+    def __init__(self, latency: Optional[LatencyModel] = None):
+        self.latency = latency or LatencyModel("const:0")
+        self.tables: Dict[str, List[Dict[str, Any]]] = {name: [] for name in TABLE_DEFAULTS}
+        self.requests = 0
+        self.rpcs: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+            "resolve_customer_conversation": self._rpc_resolve_customer_conversation,
+            "store_messages_batch": self._rpc_store_messages_batch,
+            "place_order": self._rpc_place_order,
+            "add_daily_stats": self._rpc_add_daily_stats,
+            "daily_stats_summary": self._rpc_daily_stats_summary,
+            "close_idle_conversations": self._rpc_close_idle_conversations,
+        }
+        # day (ISO) -> counter -> value, like the daily_stats table
+        self.daily_stats: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.order_seq = 0
+        self.app = self._build_app()
+
+    # -- helpers -------------------------------------------------------
+
+    def _filter(self, rows: List[Dict[str, Any]], params) -> List[Dict[str, Any]]:
+        reserved = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+        for key, value in params.multi_items():
+            if key in reserved:
+                continue
+            if key in ("or", "and"):
+                rows = [r for r in rows if _match_expr(r, f"{key}{value}")]
+                continue
+            op, arg = value.split(".", 1)
+            if op == "not":
+                op, arg = arg.split(".", 1)
+                rows = [r for r in rows if not _compare(r.get(key), op, arg)]
+            else:
+                rows = [r for r in rows if _compare(r.get(key), op, arg)]
+        return rows
+
+    def _order(self, rows: List[Dict[str, Any]], order: Optional[str]) -> List[Dict[str, Any]]:
+        if not order:
+            return rows
+        for term in reversed(order.split(",")):
+            column, *mods = term.split(".")
+            desc = "desc" in mods
+            rows = sorted(rows, key=lambda r: (r.get(column) is None, str(r.get(column))), reverse=desc)
+        return rows
+
+    def _project(self, rows: List[Dict[str, Any]], select: Optional[str]) -> List[Dict[str, Any]]:
+        if not select or select == "*":
+            return [dict(r) for r in rows]
+        columns = [c.strip() for c in select.split(",")]
+        return [{c: r.get(c) for c in columns} for r in rows]
+
+    def _new_row(self, table: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        row = {**TABLE_DEFAULTS.get(table, dict)(), "id": str(uuid.uuid4()), "created_at": now_iso()}
+        row.update(payload)
+        return row
+
+    def _conflict(self, table: str, row: Dict[str, Any], columns: List[str]) -> Optional[Dict[str, Any]]:
+        for existing in self.tables[table]:
+            for column in columns:
+                if row.get(column) is not None and existing.get(column) == row.get(column):
+                    return existing
+        return None
+
+    def insert(self, table: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        row = self._new_row(table, payload)
+        self.tables.setdefault(table, []).append(row)
+        return row
+
+    # -- RPCs ----------------------------------------------------------
+
+    def _rpc_resolve_customer_conversation(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        number = args["p_whatsapp_number"]
+        customer = next((c for c in self.tables["customers"] if c["whatsapp_number"] == number), None)
+        customer_created = customer is None
+        if customer is None:
+            customer = self.insert("customers", {"whatsapp_number": number})
+        conversation = next(
+            (c for c in self.tables["conversations"]
+             if c["customer_id"] == customer["id"] and c["status"] == "active"),
+            None
+        )
+        conversation_created = conversation is None
+        if conversation is None:
+            conversation = self.insert("conversations", {
+                "customer_id": customer["id"], "whatsapp_number": number, "status": "active"
+            })
+        return {
+            "customer": dict(customer), "conversation": dict(conversation),
+            "customer_created": customer_created, "conversation_created": conversation_created,
+        }
+
+    def _rpc_store_messages_batch(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        inserted = 0
+        conversations = {c["id"]: c for c in self.tables["conversations"]}
+        for payload in args["p_messages"]:
+            payload = {k: v for k, v in payload.items() if v is not None}
+            if self._conflict("messages", payload, ["id"] + UNIQUE_COLUMNS["messages"]):
+                continue
+            row = self.insert("messages", payload)
+            inserted += 1
+            conversation = conversations.get(row["conversation_id"])
+            if conversation is not None:
+                conversation["message_count"] += 1
+                conversation["last_message_at"] = max(conversation["last_message_at"], row["sent_at"])
+        return {"inserted": inserted}
+
+    def _rpc_place_order(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        payload = args["p_order"]
+        existing = self._conflict("orders", payload, ["idempotency_key"])
+        if existing is not None:
+            return {"order": dict(existing), "created": False}
+        self.order_seq += 1
+        order = self.insert("orders", {
+            "order_number": f"ORD-{datetime.now(timezone.utc):%Y%m%d}-{self.order_seq:06d}",
+            "idempotency_key": payload.get("idempotency_key"),
+            "customer_id": payload["customer_id"],
+            "conversation_id": payload.get("conversation_id"),
+            "status": "pending_payment",
+            "subtotal": payload.get("total") or 0,
+            "total": payload.get("total") or 0,
+        })
+        for item in payload.get("items") or []:
+            quantity, price = item.get("quantity") or 1, item.get("price") or 0
+            self.insert("order_items", {
+                "order_id": order["id"], "product_snapshot": item,
+                "quantity": quantity, "unit_price": price, "subtotal": quantity * price,
+            })
+        return {"order": dict(order), "created": True}
+
+    def _rpc_close_idle_conversations(self, args: Dict[str, Any]) -> List[Dict[str, Any]]:
+        idle_before = datetime.fromisoformat(args["p_idle_before"])
+        ids = set(args["p_ids"])
+        idle = [
+            c for c in self.tables["conversations"]
+            if c["id"] in ids and c["status"] == "active" and datetime.fromisoformat(c["last_message_at"]) < idle_before
+        ]
+        for conversation in idle:
+            conversation.update(status="closed", ended_at=now_iso())
+        return [{"id": c["id"], "whatsapp_number": c["whatsapp_number"]} for c in idle]
+
+    def _rpc_add_daily_stats(self, args: Dict[str, Any]) -> None:
+        for row in args["p_rows"]:
+            day = self.daily_stats[row["day"]]
+            for counter in DAILY_COUNTERS:
+                day[counter] += row.get(counter) or 0
+
+    def _sum_daily_stats(self, start: date, end: date) -> Dict[str, float]:
+        days = [v for d, v in self.daily_stats.items() if start <= date.fromisoformat(d) < end]
+        return {c: sum(v[c] for v in days) for c in DAILY_COUNTERS}
+
+    def _rpc_daily_stats_summary(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        today = date.fromisoformat(args["p_today"])
+        month_start = today.replace(day=1)
+        last_month_start = (month_start - timedelta(days=1)).replace(day=1)
+        return {
+            "totals": self._sum_daily_stats(date.min, date.max),
+            "today": self._sum_daily_stats(today, today + timedelta(days=1)),
+            "this_month": self._sum_daily_stats(month_start, today + timedelta(days=1)),
+            "last_month": self._sum_daily_stats(last_month_start, month_start),
+        }
+
+    # -- HTTP ----------------------------------------------------------
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/rest/v1/rpc/{name}")
+        async def rpc(name: str, request: Request):
+            self.requests += 1
+            await self.latency.wait()
+            if name not in self.rpcs:
+                return JSONResponse({"code": "PGRST202", "message": f"Unknown function {name}"}, status_code=404)
+            body = await request.body()
+            return JSONResponse(self.rpcs[name](json.loads(body) if body else {}))
+
+        @app.get("/rest/v1/{table}")
+        async def select(table: str, request: Request):
+            self.requests += 1
+            await self.latency.wait()
+            params = request.query_params
+            rows = self._filter(self.tables.get(table, []), params)
+            rows = self._order(rows, params.get("order"))
+            offset = int(params.get("offset", 0))
+            if "limit" in params:
+                rows = rows[offset:offset + int(params["limit"])]
+            elif offset:
+                rows = rows[offset:]
+            return JSONResponse(self._project(rows, params.get("select")))
+
+        @app.post("/rest/v1/{table}")
+        async def insert(table: str, request: Request):
+            self.requests += 1
+            await self.latency.wait()
+            payload = json.loads(await request.body())
+            prefer = request.headers.get("prefer", "")
+            on_conflict = request.query_params.get("on_conflict")
+            conflict_columns = on_conflict.split(",") if on_conflict else UNIQUE_COLUMNS.get(table, [])
+            created = []
+            for item in payload if isinstance(payload, list) else [payload]:
+                existing = self._conflict(table, item, conflict_columns)
+                if existing is not None:
+                    if "ignore-duplicates" in prefer:
+                        continue
+                    if "merge-duplicates" in prefer:
+                        existing.update(item)
+                        created.append(dict(existing))
+                        continue
+                    return JSONResponse(
+                        {"code": "23505", "message": f"duplicate key value violates unique constraint on {table}"},
+                        status_code=409
+                    )
+                created.append(dict(self.insert(table, item)))
+            return JSONResponse(created, status_code=201)
+
+        @app.patch("/rest/v1/{table}")
+        async def update(table: str, request: Request):
+            self.requests += 1
+            await self.latency.wait()
+            changes = json.loads(await request.body())
+            rows = self._filter(self.tables.get(table, []), request.query_params)
+            for row in rows:
+                row.update(changes)
+            return JSONResponse([dict(r) for r in rows])
+
+        @app.delete("/rest/v1/{table}")
+        async def delete(table: str, request: Request):
+            self.requests += 1
+            await self.latency.wait()
+            rows = self._filter(self.tables.get(table, []), request.query_params)
+            ids = {r["id"] for r in rows}
+            self.tables[table] = [r for r in self.tables.get(table, []) if r["id"] not in ids]
+            return JSONResponse([dict(r) for r in rows])
+
+        return app
+
+
+# =====================================================
+# OpenAI / OpenRouter
+# =====================================================
+
+class FakeOpenAI:
+    """OpenAI-compatible chat completions endpoint with configurable latency."""
+
+    def __init__(
+        self,
+        latency: Optional[LatencyModel] = None,
+        reply: str = "Thanks for your message! How can I help? 😊",
+        model_latency: Optional[Dict[str, LatencyModel]] = None
+    ):
+        self.latency = latency or LatencyModel("const:0")
+        # Per-model overrides of the latency model
+        self.model_latency = model_latency or {}
+        self.reply = reply
+        self.requests = 0
+        self.requests_by_model: Dict[str, int] = defaultdict(int)
+        self.app = self._build_app()
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/api/v1/chat/completions")
+        async def chat_completions(request: Request):
+            self.requests += 1
+            body = await request.json()
+            model = body.get("model", "fake")
+            self.requests_by_model[model] += 1
+            await self.model_latency.get(model, self.latency).wait()
+            prompt_tokens = sum(len(m.get("content") or "") // 4 for m in body.get("messages", []))
+            completion_tokens = len(self.reply) // 4
+            return JSONResponse({
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.reply},
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            })
+
+        @app.get("/api/v1/models")
+        async def models():
+            return JSONResponse({"object": "list", "data": [{"id": "fake", "object": "model"}]})
+
+        return app
+
+
+# =====================================================
+# Twilio
+# =====================================================
+
+class FakeTwilio:
+    """Twilio Messages API stand-in that records every send."""
+
+    def __init__(self, latency: Optional[LatencyModel] = None, error_rate: float = 0.0):
+        self.latency = latency or LatencyModel("const:0")
+        # Share of sends answered with a 429 or 503 instead of being accepted
+        self.error_rate = error_rate
+        self.errors = 0
+        self.sent: List[Dict[str, Any]] = []
+        # Called with (to, body, received_at) for every message
+        self.on_message: Optional[Callable[[str, str, float], None]] = None
+        # Media SID -> (content, content type), served like Twilio media URLs
+        self.media: Dict[str, Tuple[bytes, str]] = {}
+        self.media_requests = 0
+        self.app = self._build_app()
+
+    def add_media(self, media_sid: str, content: bytes, content_type: str):
+        """Serve content at .../Messages/<any>/Media/<media_sid>."""
+        self.media[media_sid] = (content, content_type)
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/2010-04-01/Accounts/{account_sid}/Messages.json")
+        async def create_message(account_sid: str, request: Request):
+            form = await request.form()
+            await self.latency.wait()
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                status = random.choice((429, 503))
+                return JSONResponse({
+                    "code": 20429 if status == 429 else 20503,
+                    "message": "Too Many Requests" if status == 429 else "Service Unavailable",
+                    "status": status,
+                }, status_code=status)
+            received_at = time.perf_counter()
+            sid = f"SM{uuid.uuid4().hex}"
+            to, body = form.get("To", ""), form.get("Body", "")
+            self.sent.append({"sid": sid, "to": to, "body": body, "received_at": received_at})
+            if self.on_message:
+                self.on_message(to, body, received_at)
+            return JSONResponse({
+                "sid": sid, "account_sid": account_sid, "to": to, "from": form.get("From", ""),
+                "body": body, "status": "queued", "date_created": now_iso(),
+            }, status_code=201)
+
+        @app.get("/2010-04-01/Accounts/{account_sid}.json")
+        async def fetch_account(account_sid: str):
+            return JSONResponse({"sid": account_sid, "status": "active"})
+
+        @app.get("/2010-04-01/Accounts/{account_sid}/Messages/{message_sid}/Media/{media_sid}")
+        async def fetch_media(account_sid: str, message_sid: str, media_sid: str):
+            self.media_requests += 1
+            await self.latency.wait()
+            if media_sid not in self.media:
+                return JSONResponse({"code": 20404, "message": "Not Found", "status": 404}, status_code=404)
+            # Like Twilio, redirect to the storage host
+            return Response(status_code=307, headers={"Location": f"/storage/{media_sid}"})
+
+        @app.get("/storage/{media_sid}")
+        async def fetch_stored_media(media_sid: str):
+            content, content_type = self.media[media_sid]
+            return Response(content=content, media_type=content_type)
+
+        return app
+
+
+# =====================================================
+# Runner
+# =====================================================
+
+def _bind() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+class FakeServices:
+    """Runs the fakes on free local ports in a dedicated thread."""
+
+    def __init__(self, postgrest: FakePostgrest, openai: FakeOpenAI, twilio: FakeTwilio):
+        self.postgrest = postgrest
+        self.openai = openai
+        self.twilio = twilio
+        self._sockets = {name: _bind() for name in ("postgrest", "openai", "twilio")}
+        self._servers: List[uvicorn.Server] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def url(self, name: str) -> str:
+        host, port = self._sockets[name].getsockname()
+        return f"http://{host}:{port}"
+
+    def env(self) -> Dict[str, str]:
+        """Environment variables pointing main:app at the fakes."""
+        return {
+            "SUPABASE_URL": self.url("postgrest"),
+            "SUPABASE_PROJECT_REF": "local",
+            # Any well-formed JWT; the fake does not check it
+            "SUPABASE_SERVICE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.local",
+            "OPENROUTER_API_KEY": "local",
+            "OPENROUTER_BASE_URL": f"{self.url('openai')}/api/v1",
+            "TWILIO_ACCOUNT_SID": "AClocal",
+            "TWILIO_AUTH_TOKEN": "local",
+            "TWILIO_WHATSAPP_NUMBER": "whatsapp:+14155238886",
+            "TWILIO_API_BASE_URL": self.url("twilio"),
+        }
+
+    def start(self):
+        ready = threading.Event()
+
+        async def serve():
+            apps = {"postgrest": self.postgrest.app, "openai": self.openai.app, "twilio": self.twilio.app}
+            tasks = []
+            for name, app in apps.items():
+                server = uvicorn.Server(uvicorn.Config(app, log_level="warning", access_log=False, lifespan="off"))
+                self._servers.append(server)
+                tasks.append(asyncio.create_task(server.serve(sockets=[self._sockets[name]])))
+            while not all(s.started for s in self._servers):
+                await asyncio.sleep(0.01)
+            ready.set()
+            await asyncio.gather(*tasks)
+
+        self._thread = threading.Thread(target=lambda: asyncio.run(serve()), name="fake-services", daemon=True)
+        self._thread.start()
+        if not ready.wait(timeout=10):
+            raise RuntimeError("Fake services failed to start")
+
+    def stop(self):
+        for server in self._servers:
+            server.should_exit = True
+        if self._thread:
+            self._thread.join(timeout=5)
@@ -0,0 +1,263 @@
+"""
+End-to-end load test for main:app against local stand-ins.
+
+Boots the FastAPI app in-process (including its lifespan) with Supabase,
+OpenRouter and Twilio replaced by the fakes in benchmarks/fakes.py, then
+drives POST /webhooks/whatsapp from N concurrent synthetic customers.
+Each customer sends its next message after the previous reply reaches
+the Twilio stub, so end-to-end latency is webhook POST -> outbound send.
+With --burst N, customers send N messages back to back (like WhatsApp
+users typing in fragments) and latency is measured from the last one.
+
+Reports throughput, p50/p95/p99 latency and the per-stage breakdown from
+services.metrics, and writes machine-readable JSON for comparing commits.
+
+Usage (from backend/):
+    python benchmarks/loadtest.py --customers 50 --messages 5 \\
+        --llm-latency lognormal:0.8:0.4 --db-latency const:0.01 \\
+        [--llm-model-latency openai/gpt-3.5-turbo=lognormal:0.8:1.0] \\
+        [--burst 3 --burst-gap 0.2] \\
+        --output results.json [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Dict, List
+
+sys.path.append('.')
+
+from benchmarks.fakes import FakeOpenAI, FakePostgrest, FakeServices, FakeTwilio, LatencyModel
+
+MESSAGE_POOL = [
+    "hi",
+    "Hello",
+    "what do you sell?",
+    "Do you have red sneakers in size 42?",
+    "How long does delivery take to Nairobi?",
+    "Can I see your laptops",
+    "What's the price of the wireless headphones?",
+    "I'd like to order 2 t-shirts please",
+    "Do you accept M-Pesa?",
+    "thanks!",
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+async def run(args) -> Dict[str, Any]:
+    postgrest = FakePostgrest(LatencyModel(args.db_latency))
+    model_latency = {}
+    for override in args.llm_model_latency:
+        model, spec = override.split("=", 1)
+        model_latency[model] = LatencyModel(spec)
+    openai = FakeOpenAI(LatencyModel(args.llm_latency), model_latency=model_latency)
+    twilio = FakeTwilio(LatencyModel(args.twilio_latency), error_rate=args.twilio_error_rate)
+    fakes = FakeServices(postgrest, openai, twilio)
+    fakes.start()
+    os.environ.update(fakes.env())
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    # Imported only now so settings and global clients pick up the fakes
+    import httpx
+    import main
+    from services.metrics import stage_seconds
+
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.get_running_loop()
+
+    # Replies per customer, signalled from the fake Twilio thread
+    replies: Dict[str, asyncio.Queue] = defaultdict(asyncio.Queue)
+
+    def on_message(to: str, body: str, received_at: float):
+        loop.call_soon_threadsafe(replies[to.replace("whatsapp:", "")].put_nowait, received_at)
+
+    twilio.on_message = on_message
+
+    latencies: List[float] = []
+    ack_latencies: List[float] = []
+    errors = defaultdict(int)
+
+    async def customer(client: httpx.AsyncClient, index: int):
+        number = f"+2547{index:08d}"
+        seq = 0
+        while seq < args.messages:
+            # A burst of messages sent back to back, then wait for the reply
+            burst = min(args.burst, args.messages - seq)
+            accepted = 0
+            for _ in range(burst):
+                body = random.choice(MESSAGE_POOL)
+                sent_at = time.perf_counter()
+                response = await client.post("/webhooks/whatsapp", data={
+                    "From": f"whatsapp:{number}",
+                    "Body": body,
+                    "MessageSid": f"SMload{index:06d}{seq:04d}",
+                })
+                seq += 1
+                ack_latencies.append(time.perf_counter() - sent_at)
+                if response.status_code != 200:
+                    errors[f"http_{response.status_code}"] += 1
+                else:
+                    accepted += 1
+                if args.burst_gap and seq % args.burst:
+                    await asyncio.sleep(args.burst_gap)
+            if not accepted:
+                continue
+            try:
+                received_at = await asyncio.wait_for(replies[number].get(), timeout=args.timeout)
+                latencies.append(received_at - sent_at)
+            except asyncio.TimeoutError:
+                errors["reply_timeout"] += 1
+            if args.burst > 1:
+                # Collect any further replies to this burst before the next one
+                while True:
+                    try:
+                        await asyncio.wait_for(replies[number].get(), timeout=args.settle)
+                    except asyncio.TimeoutError:
+                        break
+            if args.think_time:
+                await asyncio.sleep(random.uniform(0, args.think_time))
+
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+                started = time.perf_counter()
+                await asyncio.gather(*(customer(client, i) for i in range(args.customers)))
+                elapsed = time.perf_counter() - started
+    finally:
+        fakes.stop()
+
+    stages = {
+        f"{stage}:{outcome}": {k: round(v, 6) if isinstance(v, float) else v for k, v in stats.items()}
+        for (stage, outcome), stats in stage_seconds.series().items()
+    }
+    return {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "config": {
+            "customers": args.customers,
+            "messages_per_customer": args.messages,
+            "think_time": args.think_time,
+            "burst": args.burst,
+            "db_latency": args.db_latency,
+            "llm_latency": args.llm_latency,
+            "llm_model_latency": args.llm_model_latency,
+            "twilio_latency": args.twilio_latency,
+            "twilio_error_rate": args.twilio_error_rate,
+        },
+        "replies": len(latencies),
+        "inbound_messages": args.customers * args.messages,
+        "errors": dict(errors),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_msgs_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_seconds": {
+            "p50": round(percentile(latencies, 0.50), 4),
+            "p95": round(percentile(latencies, 0.95), 4),
+            "p99": round(percentile(latencies, 0.99), 4),
+            "max": round(max(latencies), 4) if latencies else 0.0,
+        },
+        "webhook_ack_seconds": {
+            "p50": round(percentile(ack_latencies, 0.50), 4),
+            "p99": round(percentile(ack_latencies, 0.99), 4),
+        },
+        "upstream_requests": {
+            "postgrest": postgrest.requests,
+            "llm": openai.requests,
+            "llm_by_model": dict(openai.requests_by_model),
+            "twilio": len(twilio.sent),
+            "twilio_errors": twilio.errors,
+        },
+        "stages": stages,
+        "cold_start": main.container.stats()["cold_start"],
+    }
+
+
+def report(results: Dict[str, Any], baseline: Dict[str, Any] = None):
+    def delta(path: List[str]) -> str:
+        if not baseline:
+            return ""
+        old, new = baseline, results
+        for key in path:
+            old, new = old.get(key, {}), new.get(key, {})
+        if not isinstance(old, (int, float)) or not old:
+            return ""
+        return f"  ({(new - old) / old * 100:+.1f}% vs {baseline.get('commit', 'baseline')})"
+
+    cfg = results["config"]
+    print(f"\n{cfg['customers']} customers x {cfg['messages_per_customer']} messages "
+          f"(db {cfg['db_latency']}, llm {cfg['llm_latency']}, twilio {cfg['twilio_latency']})")
+    print(f"  replies      {results['replies']}  errors {results['errors'] or 'none'}")
+    print(f"  inbound      {results['inbound_messages']} messages (bursts of {cfg['burst']})")
+    print(f"  throughput   {results['throughput_msgs_per_sec']:.2f} msg/s{delta(['throughput_msgs_per_sec'])}")
+    for q in ("p50", "p95", "p99"):
+        print(f"  latency {q}  {results['latency_seconds'][q] * 1000:8.1f} ms{delta(['latency_seconds', q])}")
+    print(f"  webhook ack  p50 {results['webhook_ack_seconds']['p50'] * 1000:.1f} ms, "
+          f"p99 {results['webhook_ack_seconds']['p99'] * 1000:.1f} ms")
+    print(f"  upstream     {results['upstream_requests']}")
+    cold = results.get("cold_start") or {}
+    if cold:
+        print(f"  cold start   ready {cold.get('warmup_seconds', 0) * 1000:.0f} ms "
+              f"(imports {cold.get('imports_seconds', 0) * 1000:.0f} ms), "
+              f"first reply {(cold.get('first_reply_seconds') or 0) * 1000:.0f} ms after start")
+    print("\n  stage                          count     mean ms    p95 ms")
+    for name, stats in results["stages"].items():
+        print(f"  {name:<30} {stats['count']:>5} {stats['mean'] * 1000:>11.1f} {stats['p95'] * 1000:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", type=int, default=50, help="Concurrent synthetic customers")
+    parser.add_argument("--messages", type=int, default=5, help="Messages sent by each customer")
+    parser.add_argument("--burst", type=int, default=1, help="Messages each customer sends back to back before waiting for a reply")
+    parser.add_argument("--burst-gap", type=float, default=0.2, help="Seconds between messages within a burst")
+    parser.add_argument("--settle", type=float, default=1.5, help="Quiet seconds that end a burst's replies")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Max random pause between a reply and the next message")
+    parser.add_argument("--db-latency", default="const:0.01", help="PostgREST latency spec")
+    parser.add_argument("--llm-latency", default="lognormal:0.8:0.4", help="LLM latency spec")
+    parser.add_argument("--llm-model-latency", action="append", default=[], metavar="MODEL=SPEC",
+                        help="Latency spec for one model in the LLM chain (repeatable)")
+    parser.add_argument("--twilio-latency", default="const:0.05", help="Twilio API latency spec")
+    parser.add_argument("--twilio-error-rate", type=float, default=0.0,
+                        help="Share of Twilio sends answered with a 429 or 503")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for each reply")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write JSON results to this file")
+    parser.add_argument("--compare", help="Baseline JSON results to diff against")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import sys
 sys.path.append('.')
 
 from services.supabase import supabase_client
+from services.export import iter_rows
 
 async def main():
     print("\n" + "="*80)
@@ -14,7 +15,9 @@ async def main():
     
     try:
         # Get recent conversations
-        result = supabase_client.client.table('conversations').select('*').order('started_at', desc=True).limit(1).execute()
+        result = supabase_client.client.table('conversations').select(
+            'id,customer_id,status,started_at,message_count'
+        ).order('started_at', desc=True).limit(1).execute()
         
         if result.data and len(result.data) > 0:
             conv = result.data[0]
@@ -24,18 +27,23 @@ async def main():
             print(f"   Started: {conv['started_at']}")
             print()
             
-            # Get messages for this conversation
-            messages = supabase_client.client.table('messages').select('*').eq(
-                'conversation_id', conv['id']
-            ).order('created_at', desc=False).execute()
-            
-            print(f"💬 Messages ({len(messages.data)}):")
+            # Page through this conversation's messages (keyset on created_at, id)
+            print(f"💬 Messages ({conv['message_count']}):")
             print("-" * 80)
-            for i, msg in enumerate(messages.data, 1):
-                sender = "🤖 AGENT" if msg['sender_type'] == 'agent' else "👤 USER"
-                print(f"{i}. {sender} [{msg['created_at']}]")
-                print(f"   {msg['message_text'][:100]}")
-                print()
+            i = 0
+            async for page in iter_rows(
+                supabase_client,
+                'messages',
+                ['sender_type', 'message_text', 'created_at'],
+                {'conversation_id': conv['id']},
+                page_size=200
+            ):
+                for msg in page:
+                    i += 1
+                    sender = "🤖 AGENT" if msg['sender_type'] == 'agent' else "👤 USER"
+                    print(f"{i}. {sender} [{msg['created_at']}]")
+                    print(f"   {(msg['message_text'] or '')[:100]}")
+                    print()
                 
         else:
             print("No conversations found")
@@ -1,6 +1,7 @@
 """
 Configuration management for the WhatsApp AI Sales Agent backend.
 """
+from typing import List, Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -9,6 +10,7 @@ class Settings(BaseSettings):
     
     # OpenRouter AI
     openrouter_api_key: str
+    openrouter_base_url: str = "https://openrouter.ai/api/v1"
     
     # Supabase
     supabase_project_ref: str
@@ -19,15 +21,158 @@ class Settings(BaseSettings):
     twilio_account_sid: str
     twilio_auth_token: str
     twilio_whatsapp_number: str  # Format: whatsapp:+14155238886
+    twilio_timeout: float = 10.0
+    twilio_max_connections: int = 20
+    twilio_api_base_url: Optional[str] = None  # Override api.twilio.com (local stand-ins)
     
     # Application
     port: int = 8000
     environment: str = "development"
     log_level: str = "INFO"
+    # "json" (one object per line) or "text"
+    log_format: str = "json"
+    # Share of requests whose INFO/DEBUG lines are kept (warnings always are)
+    log_sample_rate: float = 1.0
+    log_queue_size: int = 10000
 
     # Cache TTLs (kept for compatibility)
     redis_ttl_conversation_history: int = 300
     redis_ttl_customer_data: int = 1800
+
+    # LLM model chain (comma-separated, preferred first), deadline and hedging
+    llm_models: str = "openai/gpt-3.5-turbo,openai/gpt-4o-mini"
+    llm_deadline: float = 20.0
+    llm_hedge_quantile: float = 0.95
+    llm_hedge_delay: float = 3.0
+    llm_hedge_min_delay: float = 0.5
+    llm_hedge_budget: float = 0.1
+
+    # Number of recent messages kept as agent context (and in the history cache)
+    conversation_history_limit: int = 10
+
+    # Agent response cache for repeated short questions
+    response_cache_enabled: bool = True
+    response_cache_ttl: int = 3600
+    response_cache_max_chars: int = 80
+
+    # Prompt token budget (system prompt + summary + history + message)
+    context_token_budget: int = 1500
+    context_max_recent_turns: int = 4
+    context_max_message_tokens: int = 400
+
+    # Rolling conversation summaries (stored in conversations.metadata).
+    # Keep conversation_history_limit > context_max_recent_turns + summary_min_messages
+    # so overflowing turns are summarised before they leave the history window.
+    summary_enabled: bool = True
+    summary_model: str = "openai/gpt-3.5-turbo"
+    summary_min_messages: int = 4
+    summary_max_tokens: int = 200
+
+    # In-memory (L1) cache bounds
+    cache_max_entries: int = 10000
+    cache_max_bytes: int = 64 * 1024 * 1024
+
+    # Shared Redis (L2) cache; L1 copies live at most cache_l1_ttl seconds
+    redis_enabled: bool = False
+    redis_url: str = "redis://localhost:6379/0"
+    cache_l1_ttl: int = 30
+    cache_invalidation_channel: str = "whatsapp:cache:invalidate"
+
+    # Per-conversation leases (Redis when enabled, else per-process locks)
+    lease_ttl: float = 30.0
+    lease_wait_timeout: float = 60.0
+    lease_retry_delay: float = 1.0
+    # Lease waits per run before the batch is re-enqueued, and re-enqueues
+    # before it is dropped with an apology to the customer
+    lease_max_attempts: int = 3
+    lease_max_requeues: int = 1
+
+    # Supabase thread pool for offloading blocking PostgREST calls
+    supabase_pool_size: int = 16
+
+    # Webhook idempotency (MessageSid seen-set)
+    dedupe_ttl: int = 3600
+    dedupe_max_entries: int = 100000
+
+    # In-memory product catalog index
+    catalog_enabled: bool = True
+    catalog_refresh_interval: int = 60
+
+    # Write-behind buffer for message rows (bulk flush, local spool)
+    write_buffer_enabled: bool = True
+    write_buffer_spool_dir: str = ".spool/messages"
+    write_buffer_flush_interval: float = 0.25
+    write_buffer_max_batch: int = 200
+    write_buffer_fsync: bool = False
+
+    # Outbound delivery queue (Twilio limits messages per second per sender)
+    outbound_workers: int = 8
+    outbound_max_depth: int = 5000
+    outbound_rate: float = 20.0
+    outbound_burst: int = 40
+    outbound_max_attempts: int = 6
+    outbound_retry_delay: float = 0.5
+    outbound_max_retry_delay: float = 20.0
+    outbound_recovery_window: int = 900
+    outbound_dead_letter_dir: str = ".spool/outbound"
+
+    # Startup warm-up: one cheap request per dependency before reporting
+    # ready; failed ones are retried every warmup_retry_interval seconds
+    warmup_enabled: bool = True
+    warmup_timeout: float = 10.0
+    warmup_retry_interval: float = 5.0
+
+    # Order outbox (durable local log drained by a background worker)
+    order_outbox_dir: str = ".spool/orders"
+    order_outbox_max_attempts: int = 10
+    order_outbox_fsync: bool = True
+
+    # Dashboard aggregates: seconds between flushes to daily_stats, and
+    # seconds /analytics/summary is served from cache. The summary needs a
+    # Bearer key and is disabled unless one is set
+    analytics_flush_interval: float = 10.0
+    analytics_cache_ttl: int = 30
+    analytics_api_key: str = ""
+
+    # Streaming exports (/export/{table}); disabled unless a key is set
+    export_api_key: str = ""
+    export_page_size: int = 1000
+
+    # Inbound media: downloaded off the webhook path into content-addressed
+    # local storage (media_dir/<sha256[:2]>/<sha256>.<ext>)
+    media_enabled: bool = True
+    media_dir: str = "media"
+    media_workers: int = 4
+    media_max_depth: int = 500
+    media_max_bytes: int = 16 * 1024 * 1024
+    media_chunk_size: int = 64 * 1024
+    media_timeout: float = 30.0
+    # Comma-separated hosts media URLs may point to, including the storage
+    # hosts Twilio redirects them to (redirects elsewhere are refused)
+    media_allowed_hosts: str = "api.twilio.com,mms.twiliocdn.com,media.twiliocdn.com"
+
+    # Idle conversation sweeper: close conversations with no message for
+    # conversation_idle_timeout seconds, checking every sweeper_interval
+    sweeper_enabled: bool = True
+    conversation_idle_timeout: int = 86400
+    sweeper_interval: float = 300.0
+    sweeper_batch_size: int = 500
+    sweeper_max_batches: int = 20
+
+    # Coalescing of inbound message bursts (seconds; 0 answers each message
+    # as soon as a worker is free)
+    coalesce_window: float = 1.0
+    coalesce_max_wait: float = 4.0
+    coalesce_max_messages: int = 10
+
+    # Background message queue
+    queue_workers: int = 8
+    queue_max_depth: int = 1000
+    queue_drain_timeout: float = 30.0
+    
+    @property
+    def llm_model_list(self) -> List[str]:
+        return [m.strip() for m in self.llm_models.split(",") if m.strip()]
     
     model_config = SettingsConfigDict(
         env_file=".env",
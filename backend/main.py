@@ -1,27 +1,68 @@
 """
 FastAPI application for WhatsApp AI Sales Agent webhook handling.
 """
+import time
+# Cold-start reference point, taken before the heavy imports below
+PROCESS_STARTED_AT = time.monotonic()
+
 from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import logging
-import re
-import json
 import asyncio
+import secrets
+from datetime import datetime
+from typing import List, Optional
+from contextlib import asynccontextmanager
 from config import settings
+from services.analytics import daily_stats
 from services.cache import cache
+from services.export import ExportError, FORMATS, build_filters, parse_columns, stream_export
+from services.queue import MessageQueue
+from services.dedupe import message_dedupe
+from services.catalog import product_catalog
+from services.write_buffer import message_buffer
+from services.outbox import order_outbox
+from services.outbound import outbound_queue
+from services.supabase import supabase_client, DuplicateMessageError
+from services.sweeper import conversation_sweeper
+from services.container import ServiceContainer, register_metrics
+from services.coalescer import InboundCoalescer, InboundMedia, InboundMessage, MessageBatch
+from services.media import media_pipeline, content_type_of, describe
+from services.lease import conversation_leases, lease_timeouts, Lease, LeaseTimeout
+from services.metrics import metrics, dependencies, stage, stage_seconds
+from services.log import setup_logging, bind_correlation_id, correlation_scope
+from agents.response_cache import response_cache
+from agents.context import context_builder
+from agents.orders import extract_order
+from agents import process_message as run_agent
+from agents.router import SYSTEM_PROMPT, model_chain
+from agents.summarizer import conversation_summarizer
 
-# Configure logging
-logging.basicConfig(
-    level=getattr(logging, settings.log_level),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Configure logging (queued, sampled JSON lines; see services/log.py)
+setup_logging(
+    level=settings.log_level,
+    fmt=settings.log_format,
+    sample_rate=settings.log_sample_rate,
+    max_queue=settings.log_queue_size
 )
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start and warm up services before serving; drain them on shutdown."""
+    await container.start()
+    yield
+    await container.stop()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="WhatsApp AI Sales Agent",
     description="AI-powered sales agent for WhatsApp Business",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -44,20 +85,124 @@ async def root():
     }
 
 
+@app.get("/ready")
+async def readiness():
+    """Readiness probe: 200 once services are started and every warm-up succeeded."""
+    if not container.ready:
+        failed = container.failed_warmups
+        raise HTTPException(status_code=503, detail=f"Warm-up failed: {', '.join(failed)}" if failed else "Starting up")
+    return {"status": "ready"}
+
+
 @app.get("/health")
 async def health_check():
-    """Detailed health check."""
+    """Detailed health check with recent measured latency and error rate per dependency."""
+    services = {
+        "whatsapp_api": dependencies.summary("twilio"),
+        "supabase": dependencies.summary("supabase"),
+        "openrouter": dependencies.summary("openrouter")
+    }
+    if settings.redis_enabled:
+        services["redis"] = dependencies.summary("redis")
+    degraded = any(s["status"] == "degraded" for s in services.values())
     return {
-        "status": "healthy",
+        "status": "degraded" if degraded else "healthy",
         "environment": settings.environment,
-        "services": {
-            "whatsapp_api": "connected",
-            "supabase": "connected",
-            "gemini": "connected"
-        }
+        "services": services,
+        "startup": container.stats(),
+        "queue": message_queue.stats(),
+        "outbound": outbound_queue.stats(),
+        "dedupe": message_dedupe.stats(),
+        "cache": cache.stats(),
+        "response_cache": response_cache.stats(),
+        "catalog": product_catalog.stats(),
+        "summaries": conversation_summarizer.stats(),
+        "write_buffer": message_buffer.stats(),
+        "orders": order_outbox.stats(),
+        "media": media_pipeline.stats(),
+        "sweeper": conversation_sweeper.stats(),
+        "analytics": daily_stats.stats(),
+        "llm": model_chain.snapshot(),
+        "coalescing": message_coalescer.stats(),
+        "leases": conversation_leases.stats()
     }
 
 
+def require_api_key(request: Request, expected: str, feature: str):
+    """
+    Check a `Authorization: Bearer <key>` header against a configured key.
+    
+    Raises:
+        HTTPException: 404 if no key is configured (the feature is off),
+            401 if the header does not match
+    """
+    supplied = request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    if not expected:
+        raise HTTPException(status_code=404, detail=f"{feature} is not enabled")
+    if not secrets.compare_digest(supplied.encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail=f"Invalid {feature.lower()} key")
+
+
+@app.get("/analytics/summary")
+async def analytics_summary(request: Request):
+    """
+    Dashboard figures from the running daily aggregates (cached briefly).
+    Requires `Authorization: Bearer <ANALYTICS_API_KEY>`; disabled when no key is set.
+    """
+    require_api_key(request, settings.analytics_api_key, "Analytics")
+    try:
+        return await daily_stats.summary()
+    except Exception as e:
+        logger.error("Analytics summary failed: %s", e)
+        raise HTTPException(status_code=503, detail="Analytics unavailable")
+
+
+@app.get("/export/{table}")
+async def export_table(
+    table: str,
+    request: Request,
+    format: str = "ndjson",
+    columns: Optional[str] = None,
+    status: Optional[str] = None,
+    customer_id: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    direction: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """
+    Stream conversations or messages as NDJSON or CSV, oldest first.
+    Requires `Authorization: Bearer <EXPORT_API_KEY>`; disabled when no key is set.
+    """
+    require_api_key(request, settings.export_api_key, "Export")
+    
+    try:
+        if format not in FORMATS:
+            raise ExportError(f"Unknown format: {format}")
+        selected = parse_columns(table, columns)
+        filters = build_filters(
+            table, since=since, until=until, status=status, customer_id=customer_id,
+            conversation_id=conversation_id, direction=direction
+        )
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return StreamingResponse(
+        stream_export(supabase_client, table, format, selected, filters, page_size=settings.export_page_size),
+        media_type=FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'}
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Prometheus metrics: stage latencies, dependency latencies, cache and queue stats."""
+    return PlainTextResponse(
+        metrics.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/webhooks/whatsapp")
 @app.post("/webhooks/whatsapp")
 async def whatsapp_webhook_handler(request: Request):
@@ -75,143 +220,290 @@ async def whatsapp_webhook_handler(request: Request):
     from_number = form_data.get("From", "")  # whatsapp:+254712345678
     message_text = form_data.get("Body", "")
     message_sid = form_data.get("MessageSid", "")
+    media = parse_media(form_data)
+    
+    # Everything logged for this message, here and in the workers, carries its SID
+    bind_correlation_id(message_sid)
+    logger.info("Received message from %s (%d chars, %d media)", from_number, len(message_text), len(media))
     
-    logger.info(f"Received message from {from_number}: {message_text[:50]}...")
+    # Twilio retries slow webhooks; drop repeats before doing any work
+    if message_sid and message_dedupe.check_and_mark(message_sid):
+        logger.info("Duplicate webhook for %s, ignoring", message_sid)
+        return Response(content="", media_type="text/plain")
     
-    # Process the message
-    await process_message(from_number, message_text, message_sid)
+    # Hand off to the background workers so Twilio gets its 200 right away.
+    # Keyed on the sender so a customer's messages are answered in order;
+    # messages sent while their batch is still waiting join it instead.
+    batch = message_coalescer.add(from_number, message_text, message_sid, media)
+    if batch is not None and not message_queue.enqueue(
+        from_number, from_number, batch, delay=settings.coalesce_window
+    ):
+        logger.warning("Message queue full, rejecting %s (depth %d)", message_sid, message_queue.depth)
+        # Let Twilio's retry through once we have capacity again
+        message_coalescer.discard(batch)
+        message_dedupe.forget(message_sid)
+        raise HTTPException(status_code=503, detail="Message queue is full")
     
     return Response(content="", media_type="text/plain")
 
 
-async def process_message(from_number: str, message_text: str, message_sid: str):
+def parse_media(form_data) -> List[InboundMedia]:
+    """Attachments of a Twilio webhook (NumMedia, MediaUrlN, MediaContentTypeN)."""
+    try:
+        count = int(form_data.get("NumMedia") or 0)
+    except ValueError:
+        return []
+    media = []
+    for i in range(count):
+        url = form_data.get(f"MediaUrl{i}")
+        if url:
+            media.append(InboundMedia(
+                url=url,
+                content_type=form_data.get(f"MediaContentType{i}") or "application/octet-stream"
+            ))
+    return media
+
+
+async def process_message(from_number: str, batch: MessageBatch):
     """
-    Process an incoming WhatsApp message from Twilio.
+    Process a batch of incoming WhatsApp messages from one sender.
+    Holds the sender's conversation lease so no other worker or node
+    handles the same customer at the same time. If the lease stays
+    unavailable the batch is re-enqueued, and eventually dropped.
     
     Args:
         from_number: Sender's number (format: whatsapp:+254712345678)
-        message_text: Message content
-        message_sid: Twilio message SID
+        batch: Coalesced messages (text and Twilio message SID)
+    """
+    # Wait out the rest of the burst, then close the batch
+    inbound = await message_coalescer.collect(batch)
+    
+    # Logs of the whole batch are correlated with its last message
+    with correlation_scope(inbound[-1].sid if inbound else None):
+        attempts = max(1, settings.lease_max_attempts)
+        for attempt in range(1, attempts + 1):
+            try:
+                async with conversation_leases.hold(from_number) as lease:
+                    await answer_messages(from_number, inbound, lease)
+                return
+            except LeaseTimeout as e:
+                error = e
+                if attempt < attempts:
+                    # Another worker is stuck on this customer. Retry here
+                    # first, so the customer's later messages stay queued
+                    # behind this batch
+                    lease_timeouts.inc(action="retried")
+                    logger.warning("%s, retrying in %ss", e, settings.lease_retry_delay)
+                    await asyncio.sleep(settings.lease_retry_delay)
+        
+        message_sids = ', '.join(m.sid for m in inbound)
+        # Free this worker; the batch runs again behind the customer's
+        # later messages
+        if batch.requeues < settings.lease_max_requeues and message_queue.enqueue(
+            from_number, from_number, batch, delay=settings.lease_retry_delay
+        ):
+            batch.requeues += 1
+            lease_timeouts.inc(action="requeued")
+            logger.warning("%s (%d attempts), re-enqueued %s", error, attempts, message_sids)
+            return
+        lease_timeouts.inc(action="dropped")
+        logger.error("%s (%d attempts), dropping %s", error, attempts, message_sids)
+        outbound_queue.send(
+            from_number.replace('whatsapp:', ''),
+            "Sorry, I'm having trouble right now. Please try again in a moment."
+        )
+
+
+async def answer_messages(from_number: str, inbound: List[InboundMessage], lease: Optional[Lease] = None):
+    """
+    Store a sender's messages and answer them with a single reply.
+    
+    Args:
+        from_number: Sender's number (format: whatsapp:+254712345678)
+        inbound: Messages to answer, oldest first
+        lease: The sender's conversation lease; if it is lost before the
+            reply is recorded, no reply is stored, queued or ordered
     """
     # Remove "whatsapp:" prefix for database storage
     clean_number = from_number.replace('whatsapp:', '')
+    message_sids = [m.sid for m in inbound]
     
-    logger.info(f"Processing message {message_sid} from {clean_number}")
+    logger.info("Processing messages %s from %s", ', '.join(message_sids), clean_number)
+    started_at = time.perf_counter()
     
     try:
-        # Import Supabase client
-        from services.supabase import supabase_client
-        
-        # 1 & 2. Get/create customer and conversation in parallel
-        logger.info(f"Getting/creating customer and conversation for {clean_number}")
-        
-        # We need customer_id for conversation creation if it doesn't exist
-        # So we first get/create customer, then conversation
-        # Ideally we'd parallelize fully, but conversation depends on customer_id
-        # Optimization: Check cache for customer first (handled in supabase_client)
-        
-        customer = await supabase_client.get_or_create_customer(clean_number)
+        # 1 & 2. Get/create customer and conversation in one step
+        # (cached mapping, otherwise a single RPC round trip)
+        logger.info("Resolving customer and conversation for %s", clean_number)
+        with stage("resolve"):
+            customer, conversation = await supabase_client.resolve_customer_conversation(clean_number)
         customer_id = customer['id']
-        logger.info(f"Customer ID: {customer_id}")
-        
-        conversation = await supabase_client.get_or_create_conversation(
-            customer_id=customer_id,
-            whatsapp_number=clean_number
-        )
         conversation_id = conversation['id']
-        logger.info(f"Conversation ID: {conversation_id}")
+        logger.info("Customer ID: %s, Conversation ID: %s", customer_id, conversation_id)
         
-        # 3. Store inbound message
-        logger.info(f"Storing inbound message")
-        await supabase_client.store_message(
-            conversation_id=conversation_id,
-            direction='inbound',
-            message_text=message_text,
-            whatsapp_message_id=message_sid,
-            sender_type='customer'
-        )
-        logger.info("Inbound message stored successfully")
+        # 3. Store inbound messages
+        logger.info("Storing %d inbound message(s)", len(inbound))
+        stored = []
+        with stage("inbound_store"):
+            for message in inbound:
+                first_media = message.media[0] if message.media else None
+                try:
+                    row = await supabase_client.store_message(
+                        conversation_id=conversation_id,
+                        direction='inbound',
+                        message_text=message.text,
+                        whatsapp_message_id=message.sid,
+                        sender_type='customer',
+                        content_type=content_type_of(first_media.content_type) if first_media else 'text',
+                        media_url=first_media.url if first_media else None,
+                        media_mime_type=first_media.content_type if first_media else None
+                    )
+                    stored.append(message)
+                    if message.media and settings.media_enabled:
+                        # Downloaded in the background; the row is updated when stored
+                        media_pipeline.submit(row['id'], message.media)
+                except DuplicateMessageError:
+                    # Already handled by another worker or before a restart
+                    message_dedupe.record_db_duplicate()
+                    logger.info("Message %s already stored, skipping", message.sid)
+        if not stored:
+            return
+        logger.info("Inbound messages stored successfully")
+        
+        # The earlier messages of a burst are in the history; the agent
+        # answers them together with the last one
+        message_text = stored[-1].text or (describe(stored[-1].media) if stored[-1].media else "")
+        coalesced = len(stored) > 1
         
         # 4. Generate AI response
         logger.info("Generating AI response")
-        from agents import process_message as run_agent
         
         # Fetch conversation history (try cache first)
-        history = await cache.get_cached_conversation_history(conversation['id'])
+        with stage("history_fetch") as span:
+            history = await cache.get_cached_conversation_history(conversation['id'])
+            
+            if history is None:
+                span.outcome = "miss"
+                logger.info("Cache miss for conversation history - fetching from DB")
+                history = await supabase_client.get_recent_messages(
+                    conversation['id'],
+                    limit=settings.conversation_history_limit
+                )
+                # Cache the result
+                await cache.set_cached_conversation_history(
+                    conversation['id'], 
+                    history, 
+                    ttl=settings.redis_ttl_conversation_history
+                )
+            else:
+                span.outcome = "hit"
+                logger.info("Cache hit for conversation history")
         
-        if history is None:
-            logger.info("Cache miss for conversation history - fetching from DB")
-            history = await supabase_client.get_recent_messages(conversation['id'], limit=10)
-            # Cache the result
-            await cache.set_cached_conversation_history(
-                conversation['id'], 
-                history, 
-                ttl=settings.redis_ttl_conversation_history
+        # Fit summary + recent turns into the token budget; turns that fall
+        # out of it are summarised in the background
+        with stage("context"):
+            summary = await conversation_summarizer.get(conversation)
+            context = context_builder.build(SYSTEM_PROMPT, message_text, history, summary, batch_sids=[m.sid for m in stored])
+            conversation_summarizer.schedule(conversation_id, summary, context.unsummarized)
+        
+        # Conversations with an order in flight always get a fresh answer
+        has_order_state = await cache.conversation_has_order_state(conversation_id)
+        with stage("llm"):
+            response_text = await run_agent(
+                message_text,
+                message_history=history,
+                use_cache=not has_order_state and not coalesced,
+                context=context
             )
-        else:
-            logger.info("Cache hit for conversation history")
+        logger.info("AI response generated (%d chars)", len(response_text))
         
-        response_text = await run_agent(message_text, message_history=history)
-        logger.info(f"AI response generated: {response_text[:100]}...")
+        if lease is not None and lease.lost:
+            # Another worker may be answering this customer by now; its
+            # history includes the messages stored above
+            logger.warning("Lease on %s lost while answering %s, not replying", clean_number, ', '.join(message_sids))
+            stage_seconds.observe(time.perf_counter() - started_at, stage="total", outcome="lease_lost")
+            return
         
-        # Check for order details in the response
-        order_match = re.search(r'<ORDER_DETAILS>(.*?)</ORDER_DETAILS>', response_text, re.DOTALL)
-        if order_match:
-            try:
-                order_json_str = order_match.group(1).strip()
-                logger.info(f"Found order details: {order_json_str}")
-                order_details = json.loads(order_json_str)
-                
-                # Create order in Supabase
-                await supabase_client.create_order(
-                    customer_id=customer_id,
-                    items=order_details.get('items', []),
-                    total=order_details.get('total', 0)
-                )
-                
-                # Remove the tag from the response sent to the user
-                response_text = re.sub(r'<ORDER_DETAILS>.*?</ORDER_DETAILS>', '', response_text, flags=re.DOTALL).strip()
-                
-            except Exception as e:
-                logger.error(f"Error processing order details: {str(e)}")
-                # We don't stop the response, just log the error
-
+        # Queue any confirmed order; the outbox inserts it in the background,
+        # keyed on the MessageSid so it is only ever created once
+        with stage("order_extraction"):
+            response_text, order = extract_order(response_text)
+            if order is not None:
+                await order_outbox.add(stored[-1].sid, {
+                    'customer_id': customer_id,
+                    'conversation_id': conversation_id,
+                    'items': order['items'],
+                    'total': order['total']
+                })
+                await cache.mark_conversation_order_state(conversation_id)
         
         # 5. Store outbound message BEFORE sending (for reliability)
         logger.info("Storing outbound message")
-        await supabase_client.store_message(
-            conversation_id=conversation_id,
-            direction='outbound',
-            message_text=response_text,
-            sender_type='agent'
-        )
+        with stage("outbound_store"):
+            outbound = await supabase_client.store_message(
+                conversation_id=conversation_id,
+                direction='outbound',
+                message_text=response_text,
+                sender_type='agent'
+            )
         logger.info("Outbound message stored successfully")
         
-        # 6. Send response via Twilio
-        logger.info(f"Sending response to {clean_number}")
-        from services.whatsapp import whatsapp_client
-        await whatsapp_client.send_text_message(
-            to=clean_number,
-            message=response_text
-        )
+        # 6. Queue the response for Twilio (rate-limited, retried; the
+        # stored row is resent after a crash until it has a Twilio SID)
+        logger.info("Queueing response to %s", clean_number)
+        outbound_queue.send(clean_number, response_text, message_id=outbound['id'])
         
-        logger.info(f"✅ Complete! Customer {customer_id}, Conversation {conversation_id}, Response sent to {clean_number}")
-        
-        # Invalidate cache so next request gets fresh history including this new message
-        await cache.invalidate_conversation_cache(conversation_id)
+        logger.info("✅ Complete! Customer %s, Conversation %s, Response queued for %s", customer_id, conversation_id, clean_number)
+        stage_seconds.observe(time.perf_counter() - started_at, stage="total", outcome="ok")
         
     except Exception as e:
-        logger.error(f"❌ Error processing message: {str(e)}", exc_info=True)
+        logger.error("❌ Error processing message: %s", e, exc_info=True)
+        stage_seconds.observe(time.perf_counter() - started_at, stage="total", outcome="error")
         # Send user-friendly error message
-        try:
-            from services.whatsapp import whatsapp_client
-            await whatsapp_client.send_text_message(
-                to=clean_number,
-                message="Sorry, I'm having trouble right now. Please try again in a moment."
-            )
-        except Exception as send_error:
-            logger.error(f"Failed to send error message to user: {send_error}")
-    
+        outbound_queue.send(
+            clean_number,
+            "Sorry, I'm having trouble right now. Please try again in a moment."
+        )
+
+
+# Groups bursts of messages from one sender into a single agent call
+message_coalescer = InboundCoalescer(
+    window=settings.coalesce_window,
+    max_wait=settings.coalesce_max_wait,
+    max_messages=settings.coalesce_max_messages
+)
+
+# Background worker pool running process_message off the request path
+message_queue = MessageQueue(
+    handler=process_message,
+    workers=settings.queue_workers,
+    max_depth=settings.queue_max_depth,
+    name="message"
+)
+
+# Clients and background services, started by the lifespan
+container = ServiceContainer(message_queue, process_started_at=PROCESS_STARTED_AT)
+register_metrics(container)
+
+metrics.gauge(
+    "whatsapp_inbound_messages_total",
+    "Inbound messages and the agent calls (batches) that answered them",
+    lambda: {("messages",): message_coalescer.messages, ("batches",): message_coalescer.batches},
+    ["type"],
+    kind="counter"
+)
+metrics.gauge("whatsapp_queue_depth", "Jobs waiting or running in the message queue", lambda: {(): message_queue.depth})
+metrics.gauge(
+    "whatsapp_queue_jobs_total",
+    "Message queue jobs by result",
+    lambda: {
+        ("processed",): message_queue.stats()["processed"],
+        ("failed",): message_queue.stats()["failed"],
+        ("rejected",): message_queue.stats()["rejected"]
+    },
+    ["result"],
+    kind="counter"
+)
 
 if __name__ == "__main__":
     import uvicorn
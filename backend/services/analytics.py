@@ -0,0 +1,189 @@
+"""
+Running aggregates for the dashboard.
+Counters (messages, orders, order value, new customers, conversations
+started and closed) are incremented in memory as the pipeline stores rows,
+and flushed as per-day deltas into the compact daily_stats table through
+the add_daily_stats RPC. The RPC adds rather than overwrites, so any
+number of workers can flush. The dashboard reads one cached summary
+computed from daily_stats, so its cost does not grow with the size of
+the orders, conversations and customers tables.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Optional
+from config import settings
+from services.cache import cache
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = (
+    "messages_inbound",
+    "messages_outbound",
+    "orders",
+    "order_value",
+    "new_customers",
+    "conversations_started",
+    "conversations_closed",
+)
+# Summed for the dashboard but maintained in the DB: revenue (confirmed,
+# shipped and delivered orders) follows order status changes
+SUMMARY_COUNTERS = COUNTERS + ("revenue",)
+MONEY_COUNTERS = ("order_value", "revenue")
+SUMMARY_KEY = "analytics:summary"
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def _growth(current: float, previous: float) -> float:
+    """Percent change from previous to current (0 when there is no baseline)."""
+    if not previous:
+        return 0.0
+    return round((current - previous) / previous * 100, 1)
+
+
+class DailyStats:
+    """In-memory per-day counter deltas, flushed to daily_stats in the background."""
+
+    def __init__(self, flush_interval: float = 10.0, cache_ttl: int = 30):
+        """
+        Args:
+            flush_interval: Seconds between flushes of the pending deltas
+            cache_ttl: Seconds a computed summary is served from cache
+        """
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        # day (UTC, ISO) -> counter -> delta not yet flushed
+        self._pending: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+        self._summary_lock = asyncio.Lock()
+
+        # Stats
+        self.flushes = 0
+        self.flush_errors = 0
+        self.summaries_computed = 0
+
+    def record(self, **deltas: float):
+        """
+        Add to today's counters (keyword names from COUNTERS).
+
+        Example:
+            daily_stats.record(orders=1, order_value=1250)
+        """
+        day = self._pending[_today()]
+        for counter, amount in deltas.items():
+            if counter not in COUNTERS:
+                raise ValueError(f"Unknown daily counter: {counter}")
+            day[counter] += amount
+
+    def start(self, db):
+        """
+        Start flushing.
+
+        Args:
+            db: SupabaseClient used to write deltas and read the summary
+        """
+        self._db = db
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop(), name="daily-stats-flush")
+
+    async def stop(self):
+        """Flush what is pending and stop."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._db is not None:
+            await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """
+        Write pending deltas in one round trip.
+
+        Returns:
+            False if the write failed (the deltas are kept for the next flush)
+        """
+        if not self._pending:
+            return True
+        pending, self._pending = self._pending, defaultdict(lambda: defaultdict(float))
+        rows = [{'day': day, **counters} for day, counters in pending.items()]
+        try:
+            await self._db.add_daily_stats(rows)
+            self.flushes += 1
+            return True
+        except Exception as e:
+            self.flush_errors += 1
+            logger.error("Daily stats flush failed, keeping %d day(s) of deltas: %s", len(rows), e)
+            for day, counters in pending.items():
+                for counter, amount in counters.items():
+                    self._pending[day][counter] += amount
+            return False
+
+    async def summary(self) -> Dict[str, Any]:
+        """
+        Dashboard figures: totals, today, this and last calendar month, and
+        month-over-month growth. Served from cache for cache_ttl seconds.
+        """
+        cached = await cache.get(SUMMARY_KEY)
+        if cached is not None:
+            return cached
+        # One computation per worker when the cached summary expires
+        async with self._summary_lock:
+            cached = await cache.get(SUMMARY_KEY)
+            if cached is not None:
+                return cached
+            summary = await self._compute(datetime.now(timezone.utc).date())
+            await cache.set(SUMMARY_KEY, summary, ttl=self.cache_ttl)
+            self.summaries_computed += 1
+            return summary
+
+    async def _compute(self, today: date) -> Dict[str, Any]:
+        periods = await self._db.get_daily_stats_summary(today)
+        totals = periods['totals']
+        this_month = periods['this_month']
+        last_month = periods['last_month']
+        return {
+            'as_of': datetime.now(timezone.utc).isoformat(),
+            'active_conversations': int(totals['conversations_started'] - totals['conversations_closed']),
+            'totals': totals,
+            'today': periods['today'],
+            'this_month': this_month,
+            'last_month': last_month,
+            'growth': {
+                counter: _growth(this_month[counter], last_month[counter])
+                for counter in ('revenue', 'order_value', 'orders', 'new_customers', 'conversations_started')
+            },
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_days": len(self._pending),
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "summaries_computed": self.summaries_computed,
+        }
+
+
+# Global dashboard aggregates
+daily_stats = DailyStats(
+    flush_interval=settings.analytics_flush_interval,
+    cache_ttl=settings.analytics_cache_ttl
+)
+
+metrics.gauge(
+    "whatsapp_analytics_flushes_total",
+    "Daily stats flushes, by result",
+    lambda: {("ok",): daily_stats.flushes, ("error",): daily_stats.flush_errors},
+    ["result"],
+    kind="counter"
+)
@@ -1,75 +1,382 @@
 """
-Simple In-Memory Cache.
-Replaces Redis with a local dictionary for zero-setup caching.
+Two-tier cache.
+L1 is a per-process dictionary bounded by entry count and an approximate
+byte budget, with LRU eviction and an amortised sweep of expired keys.
+With REDIS_ENABLED, a shared Redis L2 sits behind it, and writes publish
+invalidations so other workers drop their L1 copies. Without Redis the
+cache is L1 only (zero setup).
 """
+import sys
 import time
+import heapq
 import logging
-from typing import Optional, Any, Dict, List
+from collections import OrderedDict, defaultdict
+from typing import Optional, Any, Dict, List, Tuple
 from config import settings
+from services.metrics import metrics
+from services.redis_client import RedisCache
 
 logger = logging.getLogger(__name__)
 
-class InMemoryCache:
+# Expired keys removed per write, keeps the sweep cost amortised
+SWEEP_BATCH = 64
+
+
+def _prefix(key: str) -> str:
+    """Stats bucket for a key, e.g. 'conversation:history:<id>' -> 'conversation:history'."""
+    return key.rsplit(':', 1)[0] if ':' in key else key
+
+
+def _estimate_size(value: Any) -> int:
+    """Rough in-memory size of a JSON-like value in bytes."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_estimate_size(k) + _estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(_estimate_size(v) for v in value)
+    return size
+
+
+class CacheHelpers:
+    """Domain-specific helpers shared by every cache tier (needs get/set/delete)."""
+
+    async def get_cached_conversation_history(self, conversation_id: str) -> Optional[List[Dict]]:
+        return await self.get(f"conversation:history:{conversation_id}")
+
+    async def set_cached_conversation_history(self, conversation_id: str, messages: List[Dict], ttl: int = 300):
+        await self.set(f"conversation:history:{conversation_id}", messages, ttl)
+
+    async def append_conversation_history(self, conversation_id: str, message: Dict, max_messages: int = 10, ttl: int = 300) -> bool:
+        """
+        Append a newly stored message to the cached history window.
+        Only extends a window that is already cached; a cold conversation is
+        loaded from the DB on its next read instead.
+        """
+        key = f"conversation:history:{conversation_id}"
+        history = await self.get(key)
+        if history is None:
+            return False
+        return await self.set(key, (history + [message])[-max_messages:], ttl)
+
+    async def invalidate_conversation_cache(self, conversation_id: str):
+        await self.delete(f"conversation:history:{conversation_id}")
+
+    async def get_cached_active_conversation(self, whatsapp_number: str) -> Optional[Dict]:
+        return await self.get(f"conversation:active:{whatsapp_number}")
+
+    async def set_cached_active_conversation(self, whatsapp_number: str, resolved: Dict, ttl: int = 1800):
+        await self.set(f"conversation:active:{whatsapp_number}", resolved, ttl)
+
+    async def invalidate_active_conversation(self, whatsapp_number: str):
+        await self.delete(f"conversation:active:{whatsapp_number}")
+
+    async def conversation_has_order_state(self, conversation_id: str) -> bool:
+        return bool(await self.get(f"conversation:order:{conversation_id}"))
+
+    async def mark_conversation_order_state(self, conversation_id: str, ttl: int = 86400):
+        await self.set(f"conversation:order:{conversation_id}", True, ttl)
+
+    async def get_cached_conversation_summary(self, conversation_id: str) -> Optional[Dict]:
+        return await self.get(f"conversation:summary:{conversation_id}")
+
+    async def set_cached_conversation_summary(self, conversation_id: str, summary: Dict, ttl: int = 86400):
+        await self.set(f"conversation:summary:{conversation_id}", summary, ttl)
+
+    async def evict_conversation(self, conversation_id: str, whatsapp_number: str):
+        """Drop everything cached for a conversation that has been closed."""
+        await self.delete(f"conversation:active:{whatsapp_number}")
+        for kind in ("history", "order", "summary"):
+            await self.delete(f"conversation:{kind}:{conversation_id}")
+
+    async def get_cached_customer(self, whatsapp_number: str) -> Optional[Dict]:
+        return await self.get(f"customer:{whatsapp_number}")
+
+    async def set_cached_customer(self, whatsapp_number: str, customer: Dict, ttl: int = 1800):
+        await self.set(f"customer:{whatsapp_number}", customer, ttl)
+
+
+class InMemoryCache(CacheHelpers):
     """
-    Simple in-memory cache using a dictionary.
+    In-memory LRU cache with TTL expiry.
     Data is lost when the application restarts.
     """
-    
-    def __init__(self):
-        self._cache: Dict[str, Dict[str, Any]] = {}
-        logger.info("✅ In-Memory Cache initialized (Local RAM)")
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024):
+        """
+        Args:
+            max_entries: Maximum number of keys held
+            max_bytes: Approximate memory budget for cached values
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> {'value', 'expires_at', 'size'}, least recently used first
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # (expires_at, key) min-heap; entries go stale when a key is rewritten
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._bytes = 0
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+        )
+        logger.info("✅ In-Memory Cache initialized (Local RAM, max %d keys / %d MB)", max_entries, max_bytes // (1024 * 1024))
 
     async def get(self, key: str) -> Optional[Any]:
         """Get value from cache if not expired."""
-        if key not in self._cache:
+        item = self._cache.get(key)
+        if item is None:
+            self._stats[_prefix(key)]['misses'] += 1
             return None
-            
-        item = self._cache[key]
-        
+
         # Check expiration
         if item['expires_at'] < time.time():
-            del self._cache[key]
+            self._remove(key)
+            self._stats[_prefix(key)]['expirations'] += 1
+            self._stats[_prefix(key)]['misses'] += 1
             return None
-            
+
+        self._cache.move_to_end(key)
+        self._stats[_prefix(key)]['hits'] += 1
         return item['value']
 
     async def set(self, key: str, value: Any, ttl: int = 300) -> bool:
         """Set value in cache with TTL (seconds)."""
         try:
+            now = time.time()
+            self._sweep(now)
+
+            if key in self._cache:
+                self._remove(key)
+
+            expires_at = now + ttl
+            size = _estimate_size(value)
             self._cache[key] = {
                 'value': value,
-                'expires_at': time.time() + ttl
+                'expires_at': expires_at,
+                'size': size
             }
+            self._bytes += size
+            heapq.heappush(self._expiry_heap, (expires_at, key))
+
+            self._evict()
             return True
         except Exception as e:
-            logger.error(f"Cache set error: {e}")
+            logger.error("Cache set error: %s", e)
             return False
 
     async def delete(self, key: str) -> bool:
         """Delete value from cache."""
         if key in self._cache:
-            del self._cache[key]
+            self._remove(key)
             return True
         return False
 
-    # Domain-specific helpers (Same interface as before)
-    
-    async def get_cached_conversation_history(self, conversation_id: str) -> Optional[List[Dict]]:
-        return await self.get(f"conversation:history:{conversation_id}")
+    def clear(self):
+        """Drop every key (stats are kept)."""
+        self._cache.clear()
+        self._expiry_heap.clear()
+        self._bytes = 0
 
-    async def set_cached_conversation_history(self, conversation_id: str, messages: List[Dict], ttl: int = 300):
-        await self.set(f"conversation:history:{conversation_id}", messages, ttl)
+    def stats(self) -> Dict[str, Any]:
+        """Hits, misses, evictions and size, overall and per key prefix."""
+        prefixes: Dict[str, Dict[str, int]] = {
+            prefix: {**counters, 'entries': 0, 'bytes': 0}
+            for prefix, counters in self._stats.items()
+        }
+        for key, item in self._cache.items():
+            bucket = prefixes.setdefault(
+                _prefix(key),
+                {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'entries': 0, 'bytes': 0}
+            )
+            bucket['entries'] += 1
+            bucket['bytes'] += item['size']
 
-    async def invalidate_conversation_cache(self, conversation_id: str):
-        await self.delete(f"conversation:history:{conversation_id}")
+        hits = sum(p['hits'] for p in prefixes.values())
+        misses = sum(p['misses'] for p in prefixes.values())
+        return {
+            'entries': len(self._cache),
+            'bytes': self._bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else 0.0,
+            'evictions': sum(p['evictions'] for p in prefixes.values()),
+            'prefixes': prefixes
+        }
 
-    async def get_cached_customer(self, whatsapp_number: str) -> Optional[Dict]:
-        return await self.get(f"customer:{whatsapp_number}")
+    def _remove(self, key: str):
+        item = self._cache.pop(key)
+        self._bytes -= item['size']
+
+    def _evict(self):
+        """Drop least recently used keys until within both limits."""
+        while self._cache and (len(self._cache) > self.max_entries or self._bytes > self.max_bytes):
+            key, item = self._cache.popitem(last=False)
+            self._bytes -= item['size']
+            self._stats[_prefix(key)]['evictions'] += 1
+
+    def _sweep(self, now: float):
+        """Remove up to SWEEP_BATCH expired keys from the front of the expiry heap."""
+        for _ in range(SWEEP_BATCH):
+            if not self._expiry_heap or self._expiry_heap[0][0] >= now:
+                break
+            expires_at, key = heapq.heappop(self._expiry_heap)
+            item = self._cache.get(key)
+            # Skip stale heap entries for keys that were rewritten or removed
+            if item is not None and item['expires_at'] == expires_at:
+                self._remove(key)
+                self._stats[_prefix(key)]['expirations'] += 1
+
+        # Rewrites leave stale heap entries behind; rebuild if they pile up
+        if len(self._expiry_heap) > 2 * len(self._cache) + SWEEP_BATCH:
+            self._expiry_heap = [(item['expires_at'], key) for key, item in self._cache.items()]
+            heapq.heapify(self._expiry_heap)
+
+
+class TieredCache(CacheHelpers):
+    """
+    Per-worker L1 (InMemoryCache) in front of a shared Redis L2.
+    Reads fall through to L2 and fill L1; writes go to both tiers and tell
+    other workers to drop their L1 copy. L1 entries live at most l1_ttl
+    seconds, which bounds staleness if an invalidation is ever missed.
+    """
+
+    def __init__(self, l1: InMemoryCache, l2: Optional[RedisCache] = None, l1_ttl: int = 30):
+        """
+        Args:
+            l1: In-process cache
+            l2: Shared Redis cache (None for L1 only)
+            l1_ttl: Maximum L1 lifetime of a key while L2 is enabled
+        """
+        self.l1 = l1
+        self.l2 = l2
+        self.l1_ttl = l1_ttl
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.invalidations_received = 0
+
+    @property
+    def shared(self) -> bool:
+        return self.l2 is not None and self.l2.enabled
+
+    async def start(self):
+        """Subscribe to invalidations from other workers."""
+        if self.shared:
+            self.l2.subscribe(self._on_invalidate, self._on_reconnect)
+            logger.info("✅ Redis L2 cache enabled with pub/sub invalidation")
+
+    async def close(self):
+        if self.l2 is not None:
+            await self.l2.close()
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Get from L1, falling back to L2 (and filling L1 on a hit)."""
+        value = await self.l1.get(key)
+        if value is not None or not self.shared:
+            return value
+
+        found = await self.l2.get(key)
+        if found is None:
+            self.l2_misses += 1
+            return None
+        self.l2_hits += 1
+        value, remaining = found
+        await self.l1.set(key, value, ttl=min(self.l1_ttl, remaining) if remaining else self.l1_ttl)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: int = 300) -> bool:
+        """Set in both tiers with TTL (seconds)."""
+        if not self.shared:
+            return await self.l1.set(key, value, ttl)
+        await self.l1.set(key, value, min(ttl, self.l1_ttl))
+        return await self.l2.set(key, value, ttl)
+
+    async def delete(self, key: str) -> bool:
+        """Delete from both tiers."""
+        deleted = await self.l1.delete(key)
+        if self.shared:
+            deleted = await self.l2.delete(key) or deleted
+        return deleted
+
+    async def claim(self, key: str, ttl: int) -> Optional[bool]:
+        """
+        Atomically mark a key as taken across workers (Redis SET NX).
+
+        Returns:
+            True if newly claimed, False if already claimed, None if there
+            is no shared tier to claim in (or it is unreachable)
+        """
+        if not self.shared:
+            return None
+        return await self.l2.claim(key, ttl)
+
+    def clear(self):
+        """Drop every L1 key in this worker."""
+        self.l1.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """L1 stats (overall and per prefix) plus L2 hit counts."""
+        return {
+            **self.l1.stats(),
+            'l2': {
+                'enabled': self.shared,
+                'hits': self.l2_hits,
+                'misses': self.l2_misses,
+                'invalidations_received': self.invalidations_received,
+            }
+        }
+
+    async def _on_invalidate(self, keys: List[str]):
+        self.invalidations_received += 1
+        for key in keys:
+            await self.l1.delete(key)
+
+    async def _on_reconnect(self):
+        # Invalidations may have been missed while disconnected
+        self.l1.clear()
 
-    async def set_cached_customer(self, whatsapp_number: str, customer: Dict, ttl: int = 1800):
-        await self.set(f"customer:{whatsapp_number}", customer, ttl)
 
 # Global Cache instance
-# We keep the name 'redis_cache' temporarily to avoid breaking imports, 
-# or we can rename it. Let's rename it to 'cache' in the new file.
-cache = InMemoryCache()
+cache = TieredCache(
+    l1=InMemoryCache(
+        max_entries=settings.cache_max_entries,
+        max_bytes=settings.cache_max_bytes
+    ),
+    l2=RedisCache(
+        url=settings.redis_url,
+        channel=settings.cache_invalidation_channel
+    ) if settings.redis_enabled else None,
+    l1_ttl=settings.cache_l1_ttl
+)
+
+
+def _prefix_stat(field: str):
+    return lambda: {(prefix,): s[field] for prefix, s in cache.stats()['prefixes'].items()}
+
+
+metrics.gauge("whatsapp_cache_hits_total", "Cache hits by key prefix", _prefix_stat('hits'), ["prefix"], kind="counter")
+metrics.gauge("whatsapp_cache_misses_total", "Cache misses by key prefix", _prefix_stat('misses'), ["prefix"], kind="counter")
+metrics.gauge("whatsapp_cache_evictions_total", "LRU evictions by key prefix", _prefix_stat('evictions'), ["prefix"], kind="counter")
+metrics.gauge("whatsapp_cache_entries", "Cached keys by prefix", _prefix_stat('entries'), ["prefix"])
+metrics.gauge("whatsapp_cache_bytes", "Approximate cached bytes by prefix", _prefix_stat('bytes'), ["prefix"])
+metrics.gauge(
+    "whatsapp_cache_hit_ratio",
+    "Cache hit ratio by key prefix",
+    lambda: {
+        (prefix,): s['hits'] / (s['hits'] + s['misses']) if s['hits'] + s['misses'] else 0.0
+        for prefix, s in cache.stats()['prefixes'].items()
+    },
+    ["prefix"]
+)
+metrics.gauge(
+    "whatsapp_cache_l2_total",
+    "Redis L2 lookups after an L1 miss, by result",
+    lambda: {("hit",): cache.l2_hits, ("miss",): cache.l2_misses},
+    ["result"],
+    kind="counter"
+)
+metrics.gauge(
+    "whatsapp_cache_invalidations_received_total",
+    "Invalidation messages received from other workers",
+    lambda: {(): cache.invalidations_received},
+    kind="counter"
+)
@@ -0,0 +1,276 @@
+"""
+In-memory product catalog index.
+Token and trigram lookup over product name, description, tags and category
+with relevance ranking, so product searches skip the PostgREST round trip.
+Refreshed incrementally from the products table using updated_at.
+"""
+import re
+import asyncio
+import heapq
+import logging
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Relevance weight of a token by the field it came from
+FIELD_WEIGHTS = {
+    'name': 3.0,
+    'tags': 2.0,
+    'category': 2.0,
+    'subcategory': 1.5,
+    'description': 1.0,
+}
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'for', 'from', 'have', 'i', 'in', 'is', 'it', 'me',
+    'my', 'of', 'on', 'or', 'the', 'to', 'with', 'you', 'your', 'do', 'any',
+}
+
+# Fuzzy (trigram) matching thresholds
+MIN_SIMILARITY = 0.4
+MAX_FUZZY_EXPANSIONS = 5
+PREFIX_SIMILARITY = 0.8
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens with stopwords dropped and simple plurals folded."""
+    tokens = []
+    for token in _TOKEN.findall((text or '').lower()):
+        if token in STOPWORDS or len(token) < 2:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def trigrams(token: str) -> Set[str]:
+    """pg_trgm-style trigrams of a single token."""
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProductCatalog:
+    """Inverted token index plus trigram index over the token vocabulary."""
+
+    def __init__(self):
+        self._products: Dict[str, Dict[str, Any]] = {}
+        # token -> {product_id: weight}
+        self._postings: Dict[str, Dict[str, float]] = defaultdict(dict)
+        # product_id -> {token: weight}, used to unindex on update
+        self._product_tokens: Dict[str, Dict[str, float]] = {}
+        # trigram -> tokens containing it
+        self._trigrams: Dict[str, Set[str]] = defaultdict(set)
+        # sorted vocabulary for prefix lookups; rebuilt lazily
+        self._vocabulary: List[str] = []
+        self._vocabulary_dirty = False
+        # (updated_at, id) of the newest row seen, for incremental refresh
+        self._cursor: Optional[Tuple[str, str]] = None
+        self._task: Optional[asyncio.Task] = None
+        self.loaded = False
+        self.last_refresh_at: Optional[float] = None
+
+    @property
+    def size(self) -> int:
+        return len(self._products)
+
+    # -- indexing ------------------------------------------------------
+
+    def upsert(self, product: Dict[str, Any]):
+        """Index or re-index one product row; inactive products are removed."""
+        product_id = str(product['id'])
+        self.remove(product_id)
+        if not product.get('is_active', True):
+            return
+
+        weights: Dict[str, float] = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            value = product.get(field)
+            text = ' '.join(value) if isinstance(value, list) else value
+            for token in tokenize(text):
+                if weight > weights.get(token, 0.0):
+                    weights[token] = weight
+
+        self._products[product_id] = product
+        self._product_tokens[product_id] = weights
+        for token, weight in weights.items():
+            if token not in self._postings:
+                for gram in trigrams(token):
+                    self._trigrams[gram].add(token)
+                self._vocabulary_dirty = True
+            self._postings[token][product_id] = weight
+
+    def remove(self, product_id: str):
+        """Drop a product from the index."""
+        weights = self._product_tokens.pop(product_id, None)
+        if weights is None:
+            return
+        self._products.pop(product_id, None)
+        for token in weights:
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[token]
+                for gram in trigrams(token):
+                    self._trigrams[gram].discard(token)
+                self._vocabulary_dirty = True
+
+    # -- search --------------------------------------------------------
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Rank products against a free-text query.
+
+        Args:
+            query: Customer search text (typos are tolerated)
+            limit: Maximum results
+
+        Returns:
+            Product records, most relevant first
+        """
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return []
+
+        # Per query word: the vocabulary tokens it matches and their postings
+        terms = []
+        for query_token in dict.fromkeys(query_tokens):
+            postings = [
+                (similarity, self._postings[token])
+                for token, similarity in self._expand(query_token)
+                if token in self._postings
+            ]
+            if postings:
+                terms.append(postings)
+        if not terms:
+            return []
+
+        # Candidates come from the rarest word, so common words ("red") don't
+        # force a scan of most of the catalog; widen to any word if too few.
+        terms.sort(key=lambda postings: sum(len(p) for _, p in postings))
+        candidates = {pid for _, p in terms[0] for pid in p}
+        if len(candidates) < limit:
+            candidates = {pid for postings in terms for _, p in postings for pid in p}
+
+        ranked = []
+        for product_id in candidates:
+            score = 0.0
+            matched = 0
+            for postings in terms:
+                best = max((similarity * p.get(product_id, 0.0) for similarity, p in postings), default=0.0)
+                if best:
+                    score += best
+                    matched += 1
+            # Products matching more of the query's words rank first
+            ranked.append((matched, score, product_id))
+
+        top = heapq.nlargest(limit, ranked)
+        return [self._products[product_id] for _, _, product_id in top]
+
+    def _expand(self, query_token: str) -> List[Tuple[str, float]]:
+        """Vocabulary tokens matching a query token, with similarity in (0, 1]."""
+        if query_token in self._postings:
+            expansions = [(query_token, 1.0)]
+        else:
+            expansions = self._fuzzy(query_token)
+
+        # Prefix matches help partial words ("head" -> "headphone")
+        if len(query_token) >= 3:
+            vocabulary = self._sorted_vocabulary()
+            index = bisect_left(vocabulary, query_token)
+            seen = {token for token, _ in expansions}
+            while index < len(vocabulary) and vocabulary[index].startswith(query_token):
+                token = vocabulary[index]
+                if token not in seen:
+                    expansions.append((token, PREFIX_SIMILARITY))
+                index += 1
+        return expansions
+
+    def _fuzzy(self, query_token: str) -> List[Tuple[str, float]]:
+        query_grams = trigrams(query_token)
+        shared: Dict[str, int] = defaultdict(int)
+        for gram in query_grams:
+            for token in self._trigrams.get(gram, ()):
+                shared[token] += 1
+
+        candidates = []
+        for token, count in shared.items():
+            similarity = count / (len(query_grams) + len(trigrams(token)) - count)
+            if similarity >= MIN_SIMILARITY:
+                candidates.append((token, similarity))
+        return heapq.nlargest(MAX_FUZZY_EXPANSIONS, candidates, key=lambda c: c[1])
+
+    def _sorted_vocabulary(self) -> List[str]:
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+        return self._vocabulary
+
+    # -- refresh -------------------------------------------------------
+
+    async def refresh(self, db, page_size: int = 1000) -> int:
+        """
+        Pull products changed since the last refresh and re-index them.
+
+        Args:
+            db: SupabaseClient used to page through the products table
+            page_size: Rows per request
+
+        Returns:
+            Number of product rows applied
+        """
+        applied = 0
+        while True:
+            rows = await db.fetch_products_since(self._cursor, limit=page_size)
+            for row in rows:
+                self.upsert(row)
+            applied += len(rows)
+            if rows:
+                last = rows[-1]
+                self._cursor = (last['updated_at'], str(last['id']))
+            if len(rows) < page_size:
+                break
+
+        self.loaded = True
+        self.last_refresh_at = time.time()
+        if applied:
+            logger.info("Product catalog refreshed: %d rows applied, %d products indexed", applied, self.size)
+        return applied
+
+    def start(self, db, interval: int = 60):
+        """Load the catalog and keep refreshing it in the background."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop(db, interval), name="catalog-refresh")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh_loop(self, db, interval: int):
+        while True:
+            try:
+                await self.refresh(db)
+            except Exception as e:
+                logger.error("Product catalog refresh failed: %s", e)
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loaded": self.loaded,
+            "products": self.size,
+            "tokens": len(self._postings),
+            "last_refresh_at": self.last_refresh_at,
+        }
+
+
+# Global catalog index
+product_catalog = ProductCatalog()
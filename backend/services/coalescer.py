@@ -0,0 +1,151 @@
+"""
+Per-conversation coalescing of inbound message bursts.
+Customers often send several short messages in a row ("hi" / "do you
+have" / "red sneakers?"). Messages from the same sender that arrive while
+their batch is still open are added to it, and the whole batch is answered
+with a single agent call. A batch stays open until the sender has been
+quiet for the coalescing window (capped by a maximum wait) or until a
+worker starts processing it.
+"""
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+batch_size = metrics.histogram(
+    "whatsapp_inbound_batch_size",
+    "Inbound messages answered together by one agent call",
+    buckets=(1, 2, 3, 4, 5, 8, 13, 20)
+)
+
+
+@dataclass
+class InboundMedia:
+    """An attachment of an inbound message (Twilio MediaUrlN / MediaContentTypeN)."""
+    url: str
+    content_type: str
+
+
+@dataclass
+class InboundMessage:
+    """One inbound WhatsApp message."""
+    text: str
+    sid: str
+    media: List[InboundMedia] = field(default_factory=list)
+    received_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class MessageBatch:
+    """Messages from one sender that will be answered together."""
+    key: str
+    messages: List[InboundMessage] = field(default_factory=list)
+    opened_at: float = field(default_factory=time.monotonic)
+    closed: bool = False
+    # Times re-enqueued after its lease attempts ran out
+    requeues: int = 0
+
+    @property
+    def last_received_at(self) -> float:
+        return self.messages[-1].received_at
+
+
+class InboundCoalescer:
+    """Groups bursts of messages per sender into batches."""
+
+    def __init__(self, window: float = 1.0, max_wait: float = 4.0, max_messages: int = 10):
+        """
+        Args:
+            window: Seconds of quiet after the last message before a batch is answered
+            max_wait: Longest a batch waits for more messages after its first one
+            max_messages: Most messages in one batch
+        """
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        # Open (not yet processing) batch per sender
+        self._open: Dict[str, MessageBatch] = {}
+        self.batches = 0
+        self.messages = 0
+
+    def add(
+        self,
+        key: str,
+        text: str,
+        sid: str,
+        media: Optional[List[InboundMedia]] = None
+    ) -> Optional[MessageBatch]:
+        """
+        Add a message to the sender's open batch, or open a new one.
+
+        Args:
+            key: Sender (ordering key)
+            text: Message body
+            sid: Twilio MessageSid
+            media: Attachments, if any
+
+        Returns:
+            The new batch, which the caller must enqueue, or None if the
+            message joined a batch that is already queued
+        """
+        message = InboundMessage(text=text, sid=sid, media=media or [])
+        batch = self._open.get(key)
+        if (
+            batch is not None
+            and len(batch.messages) < self.max_messages
+            and message.received_at - batch.opened_at < self.max_wait
+        ):
+            batch.messages.append(message)
+            self.messages += 1
+            return None
+
+        # Full or too old: later messages start a batch queued behind it
+        batch = self._open[key] = MessageBatch(key=key, messages=[message])
+        self.batches += 1
+        self.messages += 1
+        return batch
+
+    def discard(self, batch: MessageBatch):
+        """Forget a batch that could not be enqueued."""
+        if self._open.get(batch.key) is batch:
+            del self._open[batch.key]
+        batch.closed = True
+        self.batches -= 1
+        self.messages -= len(batch.messages)
+
+    async def collect(self, batch: MessageBatch) -> List[InboundMessage]:
+        """
+        Wait until the sender has been quiet for the window (or max_wait
+        has passed), then close the batch and return its messages.
+        """
+        if batch.closed:
+            # Retried after a lease timeout; already collected
+            return batch.messages
+        while True:
+            now = time.monotonic()
+            quiet_at = batch.last_received_at + self.window
+            deadline = batch.opened_at + self.max_wait
+            if now >= quiet_at or now >= deadline or len(batch.messages) >= self.max_messages:
+                break
+            await asyncio.sleep(min(quiet_at, deadline) - now)
+
+        if self._open.get(batch.key) is batch:
+            del self._open[batch.key]
+        batch.closed = True
+        batch_size.observe(len(batch.messages))
+        if len(batch.messages) > 1:
+            logger.info("Coalesced %d messages from %s into one reply", len(batch.messages), batch.key)
+        return batch.messages
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_seconds": self.window,
+            "open_batches": len(self._open),
+            "batches": self.batches,
+            "messages": self.messages,
+            "agent_calls_saved": self.messages - self.batches,
+        }
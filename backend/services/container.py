@@ -0,0 +1,230 @@
+"""
+Service container for the app's lifespan.
+Owns the shared clients (Supabase, OpenRouter, Twilio, Redis) and the
+background services, and starts and stops them in dependency order. Before
+the app reports ready, a cheap warm-up request goes to each provider (for
+the LLM, a one-token completion), so imports, client construction and TLS
+handshakes are paid at deploy time instead of by the first customer. The
+app only reports ready once every warm-up has succeeded; failed ones are
+retried in the background. Startup phases and the time to the first reply
+are recorded as cold-start metrics.
+"""
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from config import settings
+from services.analytics import daily_stats
+from services.cache import cache
+from services.catalog import product_catalog
+from services.media import media_pipeline
+from services.metrics import metrics
+from services.outbound import outbound_queue
+from services.outbox import order_outbox
+from services.queue import MessageQueue
+from services.supabase import supabase_client
+from services.sweeper import conversation_sweeper
+from services.whatsapp import whatsapp_client
+from services.write_buffer import message_buffer
+from agents.router import client as llm_client, model_chain
+from agents.summarizer import conversation_summarizer
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceContainer:
+    """Starts, warms up and stops everything the webhook pipeline depends on."""
+
+    def __init__(self, message_queue: MessageQueue, process_started_at: float):
+        """
+        Args:
+            message_queue: Inbound worker pool (owned by main, which defines its handler)
+            process_started_at: monotonic() taken before the app's imports
+        """
+        self.db = supabase_client
+        self.llm = llm_client
+        self.whatsapp = whatsapp_client
+        self.message_queue = message_queue
+        self.process_started_at = process_started_at
+        self.ready = False
+        # Seconds since process start at the end of each startup phase
+        self.phases: Dict[str, float] = {}
+        self.warmup: Dict[str, Dict[str, Any]] = {}
+        self._rewarm: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Start background services, warm up dependencies, then report ready."""
+        self._mark("imports")
+
+        if settings.write_buffer_enabled:
+            message_buffer.start(self.db)
+        order_outbox.start(self.db)
+        await cache.start()
+        daily_stats.start(self.db)
+        self.message_queue.start()
+        outbound_queue.start(self.db)
+        if settings.media_enabled:
+            media_pipeline.start(self.db)
+        if settings.catalog_enabled:
+            product_catalog.start(self.db, interval=settings.catalog_refresh_interval)
+        if settings.sweeper_enabled:
+            conversation_sweeper.start(self.db)
+        self._mark("services")
+
+        if settings.warmup_enabled:
+            await self.warm_up()
+        self._mark("warmup")
+
+        failed = self.failed_warmups
+        if failed:
+            logger.warning("⚠️ Not ready, warm-up failed for %s; retrying", ', '.join(failed))
+            self._rewarm = asyncio.create_task(self._retry_warm_up(), name="warm-up-retry")
+            return
+        self.ready = True
+        logger.info(
+            "✅ Ready %.2fs after start (imports %.2fs, warm-up %.2fs)",
+            self.phases['warmup'],
+            self.phases['imports'],
+            self.phases['warmup'] - self.phases['services']
+        )
+
+    async def stop(self):
+        """Drain the pipeline and release connections."""
+        self.ready = False
+        if self._rewarm is not None:
+            self._rewarm.cancel()
+            await asyncio.gather(self._rewarm, return_exceptions=True)
+            self._rewarm = None
+        await product_catalog.stop()
+        await conversation_sweeper.stop()
+        await self.message_queue.stop(timeout=settings.queue_drain_timeout)
+        await outbound_queue.stop(timeout=settings.queue_drain_timeout)
+        await media_pipeline.stop(timeout=settings.queue_drain_timeout)
+        await conversation_summarizer.stop()
+        await order_outbox.stop()
+        await daily_stats.stop()
+        await message_buffer.stop()
+        await cache.close()
+        await self.whatsapp.close()
+        await self.llm.close()
+
+    @property
+    def failed_warmups(self) -> List[str]:
+        return [name for name, result in self.warmup.items() if not result["ok"]]
+
+    async def warm_up(self, names: Optional[List[str]] = None):
+        """
+        Send one cheap request to every dependency in parallel, so their
+        connection pools hold an open (TLS) connection before traffic
+        arrives. Failures are logged and recorded in self.warmup.
+
+        Args:
+            names: Only warm these dependencies (default: all of them)
+        """
+        await asyncio.gather(*(
+            self._warm(name, check) for name, check in self._checks()
+            if names is None or name in names
+        ))
+
+    async def _retry_warm_up(self):
+        """Retry failed warm-ups until all succeed, then report ready."""
+        while True:
+            await asyncio.sleep(settings.warmup_retry_interval)
+            await self.warm_up(self.failed_warmups)
+            if not self.failed_warmups:
+                self.ready = True
+                logger.info("✅ Ready %.2fs after start, warm-up retries succeeded", time.monotonic() - self.process_started_at)
+                return
+
+    def _checks(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+        checks = [
+            ("supabase", self.db.ping),
+            ("openrouter", self._complete_one_token),
+            ("twilio", self.whatsapp.ping),
+        ]
+        if cache.shared:
+            checks.append(("redis", self._ping_redis))
+        if settings.catalog_enabled:
+            checks.append(("catalog", self._catalog_loaded))
+        return checks
+
+    async def _complete_one_token(self):
+        """Smallest request on the completion path the agent uses."""
+        await self.llm.chat.completions.create(
+            model=model_chain.models[0],
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1
+        )
+
+    async def _warm(self, name: str, check: Callable[[], Awaitable[Any]]):
+        started_at = time.perf_counter()
+        error: Optional[str] = None
+        try:
+            await asyncio.wait_for(check(), timeout=settings.warmup_timeout)
+        except asyncio.TimeoutError:
+            error = f"timed out after {settings.warmup_timeout}s"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        if error:
+            logger.warning("⚠️ Warm-up of %s failed: %s", name, error)
+        self.warmup[name] = {
+            "ok": error is None,
+            "seconds": round(time.perf_counter() - started_at, 4),
+            "error": error,
+        }
+
+    @staticmethod
+    async def _ping_redis():
+        # RedisCache.ping reports failures instead of raising
+        if not await cache.l2.ping():
+            raise ConnectionError("no PING reply")
+
+    @staticmethod
+    async def _catalog_loaded():
+        while not product_catalog.loaded:
+            await asyncio.sleep(0.05)
+
+    def _mark(self, phase: str):
+        self.phases[phase] = time.monotonic() - self.process_started_at
+
+    @property
+    def first_reply_seconds(self) -> Optional[float]:
+        """Seconds from process start to the first reply Twilio accepted."""
+        if outbound_queue.first_sent_at is None:
+            return None
+        return outbound_queue.first_sent_at - self.process_started_at
+
+    def stats(self) -> Dict[str, Any]:
+        first_reply = self.first_reply_seconds
+        return {
+            "ready": self.ready,
+            "uptime_seconds": round(time.monotonic() - self.process_started_at, 1),
+            "cold_start": {
+                **{f"{phase}_seconds": round(value, 4) for phase, value in self.phases.items()},
+                "first_reply_seconds": round(first_reply, 4) if first_reply is not None else None,
+            },
+            "warmup": self.warmup,
+        }
+
+
+def register_metrics(container: ServiceContainer):
+    """Export readiness and cold-start timings for a container."""
+    def startup_seconds():
+        values = {(phase,): value for phase, value in container.phases.items()}
+        if container.first_reply_seconds is not None:
+            values[("first_reply",)] = container.first_reply_seconds
+        return values
+
+    metrics.gauge("whatsapp_ready", "1 once startup has finished and every warm-up succeeded", lambda: {(): int(container.ready)})
+    metrics.gauge(
+        "whatsapp_startup_seconds",
+        "Seconds from process start to the end of each startup phase, and to the first reply",
+        startup_seconds,
+        ["phase"]
+    )
+    metrics.gauge(
+        "whatsapp_warmup_seconds",
+        "Duration of each dependency's warm-up",
+        lambda: {(name,): result["seconds"] for name, result in container.warmup.items()},
+        ["dependency"]
+    )
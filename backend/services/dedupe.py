@@ -0,0 +1,103 @@
+"""
+Webhook idempotency.
+Remembers recently seen Twilio MessageSids so retried POSTs are dropped
+before any DB, LLM or Twilio work. Across restarts and workers this is
+backed up when the message is stored: a buffered row first claims its SID
+in Redis (SET NX), and without Redis the row is written directly so the
+UNIQUE constraint on messages.whatsapp_message_id rejects the retry.
+"""
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Dict
+from config import settings
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MessageDeduplicator:
+    """Bounded seen-set of message IDs with TTL expiry."""
+
+    def __init__(self, ttl: int = 3600, max_entries: int = 100000):
+        """
+        Args:
+            ttl: Seconds to remember a message ID
+            max_entries: Maximum IDs kept; the oldest are evicted first
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # message_sid -> expires_at, oldest first
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db_hits = 0
+
+    def check_and_mark(self, message_sid: str) -> bool:
+        """
+        Record a message ID and report whether it was already seen.
+
+        Args:
+            message_sid: Twilio MessageSid
+
+        Returns:
+            True if the ID is a duplicate, False if it is new
+        """
+        now = time.time()
+        self._expire(now)
+
+        expires_at = self._seen.get(message_sid)
+        if expires_at is not None and expires_at >= now:
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        self._seen[message_sid] = now + self.ttl
+        self._seen.move_to_end(message_sid)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+        return False
+
+    def forget(self, message_sid: str):
+        """Drop an ID so a retry of it is accepted (e.g. after a rejected enqueue)."""
+        self._seen.pop(message_sid, None)
+
+    def record_db_duplicate(self):
+        """Count a duplicate that slipped past memory and hit the DB constraint."""
+        self.db_hits += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and current size."""
+        return {
+            "size": len(self._seen),
+            "hits": self.hits,
+            "misses": self.misses,
+            "db_hits": self.db_hits,
+        }
+
+    def _expire(self, now: float):
+        # Entries are inserted in expiry order, so expired ones sit at the front
+        while self._seen:
+            sid, expires_at = next(iter(self._seen.items()))
+            if expires_at >= now:
+                break
+            del self._seen[sid]
+
+
+# Global deduplicator instance
+message_dedupe = MessageDeduplicator(
+    ttl=settings.dedupe_ttl,
+    max_entries=settings.dedupe_max_entries
+)
+
+metrics.gauge(
+    "whatsapp_dedupe_total",
+    "MessageSid dedupe lookups by result",
+    lambda: {
+        ("hit",): message_dedupe.hits,
+        ("miss",): message_dedupe.misses,
+        ("db_hit",): message_dedupe.db_hits
+    },
+    ["result"],
+    kind="counter"
+)
@@ -0,0 +1,213 @@
+"""
+Streaming exports of conversations and messages.
+Rows are read with keyset pagination on (created_at, id), one page at a
+time, and each page is encoded (NDJSON or CSV) and handed to the response
+before the next one is fetched. Memory use is bounded by the page size,
+however many rows are exported.
+"""
+import io
+import csv
+import json
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Exportable columns per table (also the default projection), in output order
+EXPORT_COLUMNS: Dict[str, List[str]] = {
+    'conversations': [
+        'id', 'customer_id', 'whatsapp_number', 'status', 'started_at', 'ended_at',
+        'last_message_at', 'message_count', 'agent_handled', 'resolution_type', 'created_at',
+    ],
+    'messages': [
+        'id', 'conversation_id', 'whatsapp_message_id', 'direction', 'sender_type',
+        'content_type', 'message_text', 'media_url', 'media_mime_type', 'intent',
+        'sent_at', 'created_at',
+    ],
+}
+# Equality filters accepted per table (besides since/until on created_at)
+EXPORT_FILTERS: Dict[str, List[str]] = {
+    'conversations': ['status', 'customer_id'],
+    'messages': ['conversation_id', 'customer_id', 'direction'],
+}
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+CURSOR_COLUMNS = ('created_at', 'id')
+
+exported_rows = metrics.counter(
+    "whatsapp_export_rows_total",
+    "Rows streamed by the export endpoints",
+    ["table", "format"]
+)
+
+
+class ExportError(ValueError):
+    """Invalid export request (unknown table, column, filter or format)."""
+
+
+def parse_columns(table: str, columns: Optional[str]) -> List[str]:
+    """
+    Validate a comma-separated projection against the table's allowlist.
+
+    Args:
+        table: conversations or messages
+        columns: e.g. "id,status,created_at", or None for all exportable columns
+
+    Returns:
+        Column names, in the requested order
+    """
+    if table not in EXPORT_COLUMNS:
+        raise ExportError(f"Unknown table: {table}")
+    if not columns:
+        return list(EXPORT_COLUMNS[table])
+    requested = [c.strip() for c in columns.split(',') if c.strip()]
+    unknown = [c for c in requested if c not in EXPORT_COLUMNS[table]]
+    if unknown:
+        raise ExportError(f"Unknown columns for {table}: {', '.join(unknown)}")
+    return requested
+
+
+def build_filters(
+    table: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    **equals: Optional[str]
+) -> Dict[str, Any]:
+    """
+    Collect the filters that were given, rejecting ones the table does not support.
+
+    Args:
+        table: conversations or messages
+        since: Only rows created at or after this time
+        until: Only rows created before this time
+        **equals: Equality filters (None means not given)
+
+    Returns:
+        Filters for SupabaseClient.fetch_page
+    """
+    filters: Dict[str, Any] = {}
+    for column, value in equals.items():
+        if value is None:
+            continue
+        if column not in EXPORT_FILTERS[table]:
+            raise ExportError(f"{table} cannot be filtered by {column}")
+        filters[column] = value
+    if since is not None:
+        filters['since'] = since
+    if until is not None:
+        filters['until'] = until
+    return filters
+
+
+async def iter_rows(
+    db,
+    table: str,
+    columns: List[str],
+    filters: Optional[Dict[str, Any]] = None,
+    page_size: int = 1000
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Yield a table's rows page by page in (created_at, id) order.
+
+    Args:
+        db: SupabaseClient
+        table: conversations or messages
+        columns: Projection; the cursor columns are fetched too but only
+            returned if requested
+        filters: See build_filters
+        page_size: Rows per query
+
+    Yields:
+        Lists of up to page_size rows
+    """
+    filters = dict(filters or {})
+    if table == 'messages' and 'customer_id' in filters:
+        # Messages have no customer_id; filter on the customer's conversations
+        customer_id = filters.pop('customer_id')
+        conversation_ids = [
+            row['id'] async for page in iter_rows(
+                db, 'conversations', ['id'], {'customer_id': customer_id}, page_size
+            ) for row in page
+        ]
+        if not conversation_ids:
+            return
+        filters['conversation_id'] = conversation_ids
+
+    select = columns + [c for c in CURSOR_COLUMNS if c not in columns]
+    extra = [c for c in CURSOR_COLUMNS if c not in columns]
+    cursor = None
+    while True:
+        rows = await db.fetch_page(table, select, cursor=cursor, limit=page_size, filters=filters)
+        if not rows:
+            return
+        last = rows[-1]
+        cursor = (last['created_at'], str(last['id']))
+        if extra:
+            rows = [{c: row.get(c) for c in columns} for row in rows]
+        yield rows
+        if len(rows) < page_size:
+            return
+
+
+def _csv_value(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+async def stream_export(
+    db,
+    table: str,
+    fmt: str,
+    columns: List[str],
+    filters: Optional[Dict[str, Any]] = None,
+    page_size: int = 1000
+) -> AsyncIterator[str]:
+    """
+    Encode an export as it is read, one chunk per page.
+
+    Args:
+        db: SupabaseClient
+        table: conversations or messages
+        fmt: ndjson or csv
+        columns: Projection (see parse_columns)
+        filters: See build_filters
+        page_size: Rows per query (and per chunk)
+
+    Yields:
+        Encoded chunks (CSV starts with a header row)
+    """
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown format: {fmt}")
+    count = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(columns)
+
+    try:
+        async for rows in iter_rows(db, table, columns, filters, page_size):
+            if writer is not None:
+                writer.writerows([_csv_value(row.get(c)) for c in columns] for row in rows)
+            else:
+                for row in rows:
+                    buffer.write(json.dumps(row, ensure_ascii=False, default=str))
+                    buffer.write('\n')
+            count += len(rows)
+            exported_rows.inc(len(rows), table=table, format=fmt)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            # CSV header of an empty export
+            yield buffer.getvalue()
+    except Exception as e:
+        # The status line is already sent; abort so the client sees a
+        # broken transfer rather than a silently short file
+        logger.error("Export of %s failed after %d rows: %s", table, count, e)
+        raise
+    logger.info("Exported %d %s as %s", count, table, fmt)
@@ -0,0 +1,270 @@
+"""
+Per-conversation leases.
+Only one worker, on any node, handles a given customer's messages at a
+time, so history reads, replies and customer/conversation creation never
+interleave. With Redis the lease is a key (SET NX PX) holding a random
+token; it is renewed while held, released only by its owner, and expires
+on its own if the holder dies. Without Redis it falls back to a lock per
+key in this process, which is all a single worker needs.
+"""
+import time
+import uuid
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, Optional
+from config import settings
+from services.cache import cache
+from services.metrics import dependencies, metrics
+
+logger = logging.getLogger(__name__)
+
+# Delete / extend the lease only if we still own it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Polling backoff while another node holds the lease
+MIN_POLL_INTERVAL = 0.02
+MAX_POLL_INTERVAL = 0.5
+
+lease_wait_seconds = metrics.histogram(
+    "whatsapp_lease_wait_seconds",
+    "Time spent waiting for a conversation lease, by backend and result",
+    ["backend", "result"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+lease_contended = metrics.counter(
+    "whatsapp_lease_contended_total",
+    "Lease acquisitions that had to wait for another holder",
+    ["backend"]
+)
+lease_timeouts = metrics.counter(
+    "whatsapp_lease_timeouts_total",
+    "Batches whose lease wait timed out, by what was done next (retried, requeued, dropped)",
+    ["action"]
+)
+lease_lost = metrics.counter(
+    "whatsapp_lease_lost_total",
+    "Leases that expired or were taken over while still held"
+)
+
+
+class LeaseTimeout(Exception):
+    """The lease could not be acquired within the wait timeout."""
+
+
+@dataclass
+class Lease:
+    """A held lease on one key."""
+    key: str
+    token: str = field(default_factory=lambda: uuid.uuid4().hex)
+    acquired_at: float = field(default_factory=time.monotonic)
+    # Set when Redis ownership was lost (expired or taken over) while held
+    lost: bool = False
+    # False if Redis was unreachable and only the local lock is held
+    distributed: bool = False
+
+
+class ConversationLeases:
+    """Mutual exclusion per conversation key across workers and nodes."""
+
+    def __init__(
+        self,
+        client=None,
+        ttl: float = 30.0,
+        wait_timeout: float = 60.0,
+        prefix: str = "lease:"
+    ):
+        """
+        Args:
+            client: redis.asyncio client (None for process-local locks only)
+            ttl: Seconds a lease survives without renewal (e.g. if its holder dies)
+            wait_timeout: Longest to wait for a lease before giving up
+            prefix: Redis key prefix
+        """
+        self.client = client
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.prefix = prefix
+        self.backend = "redis" if client is not None else "local"
+        # key -> (lock, holders + waiters), dropped when unused
+        self._local: Dict[str, Any] = {}
+        self._release = client.register_script(RELEASE_SCRIPT) if client is not None else None
+        self._renew = client.register_script(RENEW_SCRIPT) if client is not None else None
+        self.held = 0
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.degraded = 0
+        self.lost = 0
+
+    @asynccontextmanager
+    async def hold(self, key: str, wait_timeout: Optional[float] = None) -> AsyncIterator[Lease]:
+        """
+        Hold the lease on a key for the duration of the block.
+
+        Args:
+            key: Conversation key (the customer's WhatsApp number)
+            wait_timeout: Override of the default wait in seconds
+
+        Raises:
+            LeaseTimeout: If the lease is still held elsewhere after the wait
+        """
+        if wait_timeout is None:
+            wait_timeout = self.wait_timeout
+        started_at = time.perf_counter()
+        deadline = time.monotonic() + wait_timeout
+        lease = Lease(key=key)
+
+        # Local waiters queue on the lock, so at most one per process polls Redis
+        lock = self._local_lock(key)
+        waited = self._local[key][1] > 1
+        try:
+            await asyncio.wait_for(lock.acquire(), timeout=wait_timeout)
+        except asyncio.TimeoutError:
+            self._unref(key)
+            self._timed_out(key, started_at, wait_timeout)
+
+        renewal: Optional[asyncio.Task] = None
+        try:
+            if self.client is not None:
+                result = await self._acquire_remote(lease, deadline)
+                if result == "timeout":
+                    self._timed_out(key, started_at, wait_timeout)
+                waited = waited or result == "contended"
+                if lease.distributed:
+                    renewal = asyncio.create_task(self._keep_alive(lease), name=f"lease-renew:{key}")
+
+            result = "acquired" if lease.distributed or self.client is None else "degraded"
+            lease_wait_seconds.observe(time.perf_counter() - started_at, backend=self.backend, result=result)
+            if waited:
+                self.contended += 1
+                lease_contended.inc(backend=self.backend)
+            self.acquired += 1
+            self.held += 1
+            try:
+                yield lease
+            finally:
+                self.held -= 1
+        finally:
+            if renewal is not None:
+                renewal.cancel()
+                await asyncio.gather(renewal, return_exceptions=True)
+            if lease.distributed and not lease.lost:
+                await self._release_remote(lease)
+            lock.release()
+            self._unref(key)
+
+    async def _acquire_remote(self, lease: Lease, deadline: float) -> str:
+        """
+        Take the Redis lease, polling with backoff while someone else holds it.
+
+        Returns:
+            "free" or "contended" once held, "timeout" past the deadline, or
+            "degraded" if Redis failed (only the local lock is held then)
+        """
+        name = self.prefix + lease.key
+        interval = MIN_POLL_INTERVAL
+        contended = False
+        while True:
+            try:
+                with dependencies.track('redis'):
+                    ok = await self.client.set(name, lease.token, nx=True, px=int(self.ttl * 1000))
+            except Exception as e:
+                # Favour availability: carry on with per-process ordering only
+                self.degraded += 1
+                logger.error("Lease backend unavailable for %s, continuing with a local lock: %s", lease.key, e)
+                return "degraded"
+            if ok:
+                lease.distributed = True
+                lease.acquired_at = time.monotonic()
+                return "contended" if contended else "free"
+
+            contended = True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return "timeout"
+            await asyncio.sleep(min(remaining, interval * random.uniform(0.5, 1.5)))
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    async def _keep_alive(self, lease: Lease):
+        """Extend the lease every third of its TTL until cancelled."""
+        name = self.prefix + lease.key
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                with dependencies.track('redis'):
+                    renewed = await self._renew(keys=[name], args=[lease.token, int(self.ttl * 1000)])
+            except Exception as e:
+                # Try again next period; the TTL leaves room for two misses
+                logger.warning("Lease renewal failed for %s: %s", lease.key, e)
+                continue
+            if not renewed:
+                lease.lost = True
+                self.lost += 1
+                lease_lost.inc()
+                logger.warning("⚠️ Lost lease on %s after %.1fs", lease.key, time.monotonic() - lease.acquired_at)
+                return
+
+    async def _release_remote(self, lease: Lease):
+        try:
+            with dependencies.track('redis'):
+                await self._release(keys=[self.prefix + lease.key], args=[lease.token])
+        except Exception as e:
+            # It expires on its own after the TTL
+            logger.warning("Lease release failed for %s: %s", lease.key, e)
+
+    def _local_lock(self, key: str) -> asyncio.Lock:
+        entry = self._local.get(key)
+        if entry is None:
+            entry = self._local[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _unref(self, key: str):
+        entry = self._local[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._local[key]
+
+    def _timed_out(self, key: str, started_at: float, wait_timeout: float):
+        self.timeouts += 1
+        lease_wait_seconds.observe(time.perf_counter() - started_at, backend=self.backend, result="timeout")
+        raise LeaseTimeout(f"Lease on {key} still held after {wait_timeout:.0f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "held": self.held,
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "timeouts": self.timeouts,
+            "degraded": self.degraded,
+            "lost": self.lost,
+        }
+
+
+# Global lease manager (shares the cache's Redis connection pool)
+conversation_leases = ConversationLeases(
+    client=cache.l2.redis if cache.shared else None,
+    ttl=settings.lease_ttl,
+    wait_timeout=settings.lease_wait_timeout
+)
+
+metrics.gauge(
+    "whatsapp_leases_held",
+    "Conversation leases currently held by this process",
+    lambda: {(): conversation_leases.held}
+)
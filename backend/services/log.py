@@ -0,0 +1,182 @@
+"""
+Logging pipeline.
+Records are put on a queue by the calling thread and formatted and written
+by a background thread, so the event loop never waits on log I/O or on
+formatting. Output is one JSON object per line carrying the request's
+correlation id (the Twilio MessageSid), with phone numbers masked.
+INFO and DEBUG lines logged inside a request are sampled per request, so a
+sampled request keeps its whole trace; warnings and errors are always kept.
+"""
+import re
+import sys
+import json
+import zlib
+import queue
+import atexit
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional, Tuple
+from services.metrics import metrics
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'
+
+# Phone numbers (E.164-ish, with or without "whatsapp:"); not parts of
+# UUIDs, SIDs or other identifiers
+PHONE = re.compile(r'(?<![\w-])\+?\d{8,15}(?![\w-])')
+
+# (correlation id, whether this request's INFO/DEBUG lines are written)
+_correlation: ContextVar[Optional[Tuple[str, bool]]] = ContextVar("correlation", default=None)
+_sample_rate = 1.0
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# Stats
+records = {"queued": 0, "sampled_out": 0, "dropped": 0}
+
+
+def _mask_phone(match: "re.Match") -> str:
+    number = match.group(0)
+    return f"{'+' if number.startswith('+') else ''}…{number[-4:]}"
+
+
+def redact(text: str) -> str:
+    """Mask phone numbers, keeping the last four digits for support lookups."""
+    return PHONE.sub(_mask_phone, text)
+
+
+def bind_correlation_id(correlation_id: str):
+    """
+    Tag log records from the current task (and tasks it spawns) with an id.
+
+    Returns:
+        Token for _correlation.reset()
+    """
+    sampled = zlib.crc32(correlation_id.encode("utf-8")) / 2 ** 32 < _sample_rate
+    return _correlation.set((correlation_id, sampled))
+
+
+@contextmanager
+def correlation_scope(correlation_id: Optional[str]) -> Iterator[None]:
+    """Bind a correlation id for the duration of a block (no-op for None)."""
+    if correlation_id is None:
+        yield
+        return
+    token = bind_correlation_id(correlation_id)
+    try:
+        yield
+    finally:
+        _correlation.reset(token)
+
+
+def current_correlation_id() -> Optional[str]:
+    bound = _correlation.get()
+    return bound[0] if bound else None
+
+
+class ContextFilter(logging.Filter):
+    """Attaches the correlation id and samples (runs in the caller, which sees its context)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        bound = _correlation.get()
+        if bound is not None and not bound[1] and record.levelno < logging.WARNING:
+            records["sampled_out"] += 1
+            return False
+        record.correlation_id = bound[0] if bound else None
+        return True
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that defers formatting to the writer thread and never blocks."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Tracebacks cannot wait: render them while the frames still exist
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+            records["queued"] += 1
+        except queue.Full:
+            records["dropped"] += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with phone numbers masked."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+        }
+        correlation_id = getattr(record, "correlation_id", None)
+        if correlation_id:
+            entry["correlation_id"] = correlation_id
+        if record.exc_text:
+            entry["exception"] = redact(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RedactingFormatter(logging.Formatter):
+    """Human-readable lines for local development, with phone numbers masked."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "correlation_id"):
+            record.correlation_id = None
+        return redact(super().format(record))
+
+
+def setup_logging(level: str = "INFO", fmt: str = "json", sample_rate: float = 1.0, max_queue: int = 10000):
+    """
+    Route all logging through a queue to a background writer on stderr.
+
+    Args:
+        level: Root log level
+        fmt: "json" or "text"
+        sample_rate: Share of requests whose INFO/DEBUG lines are written
+        max_queue: Records buffered before new ones are dropped
+    """
+    global _listener, _sample_rate
+    _sample_rate = sample_rate
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if fmt == "json" else RedactingFormatter(TEXT_FORMAT))
+
+    records_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=max_queue)
+    handler = AsyncQueueHandler(records_queue)
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level))
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(records_queue, stream)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+metrics.gauge(
+    "whatsapp_log_records_total",
+    "Log records queued for writing, sampled out, or dropped because the queue was full",
+    lambda: {(result,): count for result, count in records.items()},
+    ["result"],
+    kind="counter"
+)
@@ -0,0 +1,346 @@
+"""
+Inbound media ingestion.
+Images, voice notes and documents arrive as Twilio media URLs. The webhook
+only records them on the message row; a bounded pool of workers then
+streams each file to local storage in fixed-size chunks (never holding a
+whole file in memory), hashing it on the way. Files are stored under their
+SHA-256, so the same file sent twice is kept once. When a download
+finishes, the message's media_url is pointed at the stored file. File
+writes run in a worker thread so they never stall the event loop, and
+redirects are followed by hand so every hop is checked against the
+allowed hosts.
+"""
+import os
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import tempfile
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+from urllib.parse import urlsplit
+import httpx
+from config import settings
+from services.coalescer import InboundMedia
+from services.log import correlation_scope, current_correlation_id
+from services.metrics import metrics
+from services.queue import MessageQueue
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+# Twilio answers with one redirect to its storage host
+MAX_REDIRECTS = 3
+
+download_seconds = metrics.histogram(
+    "whatsapp_media_download_seconds",
+    "Time to download and store one media file",
+    ["outcome"]
+)
+media_files = metrics.counter(
+    "whatsapp_media_files_total",
+    "Inbound media files by result (stored, duplicate, too_large, rejected, failed)",
+    ["result"]
+)
+media_bytes = metrics.counter(
+    "whatsapp_media_bytes_total",
+    "Bytes of inbound media downloaded"
+)
+
+
+def content_type_of(mime_type: str) -> str:
+    """Map a MIME type to messages.content_type (image, audio, video, document)."""
+    kind = mime_type.split('/', 1)[0].lower()
+    return kind if kind in ('image', 'audio', 'video') else 'document'
+
+
+def describe(media: List[InboundMedia]) -> str:
+    """Stand-in text for the agent when a message has media but no body."""
+    kinds = ', '.join(content_type_of(m.content_type) for m in media)
+    return f"[Customer sent: {kinds}]"
+
+
+class MediaTooLarge(Exception):
+    """The file is larger than the pipeline's size limit."""
+
+
+class MediaRejected(Exception):
+    """A redirect pointed outside the allowed hosts (or there were too many)."""
+
+
+@dataclass
+class MediaJob:
+    """The attachments of one stored message."""
+    message_id: str
+    media: List[InboundMedia]
+    queued_at: float = field(default_factory=time.monotonic)
+    correlation_id: Optional[str] = field(default_factory=current_correlation_id)
+
+
+class MediaPipeline:
+    """Streams inbound media to content-addressed local storage."""
+
+    def __init__(
+        self,
+        media_dir: str,
+        workers: int = 4,
+        max_depth: int = 500,
+        max_bytes: int = 16 * 1024 * 1024,
+        chunk_size: int = 64 * 1024,
+        timeout: float = 30.0,
+        allowed_hosts: Optional[List[str]] = None,
+        auth: Optional[tuple] = None
+    ):
+        """
+        Args:
+            media_dir: Root directory for stored files
+            workers: Concurrent downloads
+            max_depth: Messages queued or downloading before new ones are refused
+            max_bytes: Largest file accepted
+            chunk_size: Bytes read and written at a time
+            timeout: Per-request timeout (connect and between chunks)
+            allowed_hosts: Hosts media may be fetched from, including
+                redirect targets (the URLs come from the webhook form, so
+                anything else is refused)
+            auth: (account SID, auth token) for Twilio's media URLs
+        """
+        self.media_dir = media_dir
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.allowed_hosts: Set[str] = set(allowed_hosts or [])
+        self.auth = auth
+        self.queue = MessageQueue(handler=self._ingest, workers=workers, max_depth=max_depth, name="media")
+        self._client: Optional[httpx.AsyncClient] = None
+        self._db = None
+
+        # Stats
+        self.stored = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.bytes = 0
+
+    @property
+    def depth(self) -> int:
+        return self.queue.depth
+
+    def start(self, db):
+        """
+        Start the download workers.
+
+        Args:
+            db: SupabaseClient used to update message rows
+        """
+        self._db = db
+        os.makedirs(self.media_dir, exist_ok=True)
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                auth=self.auth,
+                timeout=self.timeout,
+                # Followed in _open, which checks each target's host
+                follow_redirects=False,
+                limits=httpx.Limits(max_connections=self.workers)
+            )
+        self.queue.start()
+
+    async def stop(self, timeout: float = 30.0):
+        """Finish queued downloads (up to timeout) and close connections."""
+        await self.queue.stop(timeout=timeout)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def allowed(self, url: str) -> bool:
+        parts = urlsplit(url)
+        return parts.scheme in ('https', 'http') and parts.hostname in self.allowed_hosts
+
+    def submit(self, message_id: str, media: List[InboundMedia]) -> bool:
+        """
+        Queue a stored message's attachments for download.
+
+        Args:
+            message_id: messages row to update
+            media: Attachments from the webhook
+
+        Returns:
+            False if the queue is full (the row keeps Twilio's URL)
+        """
+        accepted = [m for m in media if self.allowed(m.url)]
+        if len(accepted) < len(media):
+            media_files.inc(len(media) - len(accepted), result="rejected")
+            logger.warning("Refusing %d media URL(s) outside the allowed hosts", len(media) - len(accepted))
+        if not accepted:
+            return False
+        if not self.queue.enqueue(message_id, MediaJob(message_id=message_id, media=accepted)):
+            logger.warning("Media queue full, not downloading media of message %s (depth %d)", message_id, self.depth)
+            return False
+        return True
+
+    async def _ingest(self, job: MediaJob):
+        with correlation_scope(job.correlation_id):
+            await self._ingest_job(job)
+
+    async def _ingest_job(self, job: MediaJob):
+        stored: List[Dict[str, Any]] = []
+        for media in job.media:
+            started_at = time.perf_counter()
+            try:
+                record = await self._download(media)
+            except MediaRejected as e:
+                self.failed += 1
+                media_files.inc(result="rejected")
+                download_seconds.observe(time.perf_counter() - started_at, outcome="rejected")
+                logger.warning("Media of message %s refused: %s", job.message_id, e)
+                continue
+            except MediaTooLarge:
+                self.failed += 1
+                media_files.inc(result="too_large")
+                download_seconds.observe(time.perf_counter() - started_at, outcome="too_large")
+                logger.warning("Media of message %s is over %d bytes, not stored", job.message_id, self.max_bytes)
+                continue
+            except Exception as e:
+                self.failed += 1
+                media_files.inc(result="failed")
+                download_seconds.observe(time.perf_counter() - started_at, outcome="failed")
+                logger.error("Downloading media of message %s failed: %s", job.message_id, e)
+                continue
+            download_seconds.observe(time.perf_counter() - started_at, outcome="ok")
+            stored.append(record)
+
+        if not stored:
+            return
+        try:
+            await self._db.update_message(job.message_id, {
+                'media_url': stored[0]['path'],
+                'metadata': {'media': stored},
+            })
+        except Exception as e:
+            logger.error("Failed to record stored media of message %s: %s", job.message_id, e)
+
+    async def _download(self, media: InboundMedia) -> Dict[str, Any]:
+        """Stream one file to storage, retrying transient errors."""
+        attempt = 0
+        while True:
+            try:
+                return await self._stream_to_store(media)
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                attempt += 1
+                retryable = (
+                    not isinstance(e, httpx.HTTPStatusError)
+                    or e.response.status_code == 429
+                    or e.response.status_code >= 500
+                )
+                if not retryable or attempt >= MAX_ATTEMPTS:
+                    raise
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+    @asynccontextmanager
+    async def _open(self, url: str) -> AsyncIterator[httpx.Response]:
+        """
+        Stream a GET of url, following redirects only to allowed hosts.
+        Credentials are only sent to the host of the original URL.
+        """
+        origin = urlsplit(url).hostname
+        for _ in range(MAX_REDIRECTS + 1):
+            if not self.allowed(url):
+                raise MediaRejected(f"redirect to {urlsplit(url).hostname} is not allowed")
+            auth = httpx.USE_CLIENT_DEFAULT if urlsplit(url).hostname == origin else None
+            async with self._client.stream("GET", url, auth=auth) as response:
+                if not response.is_redirect:
+                    yield response
+                    return
+                url = str(response.next_request.url)
+        raise MediaRejected(f"more than {MAX_REDIRECTS} redirects")
+
+    async def _stream_to_store(self, media: InboundMedia) -> Dict[str, Any]:
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.media_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async with self._open(media.url) as response:
+                    response.raise_for_status()
+                    length = response.headers.get("content-length")
+                    if length is not None and int(length) > self.max_bytes:
+                        raise MediaTooLarge()
+                    mime_type = response.headers.get("content-type", media.content_type).split(';')[0].strip()
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise MediaTooLarge()
+                        digest.update(chunk)
+                        await asyncio.to_thread(f.write, chunk)
+
+            sha256 = digest.hexdigest()
+            extension = mimetypes.guess_extension(mime_type) or ""
+            relative = os.path.join(sha256[:2], sha256 + extension)
+            if await asyncio.to_thread(self._store, tmp_path, relative):
+                self.stored += 1
+                media_files.inc(result="stored")
+            else:
+                # Same content already stored
+                self.duplicates += 1
+                media_files.inc(result="duplicate")
+            self.bytes += size
+            media_bytes.inc(size)
+            return {
+                'path': relative,
+                'sha256': sha256,
+                'size': size,
+                'mime_type': mime_type,
+                'source_url': media.url,
+            }
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _store(self, tmp_path: str, relative: str) -> bool:
+        """Move a finished download into place; False if the content was already stored."""
+        path = os.path.join(self.media_dir, relative)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.queue.stats(),
+            "stored": self.stored,
+            "duplicates": self.duplicates,
+            "download_failures": self.failed,
+            "bytes": self.bytes,
+        }
+
+
+def _allowed_hosts() -> List[str]:
+    hosts = [h.strip() for h in settings.media_allowed_hosts.split(",") if h.strip()]
+    if settings.twilio_api_base_url:
+        # Local Twilio stand-in
+        hosts.append(urlsplit(settings.twilio_api_base_url).hostname)
+    return hosts
+
+
+# Global inbound media pipeline
+media_pipeline = MediaPipeline(
+    media_dir=settings.media_dir,
+    workers=settings.media_workers,
+    max_depth=settings.media_max_depth,
+    max_bytes=settings.media_max_bytes,
+    chunk_size=settings.media_chunk_size,
+    timeout=settings.media_timeout,
+    allowed_hosts=_allowed_hosts(),
+    auth=(settings.twilio_account_sid, settings.twilio_auth_token)
+)
+
+metrics.gauge(
+    "whatsapp_media_queue_depth",
+    "Messages whose media is queued or downloading",
+    lambda: {(): media_pipeline.depth}
+)
@@ -0,0 +1,326 @@
+"""
+Lightweight metrics for the message pipeline.
+Histograms, counters and callback gauges rendered in the Prometheus text
+exposition format, plus rolling per-dependency latency and error tracking.
+"""
+import time
+import asyncio
+import threading
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonically increasing counter with optional labels."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        return self._values.get(key, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative bucket histogram with optional labels."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label values -> [bucket counts..., sum, count]
+        self._series: Dict[LabelValues, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def series(self) -> Dict[LabelValues, Dict[str, float]]:
+        """Count, sum and estimated p50/p95/p99 for every label set."""
+        return {
+            key: {
+                "count": s[-1],
+                "sum": s[-2],
+                "mean": s[-2] / s[-1] if s[-1] else 0.0,
+                "p50": self._quantile(s, 0.50),
+                "p95": self._quantile(s, 0.95),
+                "p99": self._quantile(s, 0.99),
+            }
+            for key, s in sorted(self._series.items())
+        }
+
+    def _quantile(self, series: List[float], q: float) -> float:
+        """Estimate a quantile by linear interpolation inside buckets."""
+        total = series[-1]
+        if not total:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, series):
+            if count and cumulative + count >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return lower
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """
+    Metric whose samples are read from a callback at scrape time. Use
+    kind='counter' for totals that another component already keeps.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str],
+        callback: Callable[[], Dict[LabelValues, float]],
+        kind: str = "gauge"
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.callback().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds every metric and renders them for the /metrics route."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        callback: Callable[[], Dict[LabelValues, float]],
+        labelnames: Sequence[str] = (),
+        kind: str = "gauge"
+    ) -> Gauge:
+        return self._register(Gauge(name, help, labelnames, callback, kind))
+
+    def render(self) -> str:
+        """Render all metrics in Prometheus text format."""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+
+class Span:
+    """Timing span yielded by stage() and DependencyTracker.track()."""
+
+    __slots__ = ("name", "outcome", "started_at", "duration")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.outcome = "ok"
+        self.started_at = time.perf_counter()
+        self.duration = 0.0
+
+
+class DependencyTracker:
+    """Rolling latency and error-rate window per external dependency."""
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        # dependency -> deque of (finished_at, seconds, ok)
+        self._events: Dict[str, Deque[Tuple[float, float, bool]]] = {}
+        self._last_error: Dict[str, str] = {}
+
+    @contextmanager
+    def track(self, dependency: str) -> Iterator[Span]:
+        """
+        Time a call to a dependency. Exceptions, or setting span.outcome to
+        'error', count as failures. Cancelled calls are only observed with
+        outcome 'cancelled' and stay out of the error rate.
+        """
+        span = Span(dependency)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.outcome = "cancelled"
+            raise
+        except Exception as e:
+            span.outcome = "error"
+            self._last_error[dependency] = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            span.duration = time.perf_counter() - span.started_at
+            if span.outcome == "cancelled":
+                # Abandoned by the caller; says nothing about the dependency
+                dependency_seconds.observe(span.duration, dependency=dependency, outcome="cancelled")
+            else:
+                self.record(dependency, span.duration, span.outcome != "error")
+
+    def record(self, dependency: str, seconds: float, ok: bool):
+        events = self._events.get(dependency)
+        if events is None:
+            events = self._events[dependency] = deque(maxlen=self.window)
+        events.append((time.time(), seconds, ok))
+        dependency_seconds.observe(seconds, dependency=dependency, outcome="ok" if ok else "error")
+
+    def summary(self, dependency: str) -> Dict[str, Any]:
+        """Recent latency percentiles and error rate for a dependency."""
+        events = list(self._events.get(dependency, ()))
+        if not events:
+            return {"status": "unknown", "requests": 0}
+
+        latencies = sorted(e[1] for e in events)
+        errors = sum(1 for e in events if not e[2])
+        error_rate = errors / len(events)
+        result = {
+            "status": "degraded" if error_rate > 0.5 or not events[-1][2] else "ok",
+            "requests": len(events),
+            "error_rate": round(error_rate, 4),
+            "latency_ms_p50": round(_percentile(latencies, 0.50) * 1000, 1),
+            "latency_ms_p95": round(_percentile(latencies, 0.95) * 1000, 1),
+            "latency_ms_last": round(events[-1][1] * 1000, 1),
+            "last_seen_seconds_ago": round(time.time() - events[-1][0], 1),
+        }
+        if dependency in self._last_error:
+            result["last_error"] = self._last_error[dependency]
+        return result
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Span]:
+    """
+    Time a message pipeline stage into whatsapp_pipeline_stage_seconds.
+    Set span.outcome (e.g. 'hit'/'miss') to label the observation;
+    exceptions are labelled 'error' and cancellation 'cancelled'.
+    """
+    span = Span(name)
+    try:
+        yield span
+    except asyncio.CancelledError:
+        span.outcome = "cancelled"
+        raise
+    except Exception:
+        span.outcome = "error"
+        raise
+    finally:
+        span.duration = time.perf_counter() - span.started_at
+        stage_seconds.observe(span.duration, stage=name, outcome=span.outcome)
+
+
+# Global registry and core pipeline metrics
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram(
+    "whatsapp_pipeline_stage_seconds",
+    "Time spent in each message pipeline stage",
+    ["stage", "outcome"]
+)
+dependency_seconds = metrics.histogram(
+    "whatsapp_dependency_request_seconds",
+    "Latency of calls to external dependencies",
+    ["dependency", "outcome"]
+)
+llm_tokens = metrics.counter(
+    "whatsapp_llm_tokens_total",
+    "LLM tokens used, by type",
+    ["type"]
+)
+
+dependencies = DependencyTracker()
@@ -0,0 +1,362 @@
+"""
+Outbound delivery queue in front of the Twilio client.
+Replies are queued instead of sent inline. Workers send them in order per
+recipient, paced by a token bucket per sender number (Twilio limits
+messages per second per sender), and retry 429s, 5xx and network errors
+with exponential backoff and full jitter. Messages that cannot be sent are
+dead-lettered to a local file (and their rows marked failed). Replies are
+stored (delivery_status pending) before they are queued and marked sending
+just before the first attempt, so after a crash a periodic recovery pass
+resends stored rows that were never handed to Twilio, without repeating
+ones it may already have delivered.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Deque, Dict, Optional, Set
+import httpx
+from twilio.base.exceptions import TwilioRestException
+from config import settings
+from services.log import correlation_scope, current_correlation_id
+from services.metrics import metrics
+from services.queue import MessageQueue
+from services.whatsapp import whatsapp_client
+
+logger = logging.getLogger(__name__)
+
+# Margin on top of the longest queue wait (max_depth / rate) before a
+# pending row is taken to be lost rather than still queued on some node
+RECOVERY_GRACE = 120
+RECOVERY_INTERVAL = 60.0
+DEAD_LETTERS_KEPT = 100
+DEAD_LETTER_FILE = "dead.jsonl"
+
+delivery_seconds = metrics.histogram(
+    "whatsapp_outbound_delivery_seconds",
+    "Time from queueing a reply to Twilio accepting it (or giving up)",
+    ["outcome"]
+)
+outbound_messages = metrics.counter(
+    "whatsapp_outbound_messages_total",
+    "Outbound send attempts and results (sent, retried, dead, recovered, rejected)",
+    ["result"]
+)
+
+
+class TokenBucket:
+    """Token bucket; acquire() waits for a token."""
+
+    def __init__(self, rate: float, burst: int):
+        """
+        Args:
+            rate: Tokens added per second
+            burst: Bucket capacity
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.throttled_seconds = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            wait = (1 - self.tokens) / self.rate
+            self.throttled_seconds += wait
+            await asyncio.sleep(wait)
+
+
+@dataclass
+class OutboundMessage:
+    """A reply waiting to be sent."""
+    to: str
+    body: str
+    # Stored messages row, marked with the Twilio SID once sent
+    message_id: Optional[str] = None
+    queued_at: float = field(default_factory=time.monotonic)
+    # Request the reply answers, so worker logs stay correlated with it
+    correlation_id: Optional[str] = field(default_factory=current_correlation_id)
+
+
+class OutboundQueue:
+    """Rate-limited, retrying delivery of WhatsApp replies."""
+
+    def __init__(
+        self,
+        client,
+        workers: int = 8,
+        max_depth: int = 5000,
+        rate: float = 20.0,
+        burst: int = 40,
+        max_attempts: int = 6,
+        retry_delay: float = 0.5,
+        max_retry_delay: float = 20.0,
+        recovery_window: int = 900,
+        dead_letter_dir: Optional[str] = None
+    ):
+        """
+        Args:
+            client: WhatsAppClient used to send
+            workers: Concurrent sends
+            max_depth: Maximum replies queued or sending
+            rate: Messages per second per sender number
+            burst: Messages a sender number may send back to back
+            max_attempts: Sends tried before a reply is dead-lettered
+            retry_delay: Backoff base; attempt n waits up to retry_delay * 2^n
+            max_retry_delay: Upper bound on one backoff
+            recovery_window: Seconds back to look for stored-but-unsent replies
+                (at least the recovery grace plus two recovery intervals)
+            dead_letter_dir: Directory for the dead-letter file (None keeps
+                dead letters in memory only)
+        """
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # A full queue drains in max_depth / rate seconds
+        self.recovery_grace = RECOVERY_GRACE + max_depth / rate
+        self.recovery_window = max(recovery_window, self.recovery_grace + 2 * RECOVERY_INTERVAL)
+        self.dead_letter_dir = dead_letter_dir
+        # Keyed on the recipient so each customer's replies go out in order
+        self.queue = MessageQueue(handler=self._deliver, workers=workers, max_depth=max_depth, name="outbound")
+        self.buckets: Dict[str, TokenBucket] = {}
+        # Most recent dead letters, for /health (all of them are in the file)
+        self.dead_letters: Deque[Dict[str, Any]] = deque(maxlen=DEAD_LETTERS_KEPT)
+        # Serialises dead-letter writes, which run in a worker thread
+        self._write_lock = asyncio.Lock()
+        # Stored rows queued in this process, and rows it finished recently
+        # (their DB mark may land after a recovery query), so recovery
+        # does not queue them twice
+        self._queued_ids: Set[str] = set()
+        self._finished: Dict[str, float] = {}
+        self._db = None
+        self._recovery: Optional[asyncio.Task] = None
+
+        # Stats
+        self.sent = 0
+        self.retries = 0
+        self.dead = 0
+        self.recovered = 0
+        # monotonic() of the first reply Twilio accepted (cold-start tracking)
+        self.first_sent_at: Optional[float] = None
+
+    @property
+    def depth(self) -> int:
+        return self.queue.depth
+
+    def start(self, db):
+        """
+        Start the send workers and the recovery pass.
+
+        Args:
+            db: SupabaseClient used to mark sent rows and find unsent ones
+        """
+        self._db = db
+        if self.dead_letter_dir:
+            os.makedirs(self.dead_letter_dir, exist_ok=True)
+        self.queue.start()
+        if self._recovery is None:
+            self._recovery = asyncio.create_task(self._recover_loop(), name="outbound-recovery")
+
+    async def stop(self, timeout: float = 30.0):
+        """Send what is queued (up to timeout) and stop."""
+        if self._recovery is not None:
+            self._recovery.cancel()
+            await asyncio.gather(self._recovery, return_exceptions=True)
+            self._recovery = None
+        await self.queue.stop(timeout=timeout)
+
+    def send(self, to: str, body: str, message_id: Optional[str] = None) -> bool:
+        """
+        Queue a reply without waiting for Twilio.
+
+        Args:
+            to: Recipient's number (with or without the whatsapp: prefix)
+            body: Message text
+            message_id: Stored messages row for this reply, if any
+
+        Returns:
+            False if the queue is full (a stored reply is picked up by recovery later)
+        """
+        if message_id is not None and message_id in self._queued_ids:
+            return True
+        message = OutboundMessage(to=to, body=body, message_id=message_id)
+        if not self.queue.enqueue(to.replace('whatsapp:', ''), message):
+            outbound_messages.inc(result="rejected")
+            logger.warning("Outbound queue full, not sending to %s now (depth %s)", to, self.depth)
+            return False
+        if message_id is not None:
+            self._queued_ids.add(message_id)
+        return True
+
+    async def _deliver(self, message: OutboundMessage):
+        with correlation_scope(message.correlation_id):
+            await self._deliver_message(message)
+
+    async def _deliver_message(self, message: OutboundMessage):
+        try:
+            if message.message_id is not None:
+                # From here on recovery must not resend it: Twilio may accept
+                # the request even if we never hear back
+                await self._mark(message, {'delivery_status': 'sending'})
+            attempt = 0
+            while True:
+                await self._bucket(self.client.from_number).acquire()
+                try:
+                    result = await self.client.send_text_message(to=message.to, message=message.body)
+                except Exception as e:
+                    attempt += 1
+                    if not self._retryable(e) or attempt >= self.max_attempts:
+                        await self._dead_letter(message, e, attempt)
+                        return
+                    self.retries += 1
+                    outbound_messages.inc(result="retried")
+                    delay = random.uniform(0, min(self.max_retry_delay, self.retry_delay * 2 ** attempt))
+                    logger.warning("Send to %s failed (attempt %s), retrying in %.1fs: %s", message.to, attempt, delay, e)
+                    await asyncio.sleep(delay)
+                    continue
+
+                self.sent += 1
+                if self.first_sent_at is None:
+                    self.first_sent_at = time.monotonic()
+                outbound_messages.inc(result="sent")
+                delivery_seconds.observe(time.monotonic() - message.queued_at, outcome="sent")
+                if message.message_id is not None:
+                    await self._mark(message, {'whatsapp_message_id': result['message_sid'], 'delivery_status': 'sent'})
+                return
+        finally:
+            if message.message_id is not None:
+                self._queued_ids.discard(message.message_id)
+                self._finished[message.message_id] = time.monotonic()
+
+    @staticmethod
+    def _retryable(error: Exception) -> bool:
+        if isinstance(error, TwilioRestException):
+            return error.status == 429 or error.status >= 500
+        return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+    async def _dead_letter(self, message: OutboundMessage, error: Exception, attempts: int):
+        self.dead += 1
+        outbound_messages.inc(result="dead")
+        delivery_seconds.observe(time.monotonic() - message.queued_at, outcome="dead")
+        record = {
+            'message_id': message.message_id,
+            'to': message.to,
+            'body': message.body,
+            'attempts': attempts,
+            'error': str(error),
+            'failed_at': datetime.now(timezone.utc).isoformat(),
+        }
+        # /health shows the recent ones, without the reply text
+        self.dead_letters.append({k: v for k, v in record.items() if k != 'body'})
+        logger.error("❌ Giving up on reply to %s after %s attempt(s): %s", message.to, attempts, error)
+        if self.dead_letter_dir:
+            line = json.dumps(record, default=str) + "\n"
+            try:
+                async with self._write_lock:
+                    await asyncio.to_thread(self._write_dead_letter, line)
+            except Exception as e:
+                logger.error("Writing dead letter for %s failed: %s; record: %s", message.to, e, line.strip())
+        if message.message_id is not None:
+            await self._mark(message, {
+                'delivery_status': 'failed',
+                'metadata': {'delivery_error': str(error), 'attempts': attempts},
+            })
+
+    async def _mark(self, message: OutboundMessage, fields: Dict[str, Any]):
+        try:
+            await self._db.update_message(message.message_id, fields)
+        except Exception as e:
+            logger.error("Failed to record delivery of message %s: %s", message.message_id, e)
+
+    def _write_dead_letter(self, line: str):
+        with open(os.path.join(self.dead_letter_dir, DEAD_LETTER_FILE), "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def _bucket(self, sender: str) -> TokenBucket:
+        bucket = self.buckets.get(sender)
+        if bucket is None:
+            bucket = self.buckets[sender] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    async def _recover_loop(self):
+        while True:
+            try:
+                await self.recover()
+            except Exception as e:
+                logger.error("Outbound recovery failed: %s", e)
+            await asyncio.sleep(RECOVERY_INTERVAL)
+
+    async def recover(self) -> int:
+        """
+        Queue stored replies that were never sent (e.g. the process died
+        between storing and sending them).
+
+        Returns:
+            Number of replies queued
+        """
+        expired = time.monotonic() - self.recovery_window
+        self._finished = {k: t for k, t in self._finished.items() if t > expired}
+
+        now = datetime.now(timezone.utc)
+        unsent = await self._db.get_unsent_outbound(
+            since=now - timedelta(seconds=self.recovery_window),
+            until=now - timedelta(seconds=self.recovery_grace)
+        )
+        queued = 0
+        for row in unsent:
+            if row['id'] in self._queued_ids or row['id'] in self._finished:
+                continue
+            if self.send(row['to'], row['message_text'], message_id=row['id']):
+                queued += 1
+        if queued:
+            self.recovered += queued
+            outbound_messages.inc(queued, result="recovered")
+            logger.warning("Resending %s stored replies that were never sent", queued)
+        return queued
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.queue.stats(),
+            "sent": self.sent,
+            "retries": self.retries,
+            "dead": self.dead,
+            "recovered": self.recovered,
+            "recovery_grace_seconds": self.recovery_grace,
+            "throttled_seconds": round(sum(b.throttled_seconds for b in self.buckets.values()), 3),
+            "dead_letters": list(self.dead_letters)[-10:],
+        }
+
+
+# Global outbound delivery queue
+outbound_queue = OutboundQueue(
+    whatsapp_client,
+    workers=settings.outbound_workers,
+    max_depth=settings.outbound_max_depth,
+    rate=settings.outbound_rate,
+    burst=settings.outbound_burst,
+    max_attempts=settings.outbound_max_attempts,
+    retry_delay=settings.outbound_retry_delay,
+    max_retry_delay=settings.outbound_max_retry_delay,
+    recovery_window=settings.outbound_recovery_window,
+    dead_letter_dir=settings.outbound_dead_letter_dir
+)
+
+metrics.gauge(
+    "whatsapp_outbound_queue_depth",
+    "Replies queued or being sent",
+    lambda: {(): outbound_queue.depth}
+)
@@ -0,0 +1,320 @@
+"""
+Durable outbox for orders.
+Orders the agent confirms are appended to a local log and acknowledged
+straight away; a background worker inserts them through the place_order
+RPC, retrying with backoff. Each order carries the MessageSid it answers
+as its idempotency key, so retries and replays after a crash never create
+a second order. Orders that keep failing are moved to a dead-letter file.
+File writes (and their fsyncs) run in a worker thread, one at a time, so
+they never stall the event loop.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+from config import settings
+from services.log import correlation_scope
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LOG_FILE = "outbox.jsonl"
+DEAD_LETTER_FILE = "dead.jsonl"
+# Rewrite the log once this many lines belong to finished orders
+COMPACT_AFTER = 1000
+
+delivery_seconds = metrics.histogram(
+    "whatsapp_order_outbox_delivery_seconds",
+    "Time from an order entering the outbox to its insert being confirmed",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
+
+
+class OrderOutbox:
+    """Append-only order log drained by a background worker."""
+
+    def __init__(
+        self,
+        outbox_dir: str,
+        max_attempts: int = 10,
+        retry_delay: float = 1.0,
+        max_retry_delay: float = 300.0,
+        fsync: bool = True
+    ):
+        """
+        Args:
+            outbox_dir: Directory for the outbox log and dead-letter file
+            max_attempts: Inserts tried before an order is dead-lettered
+            retry_delay: Delay before the first retry; doubles per attempt
+            max_retry_delay: Upper bound on the retry delay
+            fsync: fsync each appended order (survives power loss, not
+                just a process crash)
+        """
+        self.outbox_dir = outbox_dir
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.fsync = fsync
+
+        # idempotency key -> entry (order, queued_at, attempts, next_attempt_at)
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        # Keys whose put record is being written
+        self._adding: Set[str] = set()
+        # Serialises log writes, which run in a worker thread
+        self._write_lock = asyncio.Lock()
+        self._log = None
+        self._log_lines = 0
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+        # Stats
+        self.queued = 0
+        self.delivered = 0
+        self.duplicates = 0
+        self.retries = 0
+        self.dead = 0
+        self.replayed = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._entries)
+
+    def start(self, db):
+        """
+        Reload undelivered orders from a previous run and start the worker.
+
+        Args:
+            db: SupabaseClient used to insert orders
+        """
+        if self._task is not None:
+            return
+        self._db = db
+        os.makedirs(self.outbox_dir, exist_ok=True)
+        self._replay()
+        self._compact(list(self._entries.items()))
+        self._task = asyncio.create_task(self._run(), name="order-outbox")
+        self._task.add_done_callback(self._worker_done)
+        logger.info("✅ Order outbox started (%d orders replayed)", self.replayed)
+
+    async def stop(self):
+        """Stop the worker; undelivered orders stay in the log for the next start."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        async with self._write_lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+        if self._entries:
+            logger.warning("Order outbox stopped with %d orders pending", len(self._entries))
+
+    @staticmethod
+    def _worker_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("❌ Order outbox worker crashed, orders are no longer delivered", exc_info=task.exception())
+
+    async def add(self, idempotency_key: str, order: Dict[str, Any]) -> bool:
+        """
+        Durably queue an order for insertion (returns once it is logged).
+
+        Args:
+            idempotency_key: MessageSid of the message that confirmed the order
+            order: create_order() arguments (customer_id, conversation_id, items, total)
+
+        Returns:
+            False if an order with this key is already queued
+        """
+        if idempotency_key in self._entries or idempotency_key in self._adding:
+            self.duplicates += 1
+            return False
+
+        queued_at = time.time()
+        self._adding.add(idempotency_key)
+        try:
+            await self._append({'op': 'put', 'key': idempotency_key, 'order': order, 'queued_at': queued_at})
+        finally:
+            self._adding.discard(idempotency_key)
+        self._entries[idempotency_key] = {
+            'order': order,
+            'queued_at': queued_at,
+            'attempts': 0,
+            'next_attempt_at': 0.0,
+        }
+        self.queued += 1
+        self._wakeup.set()
+        return True
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            due = [key for key, entry in self._entries.items() if entry['next_attempt_at'] <= now]
+            for key in due:
+                # The key is the MessageSid, i.e. the request's correlation id
+                with correlation_scope(key):
+                    await self._deliver(key)
+
+            if self._log_lines - len(self._entries) >= COMPACT_AFTER:
+                try:
+                    async with self._write_lock:
+                        await asyncio.to_thread(self._compact, list(self._entries.items()))
+                except Exception as e:
+                    logger.error("Compacting the order outbox failed: %s", e)
+
+            next_at = min((e['next_attempt_at'] for e in self._entries.values()), default=None)
+            timeout = None if next_at is None else max(0.0, next_at - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _deliver(self, key: str):
+        entry = self._entries[key]
+        try:
+            await self._db.create_order(idempotency_key=key, **entry['order'])
+        except Exception as e:
+            entry['attempts'] += 1
+            if entry['attempts'] >= self.max_attempts:
+                await self._dead_letter(key, entry, e)
+                return
+            self.retries += 1
+            delay = min(self.retry_delay * 2 ** (entry['attempts'] - 1), self.max_retry_delay)
+            entry['next_attempt_at'] = time.time() + delay * random.uniform(0.8, 1.2)
+            logger.warning("Order %s insert failed (attempt %d), retrying in %.0fs: %s", key, entry['attempts'], delay, e)
+            return
+
+        del self._entries[key]
+        self.delivered += 1
+        try:
+            await self._append({'op': 'done', 'key': key})
+        except Exception as e:
+            # The order is inserted; if it is replayed, its key stops a second one
+            logger.error("Recording delivery of order %s failed: %s", key, e)
+        delivery_seconds.observe(time.time() - entry['queued_at'])
+
+    async def _dead_letter(self, key: str, entry: Dict[str, Any], error: Exception):
+        record = json.dumps({
+            'key': key,
+            'order': entry['order'],
+            'queued_at': entry['queued_at'],
+            'attempts': entry['attempts'],
+            'error': str(error),
+        }, default=str) + "\n"
+        del self._entries[key]
+        self.dead += 1
+        try:
+            async with self._write_lock:
+                await asyncio.to_thread(self._write_dead_letter, record)
+            await self._append({'op': 'dead', 'key': key})
+        except Exception as e:
+            # Without the dead record the order is replayed on the next start
+            logger.error("Dead-lettering order %s failed: %s; order: %s", key, e, record.strip())
+        logger.error("❌ Order %s dead-lettered after %d attempts: %s", key, entry['attempts'], error)
+
+    async def _append(self, record: Dict[str, Any]):
+        line = json.dumps(record, default=str) + "\n"
+        async with self._write_lock:
+            await asyncio.to_thread(self._write_log, line)
+        self._log_lines += 1
+
+    def _write_log(self, line: str):
+        self._log.write(line)
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+
+    def _write_dead_letter(self, line: str):
+        with open(os.path.join(self.outbox_dir, DEAD_LETTER_FILE), "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def _replay(self):
+        """Queue orders a previous process logged but never finished."""
+        path = os.path.join(self.outbox_dir, LOG_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn write from a crash mid-append
+                    continue
+                if record['op'] == 'put':
+                    self._entries[record['key']] = {
+                        'order': record['order'],
+                        'queued_at': record['queued_at'],
+                        'attempts': 0,
+                        'next_attempt_at': 0.0,
+                    }
+                else:
+                    self._entries.pop(record['key'], None)
+
+        self.replayed = len(self._entries)
+        if self._entries:
+            logger.warning("Replaying %d undelivered orders from the outbox", len(self._entries))
+
+    def _compact(self, entries: List[Tuple[str, Dict[str, Any]]]):
+        """
+        Rewrite the log with only the pending orders.
+
+        Args:
+            entries: Snapshot of the pending orders, taken on the event loop
+        """
+        path = os.path.join(self.outbox_dir, LOG_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, entry in entries:
+                f.write(json.dumps({
+                    'op': 'put', 'key': key, 'order': entry['order'], 'queued_at': entry['queued_at']
+                }, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self._log is not None:
+            self._log.close()
+        os.replace(tmp_path, path)
+        self._log = open(path, "a", encoding="utf-8")
+        self._log_lines = len(entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._entries),
+            "queued": self.queued,
+            "delivered": self.delivered,
+            "duplicates": self.duplicates,
+            "retries": self.retries,
+            "dead": self.dead,
+            "replayed": self.replayed,
+        }
+
+
+# Global order outbox
+order_outbox = OrderOutbox(
+    outbox_dir=settings.order_outbox_dir,
+    max_attempts=settings.order_outbox_max_attempts,
+    fsync=settings.order_outbox_fsync
+)
+
+metrics.gauge(
+    "whatsapp_order_outbox_pending",
+    "Orders waiting to be inserted",
+    lambda: {(): order_outbox.pending}
+)
+metrics.gauge(
+    "whatsapp_order_outbox_total",
+    "Orders handled by the outbox, by result",
+    lambda: {
+        ("queued",): order_outbox.queued,
+        ("delivered",): order_outbox.delivered,
+        ("duplicate",): order_outbox.duplicates,
+        ("retried",): order_outbox.retries,
+        ("dead",): order_outbox.dead,
+    },
+    ["result"],
+    kind="counter"
+)
@@ -0,0 +1,191 @@
+"""
+In-process job queue for the inbound message pipeline.
+Lets the webhook acknowledge Twilio immediately while a bounded pool of
+asyncio workers runs the slow part (DB, LLM, Twilio send) in the background.
+"""
+import asyncio
+import time
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Tuple
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+queue_wait_seconds = metrics.histogram(
+    "whatsapp_queue_wait_seconds",
+    "Time jobs spent queued before a worker picked them up",
+    ["queue"]
+)
+
+
+@dataclass
+class Job:
+    """A unit of work waiting in the queue."""
+    key: str
+    args: Tuple[Any, ...]
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class MessageQueue:
+    """
+    Bounded job queue processed by a fixed pool of asyncio workers.
+
+    Jobs sharing the same key (e.g. the sender's WhatsApp number) are run
+    strictly in arrival order and never concurrently. Jobs with different
+    keys run in parallel across the worker pool.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[Any]],
+        workers: int = 8,
+        max_depth: int = 1000,
+        name: str = "message"
+    ):
+        """
+        Args:
+            handler: Coroutine function called with each job's args
+            workers: Number of concurrent worker tasks
+            max_depth: Maximum number of jobs waiting or running
+            name: Queue name for logs, task names and metrics
+        """
+        self.name = name
+        self._handler = handler
+        self._num_workers = max(1, workers)
+        self._max_depth = max_depth
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # Keys currently owned by a worker, with jobs that arrived meanwhile
+        self._active: Dict[str, Deque[Job]] = {}
+        self._workers: List[asyncio.Task] = []
+        self._depth = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._accepting = False
+
+        # Stats
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_last = 0.0
+
+    @property
+    def depth(self) -> int:
+        """Number of jobs enqueued but not yet finished."""
+        return self._depth
+
+    def start(self):
+        """Spawn the worker tasks. Must be called from a running event loop."""
+        if self._workers:
+            return
+        self._accepting = True
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"{self.name}-worker-{i}")
+            for i in range(self._num_workers)
+        ]
+        logger.info("✅ %s queue started with %d workers (max depth %d)", self.name.capitalize(), self._num_workers, self._max_depth)
+
+    def enqueue(self, key: str, *args: Any, delay: float = 0.0) -> bool:
+        """
+        Add a job to the queue without waiting.
+
+        Args:
+            key: Ordering key; jobs with the same key run sequentially
+            *args: Arguments passed to the handler
+            delay: Seconds before the job becomes runnable; it counts
+                towards the depth (and the drain on shutdown) right away
+
+        Returns:
+            True if accepted, False if the queue is full or shutting down
+        """
+        if not self._accepting or self._depth >= self._max_depth:
+            self._rejected += 1
+            return False
+
+        self._depth += 1
+        self._idle.clear()
+        job = Job(key=key, args=args)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._release, job)
+        else:
+            self._queue.put_nowait(job)
+        return True
+
+    async def stop(self, timeout: float = 30.0):
+        """
+        Stop accepting jobs, wait for queued work to drain, then cancel workers.
+
+        Args:
+            timeout: Maximum seconds to wait for the queue to drain
+        """
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            logger.info("%s queue drained", self.name.capitalize())
+        except asyncio.TimeoutError:
+            logger.warning("%s queue drain timed out with %d jobs left", self.name.capitalize(), self._depth)
+
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth, throughput and wait-time statistics."""
+        return {
+            "workers": self._num_workers,
+            "depth": self._depth,
+            "max_depth": self._max_depth,
+            "active_keys": len(self._active),
+            "processed": self._processed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+            "wait_seconds_avg": self._wait_total / self._processed if self._processed else 0.0,
+            "wait_seconds_max": self._wait_max,
+            "wait_seconds_last": self._wait_last,
+        }
+
+    def _release(self, job: Job):
+        # Queue wait is measured from when a delayed job became runnable
+        job.enqueued_at = time.monotonic()
+        self._queue.put_nowait(job)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                pending = self._active.get(job.key)
+                if pending is not None:
+                    # Another worker owns this key; it will run the job in order
+                    pending.append(job)
+                    continue
+
+                pending = self._active[job.key] = deque()
+                try:
+                    await self._run(job)
+                    while pending:
+                        await self._run(pending.popleft())
+                finally:
+                    del self._active[job.key]
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        wait = time.monotonic() - job.enqueued_at
+        self._wait_last = wait
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        queue_wait_seconds.observe(wait, queue=self.name)
+        try:
+            await self._handler(*job.args)
+        except Exception as e:
+            self._failed += 1
+            logger.error("Unhandled error in %s job for %s: %s", self.name, job.key, e, exc_info=True)
+        finally:
+            self._processed += 1
+            self._depth -= 1
+            if self._depth == 0:
+                self._idle.set()
@@ -1,96 +1,197 @@
 """
 Redis client wrapper for caching operations.
+Shared (L2) tier of the cache: values are msgpack-encoded, and key
+invalidations are broadcast over pub/sub so every worker can drop its
+in-process (L1) copy.
 """
-import json
+import uuid
+import asyncio
 import logging
-from typing import Optional, Any, Dict, List
-import redis.asyncio as redis
-from config import settings
+from typing import Optional, Any, Awaitable, Callable, Iterable, Tuple
+from services.metrics import dependencies
+
+try:
+    import msgpack
+    import redis.asyncio as redis
+except ImportError:  # optional: only needed with REDIS_ENABLED
+    msgpack = None
+    redis = None
 
 logger = logging.getLogger(__name__)
 
+# Reconnect backoff for the invalidation subscriber
+MAX_RECONNECT_DELAY = 30.0
+
+
+def pack(value: Any) -> bytes:
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def unpack(data: bytes) -> Any:
+    return msgpack.unpackb(data, raw=False)
+
+
 class RedisCache:
-    """Async Redis cache wrapper."""
-    
-    def __init__(self):
-        self.redis: Optional[redis.Redis] = None
-        self.enabled = settings.redis_enabled
-        
-        if self.enabled:
+    """Async Redis cache wrapper with pub/sub key invalidation."""
+
+    def __init__(self, url: Optional[str] = None, channel: str = "cache:invalidate", client=None):
+        """
+        Args:
+            url: Redis URL (ignored when client is given)
+            channel: Pub/sub channel for invalidations
+            client: Ready redis.asyncio client, e.g. fakeredis in tests
+        """
+        self.channel = channel
+        # Identifies this process so it can skip its own invalidations
+        self.origin = uuid.uuid4().hex
+        self.redis = client
+        self.enabled = client is not None
+        self._subscriber: Optional[asyncio.Task] = None
+
+        if client is None and url:
+            if redis is None or msgpack is None:
+                logger.error("REDIS_ENABLED is set but the redis/msgpack packages are not installed")
+                return
             try:
-                self.redis = redis.from_url(
-                    settings.redis_url,
-                    encoding="utf-8",
-                    decode_responses=True
-                )
-                # Test connection immediately
-                # Note: We can't await in __init__, so we'll handle connection errors 
-                # gracefully in the methods or use a startup event in FastAPI
-                logger.info(f"Redis client initialized with URL: {settings.redis_url}")
+                self.redis = redis.from_url(url, decode_responses=False)
+                self.enabled = True
+                logger.info("Redis client initialized with URL: %s", url)
             except Exception as e:
-                logger.error(f"Failed to initialize Redis client: {e}")
-                self.enabled = False
+                logger.error("Failed to initialize Redis client: %s", e)
 
-    async def get(self, key: str) -> Optional[Any]:
-        """Get value from cache."""
-        if not self.enabled or not self.redis:
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        """
+        Get a value and its remaining TTL.
+
+        Returns:
+            (value, seconds to expiry) or None on a miss or error
+        """
+        if not self.enabled:
             return None
-            
+
         try:
-            value = await self.redis.get(key)
-            if value:
-                return json.loads(value)
-            return None
+            with dependencies.track('redis'):
+                data, pttl = await self.redis.pipeline(transaction=False).get(key).pttl(key).execute()
+            if data is None:
+                return None
+            return unpack(data), (pttl / 1000 if pttl and pttl > 0 else 0.0)
         except Exception as e:
-            logger.error(f"Redis get error for key {key}: {e}")
+            logger.error("Redis get error for key %s: %s", key, e)
             return None
 
     async def set(self, key: str, value: Any, ttl: int = 300) -> bool:
-        """Set value in cache with TTL."""
-        if not self.enabled or not self.redis:
+        """Set value with TTL and tell other workers to drop their copy."""
+        if not self.enabled:
             return False
-            
+
         try:
-            json_value = json.dumps(value)
-            await self.redis.setex(key, ttl, json_value)
+            with dependencies.track('redis'):
+                await self.redis.pipeline(transaction=False).setex(key, ttl, pack(value)).publish(
+                    self.channel, self._invalidation([key])
+                ).execute()
             return True
         except Exception as e:
-            logger.error(f"Redis set error for key {key}: {e}")
+            logger.error("Redis set error for key %s: %s", key, e)
             return False
 
     async def delete(self, key: str) -> bool:
-        """Delete value from cache."""
-        if not self.enabled or not self.redis:
+        """Delete value and tell other workers to drop their copy."""
+        if not self.enabled:
             return False
-            
+
         try:
-            await self.redis.delete(key)
+            with dependencies.track('redis'):
+                await self.redis.pipeline(transaction=False).delete(key).publish(
+                    self.channel, self._invalidation([key])
+                ).execute()
             return True
         except Exception as e:
-            logger.error(f"Redis delete error for key {key}: {e}")
+            logger.error("Redis delete error for key %s: %s", key, e)
             return False
 
-    # Domain-specific helpers
-    
-    async def get_cached_conversation_history(self, conversation_id: str) -> Optional[List[Dict]]:
-        """Get cached conversation history."""
-        return await self.get(f"conversation:history:{conversation_id}")
+    async def claim(self, key: str, ttl: int) -> Optional[bool]:
+        """
+        Set a marker key only if it does not exist yet (SET NX).
 
-    async def set_cached_conversation_history(self, conversation_id: str, messages: List[Dict], ttl: int = 300):
-        """Cache conversation history."""
-        await self.set(f"conversation:history:{conversation_id}", messages, ttl)
+        Returns:
+            True if this call created it, False if it already existed,
+            None if Redis is unavailable
+        """
+        if not self.enabled:
+            return None
+
+        try:
+            with dependencies.track('redis'):
+                return bool(await self.redis.set(key, b"1", ex=ttl, nx=True))
+        except Exception as e:
+            logger.error("Redis claim error for key %s: %s", key, e)
+            return None
+
+    async def ping(self) -> bool:
+        if not self.enabled:
+            return False
+        try:
+            with dependencies.track('redis'):
+                return bool(await self.redis.ping())
+        except Exception as e:
+            logger.error("Redis ping failed: %s", e)
+            return False
+
+    def _invalidation(self, keys: Iterable[str]) -> bytes:
+        return pack({"origin": self.origin, "keys": list(keys)})
 
-    async def invalidate_conversation_cache(self, conversation_id: str):
-        """Invalidate conversation history cache."""
-        await self.delete(f"conversation:history:{conversation_id}")
+    # Invalidation subscriber
 
-    async def get_cached_customer(self, whatsapp_number: str) -> Optional[Dict]:
-        """Get cached customer data."""
-        return await self.get(f"customer:{whatsapp_number}")
+    def subscribe(
+        self,
+        on_invalidate: Callable[[list], Awaitable[None]],
+        on_reconnect: Callable[[], Awaitable[None]]
+    ):
+        """
+        Listen for invalidations from other workers in the background.
 
-    async def set_cached_customer(self, whatsapp_number: str, customer: Dict, ttl: int = 1800):
-        """Cache customer data."""
-        await self.set(f"customer:{whatsapp_number}", customer, ttl)
+        Args:
+            on_invalidate: Awaited with the keys another worker changed
+            on_reconnect: Awaited after the subscription is (re)established,
+                since invalidations may have been missed while it was down
+        """
+        if self.enabled and self._subscriber is None:
+            self._subscriber = asyncio.create_task(
+                self._listen(on_invalidate, on_reconnect), name="cache-invalidations"
+            )
+
+    async def _listen(self, on_invalidate, on_reconnect):
+        failures = 0
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                await on_reconnect()
+                failures = 0
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    payload = unpack(message["data"])
+                    if payload.get("origin") != self.origin:
+                        await on_invalidate(payload.get("keys", []))
+                raise ConnectionError("Subscription closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                delay = min(2 ** failures, MAX_RECONNECT_DELAY)
+                logger.error("Cache invalidation subscriber error, reconnecting in %ss: %s", delay, e)
+                await asyncio.sleep(delay)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
 
-# Global Redis client instance
-redis_cache = RedisCache()
+    async def close(self):
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+            await asyncio.gather(self._subscriber, return_exceptions=True)
+            self._subscriber = None
+        if self.redis is not None:
+            await self.redis.aclose()
@@ -4,12 +4,33 @@ Uses Supabase Python SDK with service role key for admin access.
 """
 from supabase import create_client, Client
 from config import settings
+from services.analytics import MONEY_COUNTERS, SUMMARY_COUNTERS, daily_stats
 from services.cache import cache
+from services.catalog import product_catalog
+from services.metrics import dependencies
+from services.write_buffer import message_buffer
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+import uuid
+from datetime import date, datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import re
+from typing import Optional, Dict, Any, List, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Characters with meaning inside a PostgREST or=() filter
+_FILTER_UNSAFE = re.compile(r'[,()%*"\\]')
+
+PRODUCT_COLUMNS = (
+    'id,sku,name,description,category,subcategory,price,compare_at_price,currency,'
+    'stock_quantity,image_urls,tags,is_active,updated_at'
+)
+
+
+class DuplicateMessageError(Exception):
+    """Raised when a message with the same whatsapp_message_id is already stored."""
+
 
 class SupabaseClient:
     """Supabase database client with admin access."""
@@ -20,7 +41,32 @@ class SupabaseClient:
             settings.supabase_url,
             settings.supabase_service_key
         )
-        logger.info("Supabase client initialized")
+        # The SDK is synchronous, so PostgREST round trips run on a sized
+        # thread pool instead of blocking the event loop. The underlying
+        # httpx client keeps its connections pooled across threads.
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.supabase_pool_size,
+            thread_name_prefix="supabase"
+        )
+        logger.info("Supabase client initialized (pool size %d)", settings.supabase_pool_size)
+    
+    async def _execute(self, query):
+        """
+        Run a PostgREST query builder without blocking the event loop.
+        
+        Args:
+            query: Any builder exposing a synchronous execute()
+            
+        Returns:
+            The API response from execute()
+        """
+        loop = asyncio.get_running_loop()
+        with dependencies.track('supabase'):
+            return await loop.run_in_executor(self._executor, query.execute)
+    
+    async def ping(self):
+        """Cheapest possible PostgREST round trip (opens a pooled connection)."""
+        await self._execute(self.client.table('customers').select('id').limit(1))
     
     async def get_or_create_customer(self, whatsapp_number: str) -> Dict[str, Any]:
         """
@@ -36,17 +82,17 @@ class SupabaseClient:
             # Check cache first
             cached_customer = await cache.get_cached_customer(whatsapp_number)
             if cached_customer:
-                logger.info(f"Cache hit for customer: {whatsapp_number}")
+                logger.info("Cache hit for customer: %s", whatsapp_number)
                 return cached_customer
 
             # Try to find existing customer
-            result = self.client.table('customers').select('*').eq(
+            result = await self._execute(self.client.table('customers').select('*').eq(
                 'whatsapp_number', whatsapp_number
-            ).limit(1).execute()
+            ).limit(1))
             
             if result.data and len(result.data) > 0:
                 customer = result.data[0]
-                logger.info(f"Found existing customer: {customer['id']}")
+                logger.info("Found existing customer: %s", customer['id'])
                 # Cache the result
                 await cache.set_cached_customer(
                     whatsapp_number, 
@@ -56,12 +102,13 @@ class SupabaseClient:
                 return customer
             
             # Create new customer
-            new_customer = self.client.table('customers').insert({
+            new_customer = await self._execute(self.client.table('customers').insert({
                 'whatsapp_number': whatsapp_number
-            }).execute()
+            }))
             
             customer = new_customer.data[0]
-            logger.info(f"Created new customer: {customer['id']}")
+            daily_stats.record(new_customers=1)
+            logger.info("Created new customer: %s", customer['id'])
             
             # Cache the new customer
             await cache.set_cached_customer(
@@ -72,9 +119,169 @@ class SupabaseClient:
             return customer
             
         except Exception as e:
-            logger.error(f"Error in get_or_create_customer: {str(e)}")
+            logger.error("Error in get_or_create_customer: %s", e)
+            raise
+    
+    async def resolve_customer_conversation(
+        self,
+        whatsapp_number: str
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Get or create the customer and their active conversation.
+        
+        Uses a cached whatsapp_number -> (customer, conversation) mapping and
+        falls back to the resolve_customer_conversation RPC, so each message
+        costs at most one DB round trip before the agent runs.
+        
+        Args:
+            whatsapp_number: Customer's WhatsApp number (without 'whatsapp:' prefix)
+            
+        Returns:
+            Tuple of (customer record, conversation record)
+        """
+        try:
+            cached = await cache.get_cached_active_conversation(whatsapp_number)
+            if cached:
+                logger.info("Cache hit for active conversation: %s", whatsapp_number)
+                return cached['customer'], cached['conversation']
+            
+            result = await self._execute(self.client.rpc(
+                'resolve_customer_conversation',
+                {'p_whatsapp_number': whatsapp_number}
+            ))
+            customer = result.data['customer']
+            conversation = result.data['conversation']
+            daily_stats.record(
+                new_customers=int(result.data.get('customer_created', False)),
+                conversations_started=int(result.data.get('conversation_created', False))
+            )
+            logger.info("Resolved customer %s, conversation %s", customer['id'], conversation['id'])
+            
+            await cache.set_cached_active_conversation(
+                whatsapp_number,
+                {'customer': customer, 'conversation': conversation},
+                ttl=settings.redis_ttl_customer_data
+            )
+            await cache.set_cached_customer(
+                whatsapp_number,
+                customer,
+                ttl=settings.redis_ttl_customer_data
+            )
+            return customer, conversation
+            
+        except Exception as e:
+            logger.error("Error in resolve_customer_conversation: %s", e)
             raise
     
+    async def update_conversation_status(
+        self,
+        conversation_id: str,
+        whatsapp_number: str,
+        status: str
+    ) -> Dict[str, Any]:
+        """
+        Change a conversation's status and drop the cached active mapping.
+        
+        Args:
+            conversation_id: Conversation UUID
+            whatsapp_number: Customer's WhatsApp number
+            status: New status (active, resolved, escalated, closed)
+            
+        Returns:
+            Updated conversation record
+        """
+        try:
+            update = {'status': status}
+            result = None
+            if status != 'active':
+                # Only a conversation leaving 'active' counts as closed
+                result = await self._execute(self.client.table('conversations').update(update).eq(
+                    'id', conversation_id
+                ).eq('status', 'active'))
+                if result.data:
+                    daily_stats.record(conversations_closed=1)
+            if not result or not result.data:
+                result = await self._execute(self.client.table('conversations').update(update).eq(
+                    'id', conversation_id
+                ))
+            
+            await cache.invalidate_active_conversation(whatsapp_number)
+            logger.info("Conversation %s set to %s", conversation_id, status)
+            return result.data[0] if result.data else {}
+            
+        except Exception as e:
+            logger.error("Error in update_conversation_status: %s", e)
+            raise
+    
+    async def update_conversation_summary(
+        self,
+        conversation_id: str,
+        summary: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        Store the rolling summary under conversations.metadata["summary"],
+        keeping any other metadata keys.
+
+        Args:
+            conversation_id: Conversation UUID
+            summary: Summary record ({"text", "through", ...})
+
+        Returns:
+            Updated conversation record
+        """
+        try:
+            current = await self._execute(self.client.table('conversations').select('metadata').eq(
+                'id', conversation_id
+            ).limit(1))
+            metadata = (current.data[0].get('metadata') if current.data else None) or {}
+            metadata['summary'] = summary
+
+            result = await self._execute(self.client.table('conversations').update({
+                'metadata': metadata
+            }).eq('id', conversation_id))
+            return result.data[0] if result.data else {}
+
+        except Exception as e:
+            logger.error("Error in update_conversation_summary: %s", e)
+            raise
+
+    async def get_idle_conversations(self, idle_before: datetime, limit: int = 500) -> List[Dict[str, Any]]:
+        """
+        Active conversations whose last message is older than `idle_before`
+        (oldest first).
+        
+        Args:
+            idle_before: Cutoff for the last message
+            limit: Maximum conversations returned
+            
+        Returns:
+            Conversations (id, whatsapp_number)
+        """
+        result = await self._execute(self.client.table('conversations').select('id, whatsapp_number').eq(
+            'status', 'active'
+        ).lt(
+            'last_message_at', idle_before.isoformat()
+        ).order('last_message_at').limit(limit))
+        return result.data or []
+
+    async def close_idle_conversations(self, idle_before: datetime, conversation_ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        Close the given conversations that are still active and idle since
+        before `idle_before`, setting ended_at.
+        
+        Args:
+            idle_before: Conversations quiet since before this time are closed
+            conversation_ids: Conversations to close
+            
+        Returns:
+            Closed conversations (id, whatsapp_number)
+        """
+        result = await self._execute(self.client.rpc('close_idle_conversations', {
+            'p_idle_before': idle_before.isoformat(),
+            'p_ids': conversation_ids
+        }))
+        return result.data or []
+
     async def get_or_create_conversation(
         self, 
         customer_id: str, 
@@ -92,28 +299,29 @@ class SupabaseClient:
         """
         try:
             # Look for active conversation
-            result = self.client.table('conversations').select('*').eq(
+            result = await self._execute(self.client.table('conversations').select('*').eq(
                 'customer_id', customer_id
             ).eq(
                 'status', 'active'
-            ).order('started_at', desc=True).limit(1).execute()
+            ).order('started_at', desc=True).limit(1))
             
             if result.data and len(result.data) > 0:
-                logger.info(f"Found active conversation: {result.data[0]['id']}")
+                logger.info("Found active conversation: %s", result.data[0]['id'])
                 return result.data[0]
             
             # Create new conversation
-            new_conversation = self.client.table('conversations').insert({
+            new_conversation = await self._execute(self.client.table('conversations').insert({
                 'customer_id': customer_id,
                 'whatsapp_number': whatsapp_number,
                 'status': 'active'
-            }).execute()
+            }))
             
-            logger.info(f"Created new conversation: {new_conversation.data[0]['id']}")
+            daily_stats.record(conversations_started=1)
+            logger.info("Created new conversation: %s", new_conversation.data[0]['id'])
             return new_conversation.data[0]
             
         except Exception as e:
-            logger.error(f"Error in get_or_create_conversation: {str(e)}")
+            logger.error("Error in get_or_create_conversation: %s", e)
             raise
     
     async def store_message(
@@ -122,42 +330,120 @@ class SupabaseClient:
         direction: str,
         message_text: str,
         whatsapp_message_id: Optional[str] = None,
-        sender_type: str = "customer"
+        sender_type: str = "customer",
+        content_type: str = "text",
+        media_url: Optional[str] = None,
+        media_mime_type: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         Store a message in the database.
         
+        With the write-behind buffer running, the row is spooled and
+        written by the next bulk flush; otherwise it is written now.
+        Either way it goes through store_messages_batch, which also keeps
+        the conversation's message_count and last_message_at current.
+        
+        A row with a whatsapp_message_id is only buffered once its SID is
+        claimed in Redis (so a retry on another worker or after a restart
+        is still caught); without Redis it is written directly and the
+        UNIQUE constraint catches the retry.
+        
         Args:
             conversation_id: Conversation UUID
             direction: 'inbound' or 'outbound'
             message_text: Message content
             whatsapp_message_id: Twilio message SID (optional)
             sender_type: 'customer' or 'agent'
+            content_type: 'text', 'image', 'audio', 'video' or 'document'
+            media_url: Attachment URL (replaced by the stored copy once downloaded)
+            media_mime_type: Attachment MIME type
             
         Returns:
-            Created message record
+            Message record
+            
+        Raises:
+            DuplicateMessageError: If whatsapp_message_id is already stored
         """
         try:
-            message_data = {
+            now = datetime.now(timezone.utc).isoformat()
+            message = {
+                'id': str(uuid.uuid4()),
                 'conversation_id': conversation_id,
                 'direction': direction,
                 'message_text': message_text,
                 'sender_type': sender_type,
-                'is_automated': sender_type == 'agent'
+                'content_type': content_type,
+                'media_url': media_url,
+                'media_mime_type': media_mime_type,
+                'is_automated': sender_type == 'agent',
+                'whatsapp_message_id': whatsapp_message_id,
+                # Outbound replies move to sending/sent/failed in the outbound queue
+                'delivery_status': 'pending' if direction == 'outbound' else None,
+                'sent_at': now,
+                'created_at': now
             }
             
-            if whatsapp_message_id:
-                message_data['whatsapp_message_id'] = whatsapp_message_id
+            if message_buffer.running and await self._claim_message_sid(whatsapp_message_id):
+                await message_buffer.add(message)
+                logger.info("Buffered %s message in conversation %s", direction, conversation_id)
+            else:
+                inserted = await self.store_messages_batch([message])
+                if not inserted and whatsapp_message_id:
+                    raise DuplicateMessageError(whatsapp_message_id)
+                logger.info("Stored %s message in conversation %s", direction, conversation_id)
+            daily_stats.record(**{f'messages_{direction}': 1})
             
-            result = self.client.table('messages').insert(message_data).execute()
-            
-            logger.info(f"Stored {direction} message in conversation {conversation_id}")
-            return result.data[0]
+            # Keep the cached history window current instead of invalidating it
+            await cache.append_conversation_history(
+                conversation_id,
+                message,
+                max_messages=settings.conversation_history_limit,
+                ttl=settings.redis_ttl_conversation_history
+            )
+            return message
             
+        except DuplicateMessageError:
+            raise
         except Exception as e:
-            logger.error(f"Error in store_message: {str(e)}")
+            logger.error("Error in store_message: %s", e)
             raise
     
+    async def _claim_message_sid(self, whatsapp_message_id: Optional[str]) -> bool:
+        """
+        Decide whether a row may be buffered.
+        
+        Returns:
+            True if it has no SID or its SID was newly claimed, False if the
+            SID cannot be claimed durably (write directly instead)
+            
+        Raises:
+            DuplicateMessageError: If the SID was already claimed
+        """
+        if not whatsapp_message_id:
+            return True
+        claimed = await cache.claim(f"message_sid:{whatsapp_message_id}", ttl=settings.dedupe_ttl)
+        if claimed is False:
+            raise DuplicateMessageError(whatsapp_message_id)
+        return bool(claimed)
+    
+    async def store_messages_batch(self, messages: List[Dict[str, Any]]) -> int:
+        """
+        Insert message rows and apply their conversation counter deltas in
+        one round trip. Rows that already exist (same id or
+        whatsapp_message_id) are skipped, so retries are safe.
+        
+        Args:
+            messages: Full message rows with client-generated ids
+            
+        Returns:
+            Number of rows newly inserted
+        """
+        result = await self._execute(self.client.rpc(
+            'store_messages_batch',
+            {'p_messages': messages}
+        ))
+        return (result.data or {}).get('inserted', 0)
+    
     async def search_products(
         self, 
         search_query: str, 
@@ -166,6 +452,9 @@ class SupabaseClient:
         """
         Search for products (for future Product Search Agent).
         
+        Served from the in-memory catalog index once it is loaded; falls
+        back to an ilike query against PostgREST before that.
+        
         Args:
             search_query: Search term
             limit: Maximum results
@@ -174,56 +463,148 @@ class SupabaseClient:
             List of product records
         """
         try:
-            result = self.client.table('products').select('*').eq(
+            if product_catalog.loaded:
+                products = product_catalog.search(search_query, limit=limit)
+                logger.info("Found %d products for a %d-char query (catalog index)", len(products), len(search_query))
+                return products
+            
+            term = _FILTER_UNSAFE.sub(' ', search_query).strip()
+            result = await self._execute(self.client.table('products').select(PRODUCT_COLUMNS).eq(
                 'is_active', True
             ).or_(
-                f'name.ilike.%{search_query}%,description.ilike.%{search_query}%'
-            ).limit(limit).execute()
+                f'name.ilike.%{term}%,description.ilike.%{term}%'
+            ).limit(limit))
             
-            logger.info(f"Found {len(result.data)} products matching '{search_query}'")
+            logger.info("Found %d products for a %d-char query", len(result.data), len(search_query))
             return result.data
             
         except Exception as e:
-            logger.error(f"Error in search_products: {str(e)}")
+            logger.error("Error in search_products: %s", e)
             raise
 
+    async def fetch_products_since(
+        self,
+        cursor: Optional[Tuple[str, str]] = None,
+        limit: int = 1000
+    ) -> list[Dict[str, Any]]:
+        """
+        Page through products in (updated_at, id) order, for the catalog index.
+        Includes inactive products so the index can drop them.
+        
+        Args:
+            cursor: (updated_at, id) of the last row already seen, or None
+            limit: Maximum rows to return
+            
+        Returns:
+            List of product records
+        """
+        query = self.client.table('products').select(PRODUCT_COLUMNS).order(
+            'updated_at'
+        ).order('id').limit(limit)
+        
+        if cursor:
+            updated_at, last_id = cursor
+            query = query.or_(
+                f'updated_at.gt."{updated_at}",'
+                f'and(updated_at.eq."{updated_at}",id.gt.{last_id})'
+            )
+        
+        result = await self._execute(query)
+        return result.data or []
+
+    async def fetch_page(
+        self,
+        table: str,
+        columns: List[str],
+        cursor: Optional[Tuple[str, str]] = None,
+        limit: int = 1000,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> list[Dict[str, Any]]:
+        """
+        Page through a table in (created_at, id) order, for streaming exports.
+        Each page is an index range scan that starts after the cursor, so
+        deep pages cost the same as the first.
+        
+        Args:
+            table: Table name
+            columns: Columns to select (must include created_at and id)
+            cursor: (created_at, id) of the last row already seen, or None
+            limit: Maximum rows to return
+            filters: Column -> value for equality (a list matches any of
+                its values); 'since' / 'until' bound created_at
+            
+        Returns:
+            List of records
+        """
+        query = self.client.table(table).select(','.join(columns)).order(
+            'created_at'
+        ).order('id').limit(limit)
+        
+        for column, value in (filters or {}).items():
+            if column == 'since':
+                query = query.gte('created_at', value.isoformat())
+            elif column == 'until':
+                query = query.lt('created_at', value.isoformat())
+            elif isinstance(value, list):
+                query = query.in_(column, value)
+            else:
+                query = query.eq(column, value)
+        
+        if cursor:
+            created_at, last_id = cursor
+            query = query.or_(
+                f'created_at.gt."{created_at}",'
+                f'and(created_at.eq."{created_at}",id.gt.{last_id})'
+            )
+        
+        result = await self._execute(query)
+        return result.data or []
+
     async def create_order(
         self,
         customer_id: str,
         items: list[Dict[str, Any]],
-        total: float
+        total: float,
+        conversation_id: Optional[str] = None,
+        idempotency_key: Optional[str] = None
     ) -> Dict[str, Any]:
         """
-        Create a new order.
+        Create a new order and its line items.
+        The order number comes from a DB sequence, so it is unique and
+        increasing; an order with the same idempotency key is returned
+        instead of being created twice.
         
         Args:
             customer_id: Customer UUID
-            items: List of order items
+            items: List of order items (name, quantity, price)
             total: Total order amount
+            conversation_id: Conversation the order was placed in
+            idempotency_key: MessageSid that confirmed the order
             
         Returns:
-            Created order record
+            Created (or previously created) order record
         """
         try:
-            # Generate a simple order number (timestamp based for MVP)
-            import time
-            order_number = f"ORD-{int(time.time())}"
+            result = await self._execute(self.client.rpc('place_order', {
+                'p_order': {
+                    'customer_id': customer_id,
+                    'conversation_id': conversation_id,
+                    'idempotency_key': idempotency_key,
+                    'items': items,
+                    'total': total
+                }
+            }))
+            order = result.data['order']
             
-            order_data = {
-                'customer_id': customer_id,
-                'status': 'pending_payment',
-                'total': total,
-                'items': items,
-                'order_number': order_number
-            }
-            
-            result = self.client.table('orders').insert(order_data).execute()
-            
-            logger.info(f"Created order {order_number} for customer {customer_id}")
-            return result.data[0]
+            if result.data['created']:
+                daily_stats.record(orders=1, order_value=float(order['total']))
+                logger.info("Created order %s for customer %s", order['order_number'], customer_id)
+            else:
+                logger.info("Order %s already exists for key %s", order['order_number'], idempotency_key)
+            return order
             
         except Exception as e:
-            logger.error(f"Error in create_order: {str(e)}")
+            logger.error("Error in create_order: %s", e)
             raise
 
     async def get_recent_messages(
@@ -242,19 +623,104 @@ class SupabaseClient:
             List of message records, ordered by created_at asc
         """
         try:
-            result = self.client.table('messages').select('*').eq(
+            result = await self._execute(self.client.table('messages').select('*').eq(
                 'conversation_id', conversation_id
-            ).order('created_at', desc=True).limit(limit).execute()
+            ).order('created_at', desc=True).limit(limit))
             
             # Return reversed list (oldest first) for context
             messages = result.data[::-1] if result.data else []
-            logger.info(f"Retrieved {len(messages)} recent messages for conversation {conversation_id}")
+            
+            # Include rows still waiting in the write-behind buffer
+            buffered = message_buffer.pending_for(conversation_id)
+            if buffered:
+                stored_ids = {m['id'] for m in messages}
+                messages += [m for m in buffered if m['id'] not in stored_ids]
+                messages = sorted(messages, key=lambda m: m.get('created_at') or '')[-limit:]
+            logger.info("Retrieved %d recent messages for conversation %s", len(messages), conversation_id)
             return messages
             
         except Exception as e:
-            logger.error(f"Error in get_recent_messages: {str(e)}")
+            logger.error("Error in get_recent_messages: %s", e)
             return []
 
+    async def update_message(self, message_id: str, fields: Dict[str, Any]):
+        """
+        Update a message row, whether it is stored or still buffered.
+        
+        Args:
+            message_id: Message UUID
+            fields: Columns to set
+        """
+        if await message_buffer.annotate(message_id, fields):
+            return
+        await self._execute(
+            self.client.table('messages').update(fields).eq('id', message_id)
+        )
+
+    async def get_unsent_outbound(self, since: datetime, until: datetime) -> List[Dict[str, Any]]:
+        """
+        Get outbound messages that were stored but never handed to Twilio
+        (delivery_status still pending). Rows whose send had started are
+        left alone, since Twilio may have accepted them.
+        
+        Args:
+            since: Oldest created_at to consider
+            until: Newest created_at to consider
+            
+        Returns:
+            Message records, oldest first, each with the recipient's number as 'to'
+        """
+        result = await self._execute(
+            self.client.table('messages')
+            .select('id, conversation_id, message_text, created_at')
+            .eq('delivery_status', 'pending')
+            .gte('created_at', since.isoformat())
+            .lte('created_at', until.isoformat())
+            .order('created_at')
+        )
+        messages = result.data or []
+        if not messages:
+            return []
+
+        conversation_ids = list({m['conversation_id'] for m in messages})
+        conversations = await self._execute(
+            self.client.table('conversations').select('id, whatsapp_number').in_('id', conversation_ids)
+        )
+        numbers = {c['id']: c['whatsapp_number'] for c in conversations.data or []}
+        return [
+            {**m, 'to': numbers[m['conversation_id']]}
+            for m in messages if m['conversation_id'] in numbers
+        ]
+
+    async def add_daily_stats(self, rows: List[Dict[str, Any]]):
+        """
+        Add per-day counter deltas to daily_stats in one round trip.
+        
+        Args:
+            rows: One dict per day: {'day': 'YYYY-MM-DD', <counter>: delta, ...}
+        """
+        await self._execute(self.client.rpc('add_daily_stats', {'p_rows': rows}))
+
+    async def get_daily_stats_summary(self, today: date) -> Dict[str, Dict[str, float]]:
+        """
+        Sum daily_stats over all time, today, this month and last month.
+        
+        Args:
+            today: Current (UTC) date
+            
+        Returns:
+            Dict of period ('totals', 'today', 'this_month', 'last_month')
+            to counter sums
+        """
+        result = await self._execute(self.client.rpc('daily_stats_summary', {'p_today': today.isoformat()}))
+        return {
+            period: {
+                counter: (float if counter in MONEY_COUNTERS else int)((sums or {}).get(counter) or 0)
+                for counter in SUMMARY_COUNTERS
+            }
+            for period, sums in result.data.items()
+        }
+
 
 # Global Supabase client instance
 supabase_client = SupabaseClient()
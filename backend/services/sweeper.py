@@ -0,0 +1,164 @@
+"""
+Lifecycle sweeper for idle conversations.
+Conversations are created active and nothing used to close them, so the
+active set (and each customer's "current" conversation) only grew. A
+background task periodically closes conversations whose last message is
+older than the idle window, in batches through the close_idle_conversations
+RPC, and evicts their cache entries so the customer's next message starts
+a fresh conversation. Each conversation is closed under its customer's
+lease, so one that is being answered right now is left for the next sweep.
+"""
+import time
+import asyncio
+import logging
+from contextlib import AsyncExitStack
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from config import settings
+from services.analytics import daily_stats
+from services.cache import cache
+from services.lease import conversation_leases, LeaseTimeout
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a customer's lease; busy customers are skipped
+LEASE_WAIT = 0.05
+
+sweep_seconds = metrics.histogram(
+    "whatsapp_conversation_sweep_seconds",
+    "Time taken by each idle-conversation sweep",
+    ["outcome"]
+)
+closed_conversations = metrics.counter(
+    "whatsapp_conversations_closed_total",
+    "Conversations closed by the idle sweeper"
+)
+
+
+class ConversationSweeper:
+    """Closes idle conversations in the background."""
+
+    def __init__(
+        self,
+        idle_after: float = 86400,
+        interval: float = 300.0,
+        batch_size: int = 500,
+        max_batches: int = 20
+    ):
+        """
+        Args:
+            idle_after: Seconds since the last message after which a
+                conversation is closed
+            interval: Seconds between sweeps
+            batch_size: Conversations closed per RPC call
+            max_batches: Batches per sweep (the rest wait for the next one)
+        """
+        self.idle_after = idle_after
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.max_batches = max(1, max_batches)
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+
+        # Stats
+        self.sweeps = 0
+        self.closed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_sweep_at: Optional[float] = None
+
+    def start(self, db):
+        """
+        Start sweeping.
+
+        Args:
+            db: SupabaseClient used to close conversations
+        """
+        self._db = db
+        if self._task is None:
+            self._task = asyncio.create_task(self._sweep_loop(), name="conversation-sweeper")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sweep_loop(self):
+        while True:
+            started_at = time.perf_counter()
+            try:
+                await self.sweep()
+                sweep_seconds.observe(time.perf_counter() - started_at, outcome="ok")
+            except Exception as e:
+                self.errors += 1
+                sweep_seconds.observe(time.perf_counter() - started_at, outcome="error")
+                logger.error("Conversation sweep failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> int:
+        """
+        Close conversations idle for longer than idle_after.
+
+        Returns:
+            Number of conversations closed
+        """
+        idle_before = datetime.now(timezone.utc) - timedelta(seconds=self.idle_after)
+        total = 0
+        for _ in range(self.max_batches):
+            idle = await self._db.get_idle_conversations(idle_before, limit=self.batch_size)
+            closed = await self._close(idle, idle_before)
+            total += closed
+            # Skipped conversations come back in the next query
+            if len(idle) < self.batch_size or not closed:
+                break
+
+        self.sweeps += 1
+        self.last_sweep_at = time.time()
+        if total:
+            self.closed += total
+            closed_conversations.inc(total)
+            daily_stats.record(conversations_closed=total)
+            logger.info("🧹 Closed %d conversations idle since %s", total, idle_before.isoformat())
+        return total
+
+    async def _close(self, idle: List[Dict[str, Any]], idle_before: datetime) -> int:
+        """Close the conversations whose customers' leases are free."""
+        async with AsyncExitStack() as leases:
+            held = []
+            for conversation in idle:
+                try:
+                    await leases.enter_async_context(
+                        conversation_leases.hold(f"whatsapp:{conversation['whatsapp_number']}", wait_timeout=LEASE_WAIT)
+                    )
+                except LeaseTimeout:
+                    self.skipped += 1
+                    continue
+                held.append(conversation['id'])
+            if not held:
+                return 0
+            closed = await self._db.close_idle_conversations(idle_before, held)
+            # Evict while the leases are held, so the next message resolves afresh
+            for conversation in closed:
+                await cache.evict_conversation(conversation['id'], conversation['whatsapp_number'])
+        return len(closed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "idle_after_seconds": self.idle_after,
+            "sweeps": self.sweeps,
+            "closed": self.closed,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "last_sweep_at": self.last_sweep_at,
+        }
+
+
+# Global idle-conversation sweeper
+conversation_sweeper = ConversationSweeper(
+    idle_after=settings.conversation_idle_timeout,
+    interval=settings.sweeper_interval,
+    batch_size=settings.sweeper_batch_size,
+    max_batches=settings.sweeper_max_batches
+)
@@ -2,23 +2,98 @@
 Twilio WhatsApp API client for sending messages.
 """
 from twilio.rest import Client
+from twilio.http import AsyncHttpClient
+from twilio.http.response import Response as TwilioResponse
 from config import settings
+from services.metrics import dependencies
+import httpx
 import logging
+from typing import Dict, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
 
+class PooledTwilioHttpClient(AsyncHttpClient):
+    """
+    Async HTTP client for the Twilio SDK backed by a pooled httpx client.
+    Keeps TLS connections to api.twilio.com alive between sends.
+    """
+    
+    def __init__(self, timeout: float, max_connections: int, base_url: Optional[str] = None):
+        super().__init__(logger, is_async=True, timeout=timeout)
+        # Optional scheme://host:port that replaces api.twilio.com
+        self.base_url = httpx.URL(base_url) if base_url else None
+        self.session = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            )
+        )
+    
+    async def request(
+        self,
+        method: str,
+        uri: str,
+        params: Optional[Dict[str, object]] = None,
+        data: Optional[Dict[str, object]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        auth: Optional[Tuple[str, str]] = None,
+        timeout: Optional[float] = None,
+        allow_redirects: bool = False,
+    ) -> TwilioResponse:
+        """Send a request and wrap the result in a Twilio SDK response."""
+        if self.base_url is not None:
+            uri = httpx.URL(uri).copy_with(
+                scheme=self.base_url.scheme,
+                host=self.base_url.host,
+                port=self.base_url.port
+            )
+        with dependencies.track('twilio') as span:
+            response = await self.session.request(
+                method.upper(),
+                uri,
+                params=params,
+                data=data,
+                headers=headers,
+                auth=auth,
+                timeout=timeout if timeout is not None else self.timeout,
+                follow_redirects=allow_redirects
+            )
+            if response.status_code == 429 or response.status_code >= 500:
+                span.outcome = 'error'
+        return TwilioResponse(response.status_code, response.text, response.headers)
+    
+    async def close(self):
+        """Close pooled connections."""
+        await self.session.aclose()
+
+
 class WhatsAppClient:
     """Twilio WhatsApp API client."""
     
     def __init__(self):
-        """Initialize Twilio client."""
+        """Initialize Twilio client with a non-blocking, pooled transport."""
+        self.http_client = PooledTwilioHttpClient(
+            timeout=settings.twilio_timeout,
+            max_connections=settings.twilio_max_connections,
+            base_url=settings.twilio_api_base_url
+        )
         self.client = Client(
             settings.twilio_account_sid,
-            settings.twilio_auth_token
+            settings.twilio_auth_token,
+            http_client=self.http_client
         )
         self.from_number = settings.twilio_whatsapp_number
     
+    async def close(self):
+        """Release pooled HTTP connections."""
+        await self.http_client.close()
+    
+    async def ping(self):
+        """Fetch our Twilio account (opens a pooled TLS connection to Twilio)."""
+        await self.client.api.v2010.accounts(settings.twilio_account_sid).fetch_async()
+    
     async def send_text_message(self, to: str, message: str):
         """
         Send a text message via Twilio WhatsApp.
@@ -35,13 +110,13 @@ class WhatsAppClient:
             if not to.startswith('whatsapp:'):
                 to = f'whatsapp:{to}'
             
-            msg = self.client.messages.create(
+            msg = await self.client.messages.create_async(
                 from_=self.from_number,
                 body=message,
                 to=to
             )
             
-            logger.info(f"Message sent to {to}: SID {msg.sid}")
+            logger.info("Message sent to %s: SID %s", to, msg.sid)
             return {
                 "status": "sent",
                 "message_sid": msg.sid,
@@ -49,7 +124,7 @@ class WhatsAppClient:
             }
             
         except Exception as e:
-            logger.error(f"Failed to send message to {to}: {str(e)}")
+            logger.error("Failed to send message to %s: %s", to, e)
             raise
     
     async def send_media_message(self, to: str, message: str, media_url: str):
@@ -68,14 +143,14 @@ class WhatsAppClient:
             if not to.startswith('whatsapp:'):
                 to = f'whatsapp:{to}'
             
-            msg = self.client.messages.create(
+            msg = await self.client.messages.create_async(
                 from_=self.from_number,
                 body=message,
                 media_url=[media_url],
                 to=to
             )
             
-            logger.info(f"Media message sent to {to}: SID {msg.sid}")
+            logger.info("Media message sent to %s: SID %s", to, msg.sid)
             return {
                 "status": "sent",
                 "message_sid": msg.sid,
@@ -83,7 +158,7 @@ class WhatsAppClient:
             }
             
         except Exception as e:
-            logger.error(f"Failed to send media message to {to}: {str(e)}")
+            logger.error("Failed to send media message to %s: %s", to, e)
             raise
 
 
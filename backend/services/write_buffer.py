@@ -0,0 +1,323 @@
+"""
+Write-behind buffer for message rows.
+Messages are appended to a local spool file and queued in memory, then
+flushed in bulk through the store_messages_batch RPC, which inserts the
+rows and applies the conversation counter deltas (message_count,
+last_message_at) in one round trip. Spool segments are only deleted once
+every row in them is confirmed, so delivery is at-least-once; the RPC
+skips rows it already has, so replays are harmless. Spool writes, fsyncs
+and rotations run in a worker thread, one at a time, so they never stall
+the event loop.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+from config import settings
+from services.dedupe import message_dedupe
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SPOOL_FILE = "current.jsonl"
+MAX_RETRY_DELAY = 30.0
+
+flush_seconds = metrics.histogram(
+    "whatsapp_write_buffer_flush_seconds",
+    "Time taken by each write-behind flush",
+    ["outcome"]
+)
+
+
+class WriteBehindBuffer:
+    """Spool-backed batch writer for the messages table."""
+
+    def __init__(
+        self,
+        spool_dir: str,
+        flush_interval: float = 0.25,
+        max_batch: int = 200,
+        fsync: bool = False
+    ):
+        """
+        Args:
+            spool_dir: Directory for spool segments
+            flush_interval: Seconds between flushes
+            max_batch: Rows per RPC call; reaching it also triggers a flush
+            fsync: fsync the spool on every append (survives power loss,
+                not just a process crash)
+        """
+        self.spool_dir = spool_dir
+        self.flush_interval = flush_interval
+        self.max_batch = max(1, max_batch)
+        self.fsync = fsync
+
+        self._pending: List[Dict[str, Any]] = []
+        # Rows taken by the flush currently in progress
+        self._flushing: List[Dict[str, Any]] = []
+        # Rotated spool files holding rows not yet confirmed by the DB
+        self._segments: List[str] = []
+        self._segment_seq = 0
+        self._spool = None
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        # Serialises spool writes and rotation, which run in a worker thread
+        self._write_lock = asyncio.Lock()
+        self._failures = 0
+
+        # Stats
+        self.rows_buffered = 0
+        self.rows_inserted = 0
+        self.rows_skipped = 0
+        self.rows_replayed = 0
+        self.flushes = 0
+        self.flush_errors = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self, db):
+        """
+        Replay any spooled rows from a previous run and start flushing.
+
+        Args:
+            db: SupabaseClient used to write batches
+        """
+        if self._task is not None:
+            return
+        self._db = db
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._replay()
+        self._spool = open(os.path.join(self.spool_dir, SPOOL_FILE), "a", encoding="utf-8")
+        self._task = asyncio.create_task(self._flush_loop(), name="write-buffer-flush")
+        logger.info("✅ Write-behind buffer started (spool %s, %d rows replayed)", self.spool_dir, len(self._pending))
+
+    async def stop(self):
+        """Flush what is buffered and stop; unflushed rows stay in the spool."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error("Final write-behind flush failed, %d rows left in spool: %s", len(self._pending), e)
+        async with self._write_lock:
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+
+    async def add(self, row: Dict[str, Any]):
+        """
+        Spool a message row and queue it for the next flush (returns once
+        it is spooled).
+
+        Args:
+            row: Full messages row, including a client-generated id and created_at
+        """
+        line = json.dumps(row, default=str) + "\n"
+        async with self._write_lock:
+            await asyncio.to_thread(self._write_spool, line)
+            # Queued under the same lock as the write, so a flush never
+            # rotates away a spooled row that is not in its batch
+            self._pending.append(row)
+        self.rows_buffered += 1
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def annotate(self, row_id: str, fields: Dict[str, Any]) -> bool:
+        """
+        Update a row that has not reached the DB yet.
+
+        Args:
+            row_id: Message id
+            fields: Columns to set
+
+        Returns:
+            True if the buffered row was updated, False if the row is not
+            buffered (the caller should update the DB instead)
+        """
+        if any(row['id'] == row_id for row in self._flushing):
+            # Let the in-flight insert finish so an UPDATE will find the row
+            async with self._flush_lock:
+                pass
+
+        async with self._write_lock:
+            for row in self._pending:
+                if row['id'] == row_id:
+                    row.update(fields)
+                    # Re-spool the new version; replay keeps the last one
+                    await asyncio.to_thread(self._write_spool, json.dumps(row, default=str) + "\n")
+                    return True
+        return False
+
+    def pending_for(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """Buffered rows of a conversation that may not be in the DB yet."""
+        return [
+            row for row in self._flushing + self._pending
+            if row['conversation_id'] == conversation_id
+        ]
+
+    async def flush(self) -> int:
+        """
+        Write every buffered row. On failure the rows are re-queued and
+        their spool segments kept.
+
+        Returns:
+            Number of rows newly inserted
+        """
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+
+            # Take the rows and rotate the spool together, so each segment
+            # only holds rows that are in this or an earlier batch
+            async with self._write_lock:
+                rows, self._pending = self._pending, []
+                self._flushing = rows
+                await asyncio.to_thread(self._rotate)
+            segments = list(self._segments)
+
+            started_at = time.perf_counter()
+            inserted = 0
+            sent = 0
+            try:
+                while sent < len(rows):
+                    batch = rows[sent:sent + self.max_batch]
+                    inserted += await self._db.store_messages_batch(batch)
+                    sent += len(batch)
+            except BaseException:
+                # Includes cancellation, so stop() can still flush these rows
+                self._pending = rows[sent:] + self._pending
+                self.flush_errors += 1
+                flush_seconds.observe(time.perf_counter() - started_at, outcome="error")
+                raise
+            finally:
+                self._flushing = []
+                self.rows_inserted += inserted
+                self.rows_skipped += sent - inserted
+
+            self.flushes += 1
+            flush_seconds.observe(time.perf_counter() - started_at, outcome="ok")
+            for path in segments:
+                self._segments.remove(path)
+            await asyncio.to_thread(self._remove_segments, segments)
+            return inserted
+
+    async def _flush_loop(self):
+        while True:
+            delay = self.flush_interval
+            if self._failures:
+                delay = min(self.flush_interval * 2 ** self._failures, MAX_RETRY_DELAY)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+                self._failures = 0
+            except Exception as e:
+                self._failures += 1
+                logger.error("Write-behind flush failed (%d rows pending, attempt %d): %s", len(self._pending), self._failures, e)
+
+    def _write_spool(self, line: str):
+        self._spool.write(line)
+        self._spool.flush()
+        if self.fsync:
+            os.fsync(self._spool.fileno())
+
+    @staticmethod
+    def _remove_segments(paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _rotate(self):
+        """Close the current spool file as a segment and start a new one."""
+        current = os.path.join(self.spool_dir, SPOOL_FILE)
+        if self._spool is not None:
+            self._spool.close()
+        if os.path.exists(current) and os.path.getsize(current):
+            self._segment_seq += 1
+            segment = os.path.join(self.spool_dir, f"segment-{int(time.time() * 1000)}-{self._segment_seq}.jsonl")
+            os.replace(current, segment)
+            self._segments.append(segment)
+        self._spool = open(current, "a", encoding="utf-8")
+
+    def _replay(self):
+        """Queue rows left in the spool by a previous process."""
+        names = sorted(n for n in os.listdir(self.spool_dir) if n.startswith("segment-"))
+        if os.path.exists(os.path.join(self.spool_dir, SPOOL_FILE)):
+            names.append(SPOOL_FILE)
+
+        rows: Dict[str, Dict[str, Any]] = {}
+        for name in names:
+            path = os.path.join(self.spool_dir, name)
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn write from a crash mid-append
+                        continue
+                    # Later lines are newer versions (see annotate)
+                    rows[row['id']] = row
+                    # Twilio retries of these messages must not be answered twice
+                    if row.get('whatsapp_message_id'):
+                        message_dedupe.check_and_mark(row['whatsapp_message_id'])
+            if name != SPOOL_FILE:
+                self._segments.append(path)
+
+        self._pending.extend(rows.values())
+        self.rows_replayed = len(self._pending)
+        if self._pending:
+            logger.warning("Replaying %d unflushed messages from the write-behind spool", len(self._pending))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "spool_segments": len(self._segments),
+            "rows_buffered": self.rows_buffered,
+            "rows_inserted": self.rows_inserted,
+            "rows_skipped": self.rows_skipped,
+            "rows_replayed": self.rows_replayed,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+        }
+
+
+# Global write-behind buffer for messages
+message_buffer = WriteBehindBuffer(
+    spool_dir=settings.write_buffer_spool_dir,
+    flush_interval=settings.write_buffer_flush_interval,
+    max_batch=settings.write_buffer_max_batch,
+    fsync=settings.write_buffer_fsync
+)
+
+metrics.gauge(
+    "whatsapp_write_buffer_pending",
+    "Message rows buffered and not yet confirmed by the DB",
+    lambda: {(): len(message_buffer._pending) + len(message_buffer._flushing)}
+)
+metrics.gauge(
+    "whatsapp_write_buffer_rows_total",
+    "Message rows handled by the write-behind buffer, by result",
+    lambda: {
+        ("buffered",): message_buffer.rows_buffered,
+        ("inserted",): message_buffer.rows_inserted,
+        ("skipped",): message_buffer.rows_skipped,
+        ("replayed",): message_buffer.rows_replayed,
+    },
+    ["result"],
+    kind="counter"
+)
@@ -0,0 +1,68 @@
+"""
+Test the token-budgeted context builder
+"""
+import sys
+sys.path.append('.')
+
+from agents.context import ContextBuilder
+
+
+def turn(sender_type: str, text: str, minute: int, sid: str = None) -> dict:
+    return {
+        "sender_type": sender_type,
+        "message_text": text,
+        "whatsapp_message_id": sid,
+        "created_at": f"2025-01-01T10:{minute:02d}:00+00:00",
+    }
+
+
+def test_context():
+    print("🧪 Testing context builder...")
+    builder = ContextBuilder(budget=1500, max_recent_turns=4, max_message_tokens=400)
+
+    older = [turn("customer" if i % 2 == 0 else "agent", f"older turn {i}", i) for i in range(6)]
+
+    # Test 1: Plain turn is trimmed to max_recent_turns
+    print("\nTest 1: Single message")
+    history = older + [turn("customer", "current", 10)]
+    context = builder.build("system", "current", history)
+    contents = [m["content"] for m in context.messages[1:]]
+    assert contents == ["older turn 2", "older turn 3", "older turn 4", "older turn 5", "current"], contents
+    assert context.trimmed and [m["message_text"] for m in context.unsummarized] == ["older turn 0", "older turn 1"]
+    print("✅ Single message passed")
+
+    # Test 2: A burst longer than max_recent_turns is kept whole
+    print("\nTest 2: Burst of 7 messages")
+    burst = [turn("customer", f"burst {i}", 20 + i, f"SM{i}") for i in range(7)]
+    sids = [m["whatsapp_message_id"] for m in burst]
+    context = builder.build("system", "burst 6", older + burst, batch_sids=sids)
+    contents = [m["content"] for m in context.messages[1:]]
+    assert contents[-7:] == [f"burst {i}" for i in range(7)], contents
+    # ...with up to max_recent_turns older turns before it
+    assert contents[:-7] == ["older turn 2", "older turn 3", "older turn 4", "older turn 5"], contents
+    assert all(m["message_text"].startswith("older") for m in context.unsummarized)
+    print("✅ Burst passed")
+
+    # Test 3: The burst is kept even when it alone exceeds the budget
+    print("\nTest 3: Burst over budget")
+    tight = ContextBuilder(budget=20, max_recent_turns=4, max_message_tokens=400)
+    context = tight.build("system", "burst 6", older + burst, batch_sids=sids)
+    contents = [m["content"] for m in context.messages[1:]]
+    assert contents == [f"burst {i}" for i in range(7)], contents
+    assert len(context.unsummarized) == len(older)
+    print("✅ Burst over budget passed")
+
+    # Test 4: A media-only message (stored without text) still pins its burst
+    print("\nTest 4: Media-only burst")
+    photos = [turn("customer", "is this in stock?", 30, "SMa"), turn("customer", "", 31, "SMb")]
+    context = builder.build("system", "[image]", older + photos, batch_sids=["SMa", "SMb"])
+    contents = [m["content"] for m in context.messages[1:]]
+    assert contents[-2:] == ["is this in stock?", "[image]"], contents
+    assert contents[:-2] == ["older turn 2", "older turn 3", "older turn 4", "older turn 5"], contents
+    print("✅ Media-only burst passed")
+
+    print("\n🎉 All context tests passed!")
+
+
+if __name__ == "__main__":
+    test_context()
@@ -1,67 +1,117 @@
+import os
 import asyncio
 import logging
-from services.redis_client import redis_cache
+from services.cache import InMemoryCache, TieredCache
+from services.redis_client import RedisCache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def make_l2s():
+    """Two Redis clients standing in for two workers (fakeredis unless REDIS_URL is set)."""
+    url = os.getenv("REDIS_URL")
+    if url:
+        print(f"Using Redis at {url}")
+        return RedisCache(url), RedisCache(url)
+
+    import fakeredis
+    server = fakeredis.FakeServer()
+    print("Using fakeredis (set REDIS_URL to test against a real server)")
+    return (
+        RedisCache(client=fakeredis.aioredis.FakeRedis(server=server)),
+        RedisCache(client=fakeredis.aioredis.FakeRedis(server=server)),
+    )
+
+
+async def wait_for(predicate, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not await predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
 async def test_cache():
-    print("🧪 Testing Redis Cache...")
-    
-    if not redis_cache.enabled:
-        print("⚠️ Redis is disabled or unavailable. Testing graceful degradation...")
-        
-        # Test get (should return None)
-        val = await redis_cache.get("test_key")
-        assert val is None
-        print("✅ Graceful get passed")
-        
-        # Test set (should return False)
-        success = await redis_cache.set("test_key", "value")
-        assert success is False
-        print("✅ Graceful set passed")
-        
-        print("✅ Graceful degradation verified!")
-        return
+    print("🧪 Testing two-tier cache...")
+
+    # Test 0: Graceful degradation without Redis
+    print("\nTest 0: L1 only")
+    local = TieredCache(InMemoryCache())
+    await local.set("test_key", {"foo": "bar"})
+    assert await local.get("test_key") == {"foo": "bar"}
+    assert local.stats()['l2']['enabled'] is False
+    print("✅ L1-only cache passed")
 
+    l2_a, l2_b = make_l2s()
+    worker_a = TieredCache(InMemoryCache(), l2_a, l1_ttl=30)
+    worker_b = TieredCache(InMemoryCache(), l2_b, l1_ttl=30)
+    await worker_a.start()
+    await worker_b.start()
+    await asyncio.sleep(0.1)  # let the subscriptions settle
+    assert await l2_a.ping()
     print("✅ Redis is enabled and connected!")
-    
-    # Test 1: Basic Set/Get
-    print("\nTest 1: Basic Set/Get")
-    test_data = {"foo": "bar", "num": 123}
-    await redis_cache.set("test_key", test_data, ttl=60)
-    result = await redis_cache.get("test_key")
-    assert result == test_data
-    print(f"✅ Set/Get passed: {result}")
-    
-    # Test 2: Conversation History
-    print("\nTest 2: Conversation History")
-    history = [
-        {"role": "user", "content": "Hello"},
-        {"role": "assistant", "content": "Hi there!"}
-    ]
-    await redis_cache.set_cached_conversation_history("test-convo-123", history)
-    cached_history = await redis_cache.get_cached_conversation_history("test-convo-123")
-    assert cached_history == history
-    print(f"✅ History caching passed: {len(cached_history)} messages")
-    
-    # Test 3: Invalidation
-    print("\nTest 3: Cache Invalidation")
-    await redis_cache.invalidate_conversation_cache("test-convo-123")
-    deleted = await redis_cache.get_cached_conversation_history("test-convo-123")
-    assert deleted is None
-    print("✅ Invalidation passed")
-    
-    # Test 4: Customer Caching
-    print("\nTest 4: Customer Caching")
-    customer = {"id": "cust-123", "name": "Test User"}
-    await redis_cache.set_cached_customer("1234567890", customer)
-    cached_cust = await redis_cache.get_cached_customer("1234567890")
-    assert cached_cust == customer
-    print("✅ Customer caching passed")
+
+    try:
+        # Test 1: Basic Set/Get through L2
+        print("\nTest 1: Basic Set/Get")
+        test_data = {"foo": "bar", "num": 123, "raw": b"\x00\x01"}
+        await worker_a.set("test_key", test_data, ttl=60)
+        result = await worker_b.get("test_key")
+        assert result == test_data
+        assert worker_b.l2_hits == 1
+        await worker_b.get("test_key")
+        assert worker_b.l2_hits == 1, "second read should be served by L1"
+        print(f"✅ Set/Get passed: {result}")
+
+        # Test 2: Conversation History
+        print("\nTest 2: Conversation History")
+        history = [
+            {"role": "user", "content": "Hello"},
+            {"role": "assistant", "content": "Hi there!"}
+        ]
+        await worker_a.set_cached_conversation_history("test-convo-123", history)
+        cached_history = await worker_b.get_cached_conversation_history("test-convo-123")
+        assert cached_history == history
+        print(f"✅ History caching passed: {len(cached_history)} messages")
+
+        # Test 3: Cross-worker invalidation
+        print("\nTest 3: Cross-worker invalidation")
+        await worker_a.append_conversation_history(
+            "test-convo-123", {"role": "user", "content": "Red sneakers?"}
+        )
+        await wait_for(lambda: _has_length(worker_b, "test-convo-123", 3))
+        assert worker_b.invalidations_received >= 1
+        print("✅ Worker B saw worker A's append")
+
+        await worker_a.invalidate_conversation_cache("test-convo-123")
+        await wait_for(lambda: _is_gone(worker_b, "test-convo-123"))
+        print("✅ Invalidation passed")
+
+        # Test 4: Customer Caching
+        print("\nTest 4: Customer Caching")
+        customer = {"id": "cust-123", "name": "Test User"}
+        await worker_a.set_cached_customer("1234567890", customer)
+        cached_cust = await worker_b.get_cached_customer("1234567890")
+        assert cached_cust == customer
+        print("✅ Customer caching passed")
+    finally:
+        await worker_a.delete("test_key")
+        await worker_a.delete("customer:1234567890")
+        await worker_a.close()
+        await worker_b.close()
 
     print("\n🎉 All Redis tests passed successfully!")
 
+
+async def _has_length(worker: TieredCache, conversation_id: str, length: int) -> bool:
+    history = await worker.get_cached_conversation_history(conversation_id)
+    return history is not None and len(history) == length
+
+
+async def _is_gone(worker: TieredCache, conversation_id: str) -> bool:
+    return await worker.get_cached_conversation_history(conversation_id) is None
+
+
 if __name__ == "__main__":
     asyncio.run(test_cache())
@@ -108,6 +108,25 @@ CREATE INDEX idx_conversations_status ON conversations(status);
 CREATE INDEX idx_conversations_started ON conversations(started_at);
 CREATE INDEX idx_conversations_last_message ON conversations(last_message_at);
 CREATE INDEX idx_conversations_whatsapp ON conversations(whatsapp_number);
+-- Keyset paging for exports
+CREATE INDEX idx_conversations_created ON conversations(created_at, id);
+-- Idle sweep: only the (small) active set, oldest activity first
+CREATE INDEX idx_conversations_active_idle ON conversations(last_message_at) WHERE status = 'active';
+-- At most one active conversation per customer (also serves the active lookup).
+-- Databases that predate the index can hold several active conversations per
+-- customer; keep the most recent one active and close the rest first, or
+-- creating the index fails.
+UPDATE conversations c
+SET status = 'closed', ended_at = COALESCE(c.ended_at, NOW())
+WHERE c.status = 'active'
+  AND EXISTS (
+    SELECT 1 FROM conversations newer
+    WHERE newer.customer_id = c.customer_id
+      AND newer.status = 'active'
+      AND (COALESCE(newer.last_message_at, '-infinity'), COALESCE(newer.created_at, '-infinity'), newer.id)
+        > (COALESCE(c.last_message_at, '-infinity'), COALESCE(c.created_at, '-infinity'), c.id)
+  );
+CREATE UNIQUE INDEX idx_conversations_one_active ON conversations(customer_id) WHERE status = 'active';
 
 CREATE TRIGGER update_conversations_updated_at BEFORE UPDATE ON conversations
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
@@ -130,6 +149,7 @@ CREATE TABLE messages (
   is_automated BOOLEAN DEFAULT true,
   confidence_score DECIMAL(3, 2),
   metadata JSONB,
+  delivery_status VARCHAR(20), -- outbound only: pending, sending, sent, failed
   sent_at TIMESTAMPTZ DEFAULT NOW(),
   delivered_at TIMESTAMPTZ,
   read_at TIMESTAMPTZ,
@@ -137,11 +157,16 @@ CREATE TABLE messages (
 );
 
 -- Indexes for messages
-CREATE INDEX idx_messages_conversation ON messages(conversation_id);
+-- Conversation lookups and keyset paging of a conversation's messages
+CREATE INDEX idx_messages_conversation ON messages(conversation_id, created_at, id);
+-- Keyset paging for exports
+CREATE INDEX idx_messages_created ON messages(created_at, id);
 CREATE INDEX idx_messages_sent_at ON messages(sent_at);
 CREATE INDEX idx_messages_direction ON messages(direction);
 CREATE INDEX idx_messages_whatsapp_id ON messages(whatsapp_message_id);
 CREATE INDEX idx_messages_text_trgm ON messages USING gin(message_text gin_trgm_ops);
+-- Outbound recovery: replies stored but never handed to Twilio
+CREATE INDEX idx_messages_pending_delivery ON messages(created_at) WHERE delivery_status = 'pending';
 
 -- =====================================================
 -- SESSIONS TABLE (for ADK context retention)
@@ -187,6 +212,7 @@ CREATE TRIGGER update_cart_items_updated_at BEFORE UPDATE ON cart_items
 CREATE TABLE orders (
   id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
   order_number VARCHAR(50) UNIQUE NOT NULL,
+  idempotency_key VARCHAR(255) UNIQUE, -- MessageSid that confirmed the order
   customer_id UUID REFERENCES customers(id) ON DELETE SET NULL,
   conversation_id UUID REFERENCES conversations(id) ON DELETE SET NULL,
   status VARCHAR(50) DEFAULT 'pending', -- pending, confirmed, processing, shipped, delivered, cancelled
@@ -255,6 +281,28 @@ CREATE INDEX idx_analytics_events_type ON analytics_events(event_type);
 CREATE INDEX idx_analytics_events_occurred_at ON analytics_events(occurred_at);
 CREATE INDEX idx_analytics_events_customer ON analytics_events(customer_id);
 
+-- =====================================================
+-- DAILY STATS TABLE (dashboard aggregates)
+-- =====================================================
+-- One row per UTC day, incremented by the backend (add_daily_stats) as
+-- messages, conversations, customers and orders are created, so the
+-- dashboard never scans the base tables. rebuild_daily_stats() recomputes
+-- it from them (backfill or repair).
+CREATE TABLE daily_stats (
+  day DATE PRIMARY KEY,
+  messages_inbound INTEGER NOT NULL DEFAULT 0,
+  messages_outbound INTEGER NOT NULL DEFAULT 0,
+  orders INTEGER NOT NULL DEFAULT 0,
+  order_value DECIMAL(14, 2) NOT NULL DEFAULT 0,
+  new_customers INTEGER NOT NULL DEFAULT 0,
+  conversations_started INTEGER NOT NULL DEFAULT 0,
+  conversations_closed INTEGER NOT NULL DEFAULT 0,
+  -- Totals of confirmed, shipped and delivered orders, kept current by the
+  -- track_order_revenue trigger as order statuses change
+  revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
 -- =====================================================
 -- ADMIN USERS TABLE (for dashboard)
 -- =====================================================
@@ -291,6 +339,7 @@ ALTER TABLE cart_items ENABLE ROW LEVEL SECURITY;
 ALTER TABLE orders ENABLE ROW LEVEL SECURITY;
 ALTER TABLE order_items ENABLE ROW LEVEL SECURITY;
 ALTER TABLE analytics_events ENABLE ROW LEVEL SECURITY;
+ALTER TABLE daily_stats ENABLE ROW LEVEL SECURITY;
 ALTER TABLE admin_users ENABLE ROW LEVEL SECURITY;
 
 -- Admin policies (allow full access for authenticated admins)
@@ -349,6 +398,17 @@ CREATE POLICY "Admins can view all orders"
     )
   );
 
+CREATE POLICY "Admins can view daily stats"
+  ON daily_stats FOR SELECT
+  TO authenticated
+  USING (
+    EXISTS (
+      SELECT 1 FROM admin_users
+      WHERE admin_users.id = auth.uid()
+      AND admin_users.is_active = true
+    )
+  );
+
 -- Service role has full access (for backend agent)
 CREATE POLICY "Service role can do everything on customers"
   ON customers FOR ALL
@@ -390,18 +450,109 @@ CREATE POLICY "Service role can do everything on analytics"
   TO service_role
   USING (true);
 
+CREATE POLICY "Service role can do everything on daily stats"
+  ON daily_stats FOR ALL
+  TO service_role
+  USING (true);
+
 -- =====================================================
 -- UTILITY FUNCTIONS
 -- =====================================================
 
+-- Monotonic, collision-free order numbers: ORD-YYYYMMDD-000042
+CREATE SEQUENCE order_number_seq;
+
 -- Function to generate unique order number
 CREATE OR REPLACE FUNCTION generate_order_number()
 RETURNS VARCHAR AS $$
+BEGIN
+  RETURN 'ORD-' || TO_CHAR(NOW(), 'YYYYMMDD') || '-' || LPAD(nextval('order_number_seq')::TEXT, 6, '0');
+END;
+$$ LANGUAGE plpgsql;
+
+-- Insert an order and its items once per idempotency key. Returns the
+-- order (new or existing) and whether this call created it.
+CREATE OR REPLACE FUNCTION place_order(p_order JSONB)
+RETURNS JSONB AS $$
 DECLARE
-  new_order_number VARCHAR;
+  v_order orders%ROWTYPE;
+  v_total DECIMAL(12, 2) := COALESCE((p_order->>'total')::DECIMAL, 0);
 BEGIN
-  new_order_number := 'ORD-' || TO_CHAR(NOW(), 'YYYYMMDD') || '-' || LPAD(FLOOR(RANDOM() * 10000)::TEXT, 4, '0');
-  RETURN new_order_number;
+  IF p_order->>'idempotency_key' IS NOT NULL THEN
+    SELECT * INTO v_order FROM orders WHERE idempotency_key = p_order->>'idempotency_key';
+    IF FOUND THEN
+      RETURN jsonb_build_object('order', to_jsonb(v_order), 'created', false);
+    END IF;
+  END IF;
+
+  INSERT INTO orders (order_number, idempotency_key, customer_id, conversation_id, status, subtotal, total)
+  VALUES (
+    generate_order_number(),
+    p_order->>'idempotency_key',
+    (p_order->>'customer_id')::UUID,
+    (p_order->>'conversation_id')::UUID,
+    'pending_payment',
+    v_total,
+    v_total
+  )
+  ON CONFLICT (idempotency_key) DO NOTHING
+  RETURNING * INTO v_order;
+
+  IF NOT FOUND THEN
+    -- Lost a race with a concurrent insert of the same order
+    SELECT * INTO v_order FROM orders WHERE idempotency_key = p_order->>'idempotency_key';
+    RETURN jsonb_build_object('order', to_jsonb(v_order), 'created', false);
+  END IF;
+
+  INSERT INTO order_items (order_id, product_snapshot, quantity, unit_price, subtotal)
+  SELECT
+    v_order.id,
+    item,
+    COALESCE((item->>'quantity')::INTEGER, 1),
+    COALESCE((item->>'price')::DECIMAL, 0),
+    COALESCE((item->>'quantity')::INTEGER, 1) * COALESCE((item->>'price')::DECIMAL, 0)
+  FROM jsonb_array_elements(COALESCE(p_order->'items', '[]'::JSONB)) AS item;
+
+  RETURN jsonb_build_object('order', to_jsonb(v_order), 'created', true);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Resolve (or create) the customer and their active conversation in one round trip.
+-- The *_created flags feed the dashboard's daily counters.
+CREATE OR REPLACE FUNCTION resolve_customer_conversation(p_whatsapp_number VARCHAR)
+RETURNS JSONB AS $$
+DECLARE
+  v_customer customers%ROWTYPE;
+  v_conversation conversations%ROWTYPE;
+  v_customer_created BOOLEAN := false;
+  v_conversation_created BOOLEAN := false;
+BEGIN
+  SELECT * INTO v_customer FROM customers WHERE whatsapp_number = p_whatsapp_number;
+  IF NOT FOUND THEN
+    INSERT INTO customers (whatsapp_number)
+    VALUES (p_whatsapp_number)
+    ON CONFLICT (whatsapp_number) DO NOTHING;
+    v_customer_created := FOUND;
+    SELECT * INTO v_customer FROM customers WHERE whatsapp_number = p_whatsapp_number;
+  END IF;
+
+  SELECT * INTO v_conversation FROM conversations
+  WHERE customer_id = v_customer.id AND status = 'active';
+  IF NOT FOUND THEN
+    INSERT INTO conversations (customer_id, whatsapp_number, status)
+    VALUES (v_customer.id, p_whatsapp_number, 'active')
+    ON CONFLICT (customer_id) WHERE status = 'active' DO NOTHING;
+    v_conversation_created := FOUND;
+    SELECT * INTO v_conversation FROM conversations
+    WHERE customer_id = v_customer.id AND status = 'active';
+  END IF;
+
+  RETURN jsonb_build_object(
+    'customer', to_jsonb(v_customer),
+    'conversation', to_jsonb(v_conversation),
+    'customer_created', v_customer_created,
+    'conversation_created', v_conversation_created
+  );
 END;
 $$ LANGUAGE plpgsql;
 
@@ -425,20 +576,210 @@ CREATE TRIGGER trigger_update_customer_stats
   FOR EACH ROW
   EXECUTE FUNCTION update_customer_stats();
 
--- Function to update conversation message count
-CREATE OR REPLACE FUNCTION update_conversation_message_count()
+-- The per-row message counter trigger is replaced by store_messages_batch;
+-- drop it from databases created before the change, or counts double
+DROP TRIGGER IF EXISTS trigger_update_conversation_message_count ON messages;
+DROP FUNCTION IF EXISTS update_conversation_message_count();
+
+-- Databases created before outbound delivery tracking (see CREATE TABLE messages)
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(20);
+CREATE INDEX IF NOT EXISTS idx_messages_pending_delivery ON messages(created_at) WHERE delivery_status = 'pending';
+
+-- Insert a batch of buffered messages and apply their conversation counter
+-- deltas (message_count, last_message_at) in one round trip. Used by the
+-- backend's write-behind buffer instead of a per-row trigger. Idempotent:
+-- rows already stored (same id or whatsapp_message_id) are skipped and not
+-- counted again, so a replayed batch is safe.
+CREATE OR REPLACE FUNCTION store_messages_batch(p_messages JSONB)
+RETURNS JSONB AS $$
+DECLARE
+  v_inserted INTEGER;
+BEGIN
+  WITH inserted AS (
+    INSERT INTO messages (
+      id, conversation_id, whatsapp_message_id, direction, sender_type, content_type,
+      message_text, media_url, media_mime_type, is_automated, metadata, delivery_status,
+      sent_at, created_at
+    )
+    SELECT
+      id, conversation_id, whatsapp_message_id, direction, sender_type, COALESCE(content_type, 'text'),
+      message_text, media_url, media_mime_type, COALESCE(is_automated, true), metadata, delivery_status,
+      COALESCE(sent_at, NOW()), COALESCE(created_at, NOW())
+    FROM jsonb_populate_recordset(NULL::messages, p_messages)
+    ON CONFLICT DO NOTHING
+    RETURNING conversation_id, sent_at
+  ), deltas AS (
+    SELECT conversation_id, COUNT(*) AS n, MAX(sent_at) AS last_at
+    FROM inserted
+    GROUP BY conversation_id
+  ), updated AS (
+    UPDATE conversations c
+    SET
+      message_count = c.message_count + d.n,
+      last_message_at = GREATEST(c.last_message_at, d.last_at)
+    FROM deltas d
+    WHERE c.id = d.conversation_id
+    RETURNING c.id
+  )
+  SELECT COALESCE(SUM(n), 0) INTO v_inserted FROM deltas;
+
+  RETURN jsonb_build_object('inserted', v_inserted);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Add per-day counter deltas from the backend (additive, so concurrent
+-- workers can flush independently). p_rows: [{"day": "2025-01-31", "orders": 1, ...}]
+CREATE OR REPLACE FUNCTION add_daily_stats(p_rows JSONB)
+RETURNS VOID AS $$
+BEGIN
+  INSERT INTO daily_stats AS d (
+    day, messages_inbound, messages_outbound, orders, order_value,
+    new_customers, conversations_started, conversations_closed
+  )
+  SELECT
+    day, COALESCE(messages_inbound, 0), COALESCE(messages_outbound, 0), COALESCE(orders, 0),
+    COALESCE(order_value, 0), COALESCE(new_customers, 0), COALESCE(conversations_started, 0),
+    COALESCE(conversations_closed, 0)
+  FROM jsonb_populate_recordset(NULL::daily_stats, p_rows)
+  ON CONFLICT (day) DO UPDATE SET
+    messages_inbound = d.messages_inbound + EXCLUDED.messages_inbound,
+    messages_outbound = d.messages_outbound + EXCLUDED.messages_outbound,
+    orders = d.orders + EXCLUDED.orders,
+    order_value = d.order_value + EXCLUDED.order_value,
+    new_customers = d.new_customers + EXCLUDED.new_customers,
+    conversations_started = d.conversations_started + EXCLUDED.conversations_started,
+    conversations_closed = d.conversations_closed + EXCLUDED.conversations_closed,
+    updated_at = NOW();
+END;
+$$ LANGUAGE plpgsql;
+
+-- Sum of each daily_stats counter over [p_from, p_to)
+CREATE OR REPLACE FUNCTION sum_daily_stats(p_from DATE, p_to DATE)
+RETURNS JSONB AS $$
+  SELECT jsonb_build_object(
+    'messages_inbound', COALESCE(SUM(messages_inbound), 0),
+    'messages_outbound', COALESCE(SUM(messages_outbound), 0),
+    'orders', COALESCE(SUM(orders), 0),
+    'order_value', COALESCE(SUM(order_value), 0),
+    'new_customers', COALESCE(SUM(new_customers), 0),
+    'conversations_started', COALESCE(SUM(conversations_started), 0),
+    'conversations_closed', COALESCE(SUM(conversations_closed), 0),
+    'revenue', COALESCE(SUM(revenue), 0)
+  )
+  FROM daily_stats
+  WHERE day >= p_from AND day < p_to;
+$$ LANGUAGE sql STABLE;
+
+-- Dashboard periods summed from daily_stats (one row per day, so this stays
+-- cheap however large the base tables grow)
+CREATE OR REPLACE FUNCTION daily_stats_summary(p_today DATE)
+RETURNS JSONB AS $$
+  SELECT jsonb_build_object(
+    'totals', sum_daily_stats('-infinity'::DATE, 'infinity'::DATE),
+    'today', sum_daily_stats(p_today, p_today + 1),
+    'this_month', sum_daily_stats(date_trunc('month', p_today)::DATE, p_today + 1),
+    'last_month', sum_daily_stats(
+      (date_trunc('month', p_today) - INTERVAL '1 month')::DATE,
+      date_trunc('month', p_today)::DATE
+    )
+  );
+$$ LANGUAGE sql STABLE;
+
+-- Recompute daily_stats from the base tables (run once after creating the
+-- table on an existing database, or to repair drift)
+CREATE OR REPLACE FUNCTION rebuild_daily_stats()
+RETURNS VOID AS $$
+BEGIN
+  DELETE FROM daily_stats;
+  INSERT INTO daily_stats (
+    day, messages_inbound, messages_outbound, orders, order_value,
+    new_customers, conversations_started, conversations_closed, revenue
+  )
+  SELECT day, SUM(mi), SUM(mo), SUM(o), SUM(ov), SUM(nc), SUM(cs), SUM(cc), SUM(rv)
+  FROM (
+    SELECT (created_at AT TIME ZONE 'UTC')::DATE AS day,
+      COUNT(*) FILTER (WHERE direction = 'inbound') AS mi, COUNT(*) FILTER (WHERE direction = 'outbound') AS mo,
+      0 AS o, 0 AS ov, 0 AS nc, 0 AS cs, 0 AS cc, 0 AS rv
+    FROM messages GROUP BY 1
+    UNION ALL
+    SELECT (created_at AT TIME ZONE 'UTC')::DATE, 0, 0, COUNT(*), SUM(total), 0, 0, 0,
+      COALESCE(SUM(total) FILTER (WHERE status IN ('confirmed', 'shipped', 'delivered')), 0)
+    FROM orders GROUP BY 1
+    UNION ALL
+    SELECT (created_at AT TIME ZONE 'UTC')::DATE, 0, 0, 0, 0, COUNT(*), 0, 0, 0 FROM customers GROUP BY 1
+    UNION ALL
+    SELECT (started_at AT TIME ZONE 'UTC')::DATE, 0, 0, 0, 0, 0, COUNT(*), 0, 0 FROM conversations GROUP BY 1
+    UNION ALL
+    SELECT (COALESCE(ended_at, updated_at) AT TIME ZONE 'UTC')::DATE, 0, 0, 0, 0, 0, 0, COUNT(*), 0
+    FROM conversations WHERE status <> 'active' GROUP BY 1
+  ) per_table
+  GROUP BY day;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Keep daily_stats.revenue in step with order statuses. An order counts
+-- towards revenue (on the day it was created) while it is confirmed,
+-- shipped or delivered, so confirming, cancelling or deleting it moves the
+-- figure, whoever makes the change (backend or dashboard).
+CREATE OR REPLACE FUNCTION track_order_revenue()
 RETURNS TRIGGER AS $$
+DECLARE
+  v_old DECIMAL(14, 2) := 0;
+  v_new DECIMAL(14, 2) := 0;
 BEGIN
-  UPDATE conversations
-  SET 
-    message_count = message_count + 1,
-    last_message_at = NEW.sent_at
-  WHERE id = NEW.conversation_id;
-  RETURN NEW;
+  IF TG_OP <> 'INSERT' THEN
+    IF OLD.status IN ('confirmed', 'shipped', 'delivered') THEN
+      v_old := OLD.total;
+    END IF;
+  END IF;
+  IF TG_OP <> 'DELETE' THEN
+    IF NEW.status IN ('confirmed', 'shipped', 'delivered') THEN
+      v_new := NEW.total;
+    END IF;
+  END IF;
+
+  IF TG_OP = 'UPDATE' AND v_old = v_new THEN
+    -- e.g. confirmed -> shipped
+    RETURN NULL;
+  END IF;
+  IF v_old <> 0 THEN
+    INSERT INTO daily_stats AS d (day, revenue)
+    VALUES ((OLD.created_at AT TIME ZONE 'UTC')::DATE, -v_old)
+    ON CONFLICT (day) DO UPDATE SET revenue = d.revenue + EXCLUDED.revenue, updated_at = NOW();
+  END IF;
+  IF v_new <> 0 THEN
+    INSERT INTO daily_stats AS d (day, revenue)
+    VALUES ((NEW.created_at AT TIME ZONE 'UTC')::DATE, v_new)
+    ON CONFLICT (day) DO UPDATE SET revenue = d.revenue + EXCLUDED.revenue, updated_at = NOW();
+  END IF;
+  RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
 
-CREATE TRIGGER trigger_update_conversation_message_count
-  AFTER INSERT ON messages
+CREATE TRIGGER trigger_track_order_revenue
+  AFTER INSERT OR DELETE OR UPDATE OF status, total ON orders
   FOR EACH ROW
-  EXECUTE FUNCTION update_conversation_message_count();
+  EXECUTE FUNCTION track_order_revenue();
+
+-- Close idle conversations in a batch (used by the backend's sweeper, which
+-- passes the ids whose customers' leases it holds). SKIP LOCKED lets
+-- several sweepers run without blocking each other or a message that is
+-- updating the same row; the idle condition is checked again on the
+-- locked row.
+DROP FUNCTION IF EXISTS close_idle_conversations(TIMESTAMPTZ, INTEGER);
+
+CREATE OR REPLACE FUNCTION close_idle_conversations(p_idle_before TIMESTAMPTZ, p_ids UUID[])
+RETURNS TABLE (id UUID, whatsapp_number VARCHAR) AS $$
+BEGIN
+  RETURN QUERY
+  UPDATE conversations c
+  SET status = 'closed', ended_at = NOW()
+  FROM (
+    SELECT i.id FROM conversations i
+    WHERE i.id = ANY(p_ids) AND i.status = 'active' AND i.last_message_at < p_idle_before
+    FOR UPDATE SKIP LOCKED
+  ) idle
+  WHERE c.id = idle.id AND c.status = 'active' AND c.last_message_at < p_idle_before
+  RETURNING c.id, c.whatsapp_number;
+END;
+$$ LANGUAGE plpgsql;
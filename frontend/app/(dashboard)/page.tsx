@@ -1,6 +1,5 @@
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card"
 import { MessageSquare, ShoppingCart, Users, DollarSign } from "lucide-react"
-import { createClient } from "@/lib/supabase/server"
 
 export const dynamic = 'force-dynamic'
 
@@ -11,109 +10,70 @@ interface DashboardStats {
   conversationsGrowth: number
   totalOrders: number
   ordersGrowth: number
-  activeCustomers: number
+  totalCustomers: number
   customersGrowth: number
 }
 
+interface PeriodStats {
+  messages_inbound: number
+  messages_outbound: number
+  orders: number
+  order_value: number
+  new_customers: number
+  conversations_started: number
+  conversations_closed: number
+  revenue: number
+}
+
+interface AnalyticsSummary {
+  active_conversations: number
+  totals: PeriodStats
+  this_month: PeriodStats
+  last_month: PeriodStats
+  growth: Record<'revenue' | 'order_value' | 'orders' | 'new_customers' | 'conversations_started', number>
+}
+
+const EMPTY_STATS: DashboardStats = {
+  totalRevenue: 0,
+  revenueGrowth: 0,
+  activeConversations: 0,
+  conversationsGrowth: 0,
+  totalOrders: 0,
+  ordersGrowth: 0,
+  totalCustomers: 0,
+  customersGrowth: 0,
+}
+
+// One request to the backend's running aggregates instead of scanning the
+// orders, conversations and customers tables on every load
 async function getDashboardStats(): Promise<DashboardStats> {
-  const supabase = await createClient()
-  
-  // Get current month and last month date ranges
-  const now = new Date()
-  const currentMonthStart = new Date(now.getFullYear(), now.getMonth(), 1)
-  const lastMonthStart = new Date(now.getFullYear(), now.getMonth() - 1, 1)
-  const lastMonthEnd = new Date(now.getFullYear(), now.getMonth(), 0, 23, 59, 59)
+  const backendUrl = process.env.BACKEND_URL || 'http://localhost:8000'
   
   try {
-    // Total Revenue - sum of confirmed/delivered orders
-    const { data: revenueData } = await supabase
-      .from('orders')
-      .select('total')
-      .in('status', ['confirmed', 'delivered', 'shipped'])
-    
-    const totalRevenue = revenueData?.reduce((sum, order) => sum + Number(order.total || 0), 0) || 0
-    
-    // Last month revenue
-    const { data: lastMonthRevenueData } = await supabase
-      .from('orders')
-      .select('total')
-      .in('status', ['confirmed', 'delivered', 'shipped'])
-      .gte('created_at', lastMonthStart.toISOString())
-      .lte('created_at', lastMonthEnd.toISOString())
-    
-    const lastMonthRevenue = lastMonthRevenueData?.reduce((sum, order) => sum + Number(order.total || 0), 0) || 0
-    const revenueGrowth = lastMonthRevenue > 0 ? ((totalRevenue - lastMonthRevenue) / lastMonthRevenue) * 100 : 0
-    
-    // Active Conversations
-    const { count: activeConversations } = await supabase
-      .from('conversations')
-      .select('*', { count: 'exact', head: true })
-      .eq('status', 'active')
-    
-    const { count: lastMonthConversations } = await supabase
-      .from('conversations')
-      .select('*', { count: 'exact', head: true })
-      .eq('status', 'active')
-      .gte('created_at', lastMonthStart.toISOString())
-      .lte('created_at', lastMonthEnd.toISOString())
-    
-    const conversationsGrowth = (lastMonthConversations || 0) > 0 
-      ? (((activeConversations || 0) - (lastMonthConversations || 0)) / (lastMonthConversations || 0)) * 100 
-      : 0
-    
-    // Total Orders
-    const { count: totalOrders } = await supabase
-      .from('orders')
-      .select('*', { count: 'exact', head: true })
-    
-    const { count: lastMonthOrders } = await supabase
-      .from('orders')
-      .select('*', { count: 'exact', head: true })
-      .gte('created_at', lastMonthStart.toISOString())
-      .lte('created_at', lastMonthEnd.toISOString())
-    
-    const ordersGrowth = (lastMonthOrders || 0) > 0 
-      ? (((totalOrders || 0) - (lastMonthOrders || 0)) / (lastMonthOrders || 0)) * 100 
-      : 0
-    
-    // Active Customers
-    const { count: activeCustomers } = await supabase
-      .from('customers')
-      .select('*', { count: 'exact', head: true })
-    
-    const { count: lastMonthCustomers } = await supabase
-      .from('customers')
-      .select('*', { count: 'exact', head: true })
-      .gte('created_at', lastMonthStart.toISOString())
-      .lte('created_at', lastMonthEnd.toISOString())
-    
-    const customersGrowth = (lastMonthCustomers || 0) > 0 
-      ? (((activeCustomers || 0) - (lastMonthCustomers || 0)) / (lastMonthCustomers || 0)) * 100 
-      : 0
+    const response = await fetch(`${backendUrl}/analytics/summary`, {
+      cache: 'no-store',
+      headers: { Authorization: `Bearer ${process.env.ANALYTICS_API_KEY ?? ''}` },
+    })
+    if (!response.ok) {
+      throw new Error(`Analytics summary returned ${response.status}`)
+    }
+    const summary: AnalyticsSummary = await response.json()
     
     return {
-      totalRevenue,
-      revenueGrowth,
-      activeConversations: activeConversations || 0,
-      conversationsGrowth,
-      totalOrders: totalOrders || 0,
-      ordersGrowth,
-      activeCustomers: activeCustomers || 0,
-      customersGrowth,
+      // Confirmed, shipped and delivered orders only
+      totalRevenue: summary.totals.revenue,
+      revenueGrowth: summary.growth.revenue,
+      activeConversations: summary.active_conversations,
+      conversationsGrowth: summary.growth.conversations_started,
+      totalOrders: summary.totals.orders,
+      ordersGrowth: summary.growth.orders,
+      totalCustomers: summary.totals.new_customers,
+      customersGrowth: summary.growth.new_customers,
     }
   } catch (error) {
     console.error('Error fetching dashboard stats:', error)
     // Return zeros if there's an error
-    return {
-      totalRevenue: 0,
-      revenueGrowth: 0,
-      activeConversations: 0,
-      conversationsGrowth: 0,
-      totalOrders: 0,
-      ordersGrowth: 0,
-      activeCustomers: 0,
-      customersGrowth: 0,
-    }
+    return EMPTY_STATS
   }
 }
 
@@ -148,7 +108,7 @@ export default async function DashboardPage() {
           <CardContent>
             <div className="text-2xl font-bold">{formatCurrency(stats.totalRevenue)}</div>
             <p className="text-xs text-muted-foreground">
-              {formatGrowth(stats.revenueGrowth)} from last month
+              {formatGrowth(stats.revenueGrowth)} vs last month
             </p>
           </CardContent>
         </Card>
@@ -160,7 +120,7 @@ export default async function DashboardPage() {
           <CardContent>
             <div className="text-2xl font-bold">{stats.activeConversations}</div>
             <p className="text-xs text-muted-foreground">
-              {formatGrowth(stats.conversationsGrowth)} from last month
+              {formatGrowth(stats.conversationsGrowth)} vs last month
             </p>
           </CardContent>
         </Card>
@@ -172,19 +132,19 @@ export default async function DashboardPage() {
           <CardContent>
             <div className="text-2xl font-bold">{stats.totalOrders}</div>
             <p className="text-xs text-muted-foreground">
-              {formatGrowth(stats.ordersGrowth)} from last month
+              {formatGrowth(stats.ordersGrowth)} vs last month
             </p>
           </CardContent>
         </Card>
         <Card>
           <CardHeader className="flex flex-row items-center justify-between space-y-0 pb-2">
-            <CardTitle className="text-sm font-medium">Active Customers</CardTitle>
+            <CardTitle className="text-sm font-medium">Customers</CardTitle>
             <Users className="h-4 w-4 text-muted-foreground" />
           </CardHeader>
           <CardContent>
-            <div className="text-2xl font-bold">{stats.activeCustomers}</div>
+            <div className="text-2xl font-bold">{stats.totalCustomers}</div>
             <p className="text-xs text-muted-foreground">
-              {formatGrowth(stats.customersGrowth)} from last month
+              {formatGrowth(stats.customersGrowth)} vs last month
             </p>
           </CardContent>
         </Card>